@@ -0,0 +1,209 @@
+# General importings
+import numpy  as np
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any, Optional, Sequence
+
+# Specific TONNE stuff
+import system_of_units as units
+
+from detector_backgrounds import get_radon_background_level
+from detector_backgrounds import get_muon_background_level
+
+from rejection_factors    import get_rejection_store
+from background_index     import get_Xe136_mass
+
+from instrumentation      import instrument
+
+
+#####################################################################
+### Isotope populations evolved: the radon chain down to Bi214, and Xe137
+EVOLUTION_ISOTOPES = ['Rn222', 'Po218', 'Pb214', 'Bi214', 'Xe137']
+
+half_life = {
+    'Rn222' : 3.8235 * units.day,
+    'Po218' : 3.098  * units.minute,
+    'Pb214' : 26.8   * units.minute,
+    'Bi214' : 19.9   * units.minute,
+    'Xe137' : 3.818  * units.minute
+}
+
+### Decay chains (parent -> daughter)
+decay_chain = [('Rn222', 'Po218'), ('Po218', 'Pb214'), ('Pb214', 'Bi214')]
+
+### Fields of every run-schedule segment and their default values.
+### duration (system of units) is mandatory; live: data taking (0 / 1),
+### muons: Xe137 production scale (0 with no xenon), radon: Rn222 emanation scale,
+### reset: every population is removed at the segment start (gas refill).
+SEGMENT_FIELDS = {'duration': None, 'live': 1., 'muons': 1., 'radon': 1., 'reset': 0.}
+
+
+
+#####################################################################
+def get_decay_matrix() -> np.ndarray:
+    '''
+    It returns the matrix A (1/s) such that dN/dt = A N for the populations
+    of EVOLUTION_ISOTOPES.
+    '''
+    position = {isotope: pos for pos, isotope in enumerate(EVOLUTION_ISOTOPES)}
+    decay_constants = np.array([np.log(2) / (half_life[iso] / units.second)
+                                for iso in EVOLUTION_ISOTOPES])
+
+    decay_matrix = -np.diag(decay_constants)
+    for parent, daughter in decay_chain:
+        decay_matrix[position[daughter], position[parent]] = decay_constants[position[parent]]
+    return decay_matrix
+
+
+
+#####################################################################
+def get_step_propagators(rates     : np.ndarray,
+                         durations : np.ndarray
+                        )         -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    It returns, for the decay rates r (1/s, eigenvalues -r of the decay matrix)
+    and any array of durations t (s), the diagonal matrix-exponential terms
+    exp(-r t), its integral phi1 = (1 - exp(-r t)) / r and the double integral
+    phi2 = (t - phi1) / r, with shape durations.shape + rates.shape.
+    '''
+    rt    = durations[..., None] * rates
+    decay = np.exp(-rt)
+    phi1  = -np.expm1(-rt) / rates
+
+    # (t - phi1) / r loses precision when r t is small, the series is used instead
+    t     = durations[..., None] * np.ones_like(rates)
+    small = rt < 1.e-3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        phi2 = np.where(small, t**2 / 2 * (1 - rt / 3 + rt**2 / 12),
+                               (rt + np.expm1(-rt)) / rates**2)
+    return decay, phi1, phi2
+
+
+
+#####################################################################
+def get_schedule_arrays(schedules: Sequence[Sequence[Dict[str, float]]]) -> Dict[str, np.ndarray]:
+    '''
+    It returns the run schedules passed (each one a list of segments, dictionaries
+    with the SEGMENT_FIELDS) as arrays of shape (n_schedules, n_segments).
+    Shorter schedules are padded with empty segments.
+    A fine time grid is just a schedule of equal-duration segments.
+    '''
+    n_segments = max(len(schedule) for schedule in schedules)
+    arrays     = {field: np.zeros((len(schedules), n_segments)) for field in SEGMENT_FIELDS}
+
+    for sched_id, schedule in enumerate(schedules):
+        for seg_id, segment in enumerate(schedule):
+            unknown = set(segment) - set(SEGMENT_FIELDS)
+            if unknown:
+                raise ValueError(f"Unknown run-schedule fields: {sorted(unknown)}")
+            for field, default in SEGMENT_FIELDS.items():
+                value = segment.get(field, default)
+                if value is None:
+                    raise ValueError(f"Run-schedule segments need a '{field}'")
+                arrays[field][sched_id, seg_id] = value
+
+    return arrays
+
+
+
+#####################################################################
+@instrument()
+def integrate_decays(schedule_arrays : Dict[str, np.ndarray],
+                     radon_rate      : float,
+                     muon_rate       : float
+                    )               -> Dict[str, np.ndarray]:
+    '''
+    It integrates the isotope populations along every run schedule (arrays of shape
+    (n_schedules, n_segments), see get_schedule_arrays) and returns the number of
+    Bi214 and Xe137 decays during the live segments, and the live time (s),
+    as arrays of shape (n_schedules,).
+    radon_rate is the steady-state radon (Bi214) activity, and muon_rate the steady-state
+    Xe137 production, both in Bq, scaled by the radon & muons fields of every segment.
+    Sources are constant within a segment, so every segment is solved exactly:
+    the decay matrix is diagonalized once and the matrix exponentials of all the
+    schedules are evaluated together, segment after segment (only once per segment
+    if all the schedules share its duration, as on a fine time grid).
+    '''
+    decay_matrix       = get_decay_matrix()
+    eigenvalues, eigvs = np.linalg.eig(decay_matrix)
+    rates, eigvs       = -eigenvalues.real, eigvs.real
+    inv_eigvs          = np.linalg.inv(eigvs)
+
+    ### Sources (atoms / s) in the eigenbasis
+    radon_source = np.zeros(len(EVOLUTION_ISOTOPES))
+    muon_source  = np.zeros(len(EVOLUTION_ISOTOPES))
+    radon_source[EVOLUTION_ISOTOPES.index('Rn222')] = radon_rate
+    muon_source [EVOLUTION_ISOTOPES.index('Xe137')] = muon_rate
+    radon_source, muon_source = inv_eigvs @ radon_source, inv_eigvs @ muon_source
+
+    ### Segment-major copies, so every step reads contiguous rows
+    durations = schedule_arrays['duration'] / units.second
+    seg_durs, live, radon, muons, keep = (np.ascontiguousarray(field.T) for field in
+                                          (durations, schedule_arrays['live'],
+                                           schedule_arrays['radon'], schedule_arrays['muons'],
+                                           1 - schedule_arrays['reset']))
+
+    n_sched    = durations.shape[0]
+    population = np.zeros((n_sched, len(EVOLUTION_ISOTOPES)))    # eigenbasis
+    live_integ = np.zeros((n_sched, len(EVOLUTION_ISOTOPES)))    # eigenbasis
+
+    for seg_id in range(durations.shape[1]):
+        # A single propagator when every schedule shares the duration (fine time grid)
+        seg_dur = seg_durs[seg_id]
+        if (seg_dur == seg_dur[0]).all():
+            seg_dur = seg_dur[:1]
+        decay, phi1, phi2 = get_step_propagators(rates, seg_dur)
+
+        source      = radon[seg_id, :, None] * radon_source + muons[seg_id, :, None] * muon_source
+        population *= keep[seg_id, :, None]
+        live_integ += live[seg_id, :, None] * (phi1 * population + phi2 * source)
+        population  = decay * population + phi1 * source
+
+    ### Integrated populations (atoms * s) -> decays
+    integ_populations = live_integ @ eigvs.T
+    decay_constants   = -np.diag(decay_matrix)
+    decays            = integ_populations * decay_constants
+
+    return {'live_time'    : (schedule_arrays['live'] * durations).sum(axis=1),
+            'Bi214_decays' : decays[:, EVOLUTION_ISOTOPES.index('Bi214')],
+            'Xe137_decays' : decays[:, EVOLUTION_ISOTOPES.index('Xe137')]}
+
+
+
+#####################################################################
+@instrument()
+def get_background_evolution(det_name          : str,
+                             radon_bkgnd_level : str,
+                             hosting_lab       : str,
+                             energyRes         : float,
+                             spatialDef        : str,
+                             schedules         : Any
+                            )                 -> pd.DataFrame:
+    '''
+    It returns the radon and muon (Xe137) background counts in the ROI integrated
+    over the live time of every run schedule passed (a list of schedules, see
+    get_schedule_arrays, or their arrays), together with the counts expected
+    from the steady-state rates during the same live time.
+    '''
+    schedule_arrays = schedules if isinstance(schedules, dict) else get_schedule_arrays(schedules)
+
+    radon_bq         = get_radon_background_level(det_name, radon_bkgnd_level) / units.Bq
+    muon_bq, _       = get_muon_background_level (det_name, hosting_lab)
+
+    store            = get_rejection_store(det_name)
+    radon_rejection  = store.get('CATHODE', energyRes, spatialDef, 'Bi214')
+    Xe137_rejection  = store.get('ACTIVE',  energyRes, spatialDef, 'Xe137')
+
+    decays           = integrate_decays(schedule_arrays, radon_bq, muon_bq)
+    live_years       = decays['live_time'] * units.second / units.year
+
+    radon_counts     = decays['Bi214_decays'] * radon_rejection
+    muon_counts      = decays['Xe137_decays'] * Xe137_rejection
+    steady_counts    = (radon_bq * radon_rejection + muon_bq * Xe137_rejection) * decays['live_time']
+
+    return pd.DataFrame({'live_years'    : live_years,
+                         'exposure'      : get_Xe136_mass(det_name) * live_years,
+                         'radon_counts'  : radon_counts,
+                         'muon_counts'   : muon_counts,
+                         'total_counts'  : radon_counts + muon_counts,
+                         'steady_counts' : steady_counts})
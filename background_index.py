@@ -0,0 +1,265 @@
+# General importings
+import math
+import numpy  as np
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any, Sequence, Optional
+
+# Specific TONNE stuff
+import system_of_units as units
+
+from detector_dimensions  import get_dimensions
+
+from detector_backgrounds import get_radiogenic_background_level
+from detector_backgrounds import get_radon_background_level
+from detector_backgrounds import get_muon_background_level
+from detector_backgrounds import get_muon_background_levels
+
+from rejection_factors    import get_rejection_store
+from roi_settings         import get_roi_settings
+from roi_settings         import roi_settings
+
+
+#####################################################################
+### Constants used to translate Bq into background index (ckky)
+SECS_IN_YEAR    = 60 * 60 * 24 * 365
+XE136_ABUNDANCE = 0.902616
+
+RADIOGENIC_ISOTOPES = ['Bi214', 'Tl208']
+
+GRID_AXES = ['detector', 'radiogenic_bkgnd_level', 'radon_bkgnd_level',
+             'hosting_lab', 'energyRes', 'spatialDef']
+
+
+
+#####################################################################
+def get_Xe136_mass(det_name: str) -> float:
+    '''
+    It returns the Xe136 mass (in kg) of the ACTIVE volume of the detector passed.
+    '''
+    det_dim = get_dimensions(det_name)
+    return det_dim['ACTIVE_mass'] * XE136_ABUNDANCE / units.kg
+
+
+
+#####################################################################
+def get_toCKKY(Xe136_mass_kg : float,
+               energyRes     : float
+              )             -> float:
+    '''
+    It returns the Bq -> ckky conversion factor for the Xe136 mass (kg)
+    and the ROI corresponding to the energy resolution passed.
+    '''
+    ROI_settings = get_roi_settings(energyRes)
+    return SECS_IN_YEAR / Xe136_mass_kg / \
+           ((ROI_settings['Emax'] - ROI_settings['Emin']) / units.keV)
+
+
+
+#####################################################################
+def get_rejection_arrays(det_name    : str,
+                         sources     : Sequence[str],
+                         energyRes   : Sequence[float],
+                         spatialDef  : Sequence[str],
+                         isotopes    : Sequence[str]
+                        )           -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    It returns the rejection factors and their errors as dense arrays of shape
+    (len(energyRes), len(spatialDef), len(sources), len(isotopes)).
+    Missing rejection factors are returned as NaN.
+    '''
+    values, errors = get_rejection_store(det_name).take(sources, energyRes, spatialDef, isotopes)
+
+    return np.moveaxis(values, 0, 2), np.moveaxis(errors, 0, 2)
+
+
+
+#####################################################################
+def check_rejection_settings(det_name           : str,
+                             energy_resolutions : Sequence[float],
+                             spatial_defs       : Sequence[str]
+                            )                  -> None:
+    '''
+    It raises a ValueError if any energy resolution or spatial definition passed
+    has no ROI settings or no rejection factors for the detector (instead of
+    summing them as missing rejection factors).
+    '''
+    store = get_rejection_store(det_name)
+    _, known_resolutions, known_defs, _ = store.axes
+
+    unknown = [energyRes for energyRes in energy_resolutions
+               if (float(energyRes) not in known_resolutions) or (energyRes not in roi_settings)]
+    if unknown:
+        raise ValueError(f"No ROI settings or '{det_name}' rejection factors for energyRes {unknown} "
+                         f"(known: {[res for res in known_resolutions if res in roi_settings]})")
+
+    unknown = [spatialDef for spatialDef in spatial_defs if spatialDef not in known_defs]
+    if unknown:
+        raise ValueError(f"No '{det_name}' rejection factors for spatialDef {unknown} "
+                         f"(known: {known_defs})")
+
+    for energyRes in energy_resolutions:
+        for spatialDef in spatial_defs:
+            values, _ = store.view(energyRes=energyRes, spatialDef=spatialDef)
+            if np.isnan(values).all():
+                raise ValueError(f"No '{det_name}' rejection factors for "
+                                 f"energyRes {energyRes} and spatialDef '{spatialDef}'")
+
+
+
+#####################################################################
+def get_detector_index_grid(det_name                : str,
+                            radiogenic_bkgnd_levels : Sequence[str],
+                            radon_bkgnd_levels      : Sequence[str],
+                            hosting_labs            : Sequence[str],
+                            energy_resolutions      : Sequence[float],
+                            spatial_defs            : Sequence[str],
+                            muon_levels             : Optional[Dict[Tuple[str, str],
+                                                                    Tuple[float, float]]] = None
+                           )                       -> Dict[str, np.ndarray]:
+    '''
+    It computes the background indices (ckky) of a single detector for every
+    (radiogenic_level, radon_level, hosting_lab, energyRes, spatialDef) combination.
+    It returns a dictionary of arrays, all of them with that 5-dim shape.
+    If passed, muon_levels[(det_name, hosting_lab)] = (Xe137 Bq, error) avoids
+    the muon normalization.
+    '''
+    check_rejection_settings(det_name, energy_resolutions, spatial_defs)
+    nE, nS = len(energy_resolutions), len(spatial_defs)
+
+    ### Radiogenic levels (Bq) -> (nRad, nSrc, nIso)
+    radiogenic_dfs = [get_radiogenic_background_level(det_name, level)
+                      for level in radiogenic_bkgnd_levels]
+    sources        = list(radiogenic_dfs[0].index)
+    radiogenic_bq  = np.stack([df.loc[sources, RADIOGENIC_ISOTOPES].to_numpy(dtype=float)
+                               for df in radiogenic_dfs])
+
+    ### Radon levels (Bq) -> (nRn,)
+    radon_bq = np.array([get_radon_background_level(det_name, level) / units.Bq
+                         for level in radon_bkgnd_levels])
+
+    ### Muon levels (Bq) -> (nLab,)
+    muon_bq, muon_bq_err = [], []
+    for lab in hosting_labs:
+        if (muon_levels is not None) and ((det_name, lab) in muon_levels):
+            level, error = muon_levels[(det_name, lab)]
+        else:
+            level, error = get_muon_background_level(det_name, lab)
+        muon_bq    .append(level)
+        muon_bq_err.append(error)
+    muon_bq, muon_bq_err = np.array(muon_bq), np.array(muon_bq_err)
+
+    ### Rejection factors -> (nE, nS, nSrc, nIso)
+    radiogenic_rej, radiogenic_rej_err = get_rejection_arrays(det_name, sources,
+                                                              energy_resolutions, spatial_defs,
+                                                              RADIOGENIC_ISOTOPES)
+    radon_rej, radon_rej_err = get_rejection_arrays(det_name, ['CATHODE'],
+                                                    energy_resolutions, spatial_defs,
+                                                    ['Bi214'])
+    active_rej, active_rej_err = get_rejection_arrays(det_name, ['ACTIVE'],
+                                                      energy_resolutions, spatial_defs,
+                                                      ['bb0nu', 'Xe137'])
+    radon_rej,  radon_rej_err  = radon_rej [..., 0, 0], radon_rej_err [..., 0, 0]
+    sig_eff,    Xe137_rej      = active_rej[..., 0, 0], active_rej    [..., 0, 1]
+    Xe137_rej_err              = active_rej_err[..., 0, 1]
+
+    ### Bq -> ckky conversion -> (nE,)
+    Xe136_mass_kg = get_Xe136_mass(det_name)
+    toCKKY = np.array([get_toCKKY(Xe136_mass_kg, energyRes) for energyRes in energy_resolutions])
+
+    ### Radiogenic index: sum over sources & isotopes
+    ### (isotopes without rejection factors in the table do not contribute)
+    # (nRad, 1, 1, nSrc, nIso) * (nE, nS, nSrc, nIso) -> (nRad, nE, nS)
+    radiogenic_index_bq  = np.nansum(radiogenic_bq[:, None, None] * radiogenic_rej,
+                                     axis=(-2, -1))
+    radiogenic_error_bq  = np.sqrt(np.nansum((radiogenic_bq[:, None, None] * radiogenic_rej_err)**2,
+                                             axis=(-2, -1)))
+
+    ### Radon index -> (nRn, nE, nS)
+    radon_index_bq = radon_bq[:, None, None] * radon_rej
+    radon_error_bq = radon_bq[:, None, None] * radon_rej_err
+
+    ### Muon index -> (nLab, nE, nS)
+    muon_index_bq = muon_bq[:, None, None] * Xe137_rej
+    muon_error_bq = np.sqrt((muon_bq    [:, None, None] * Xe137_rej_err)**2 +
+                            (muon_bq_err[:, None, None] * Xe137_rej    )**2)
+
+    ### Broadcasting everything to (nRad, nRn, nLab, nE, nS)
+    radiogenic_index_bq = radiogenic_index_bq[:, None, None]
+    radiogenic_error_bq = radiogenic_error_bq[:, None, None]
+    radon_index_bq      = radon_index_bq     [None, :, None]
+    radon_error_bq      = radon_error_bq     [None, :, None]
+    muon_index_bq       = muon_index_bq      [None, None, :]
+    muon_error_bq       = muon_error_bq      [None, None, :]
+    toCKKY              = toCKKY[:, None]
+
+    total_index_bq = radiogenic_index_bq + radon_index_bq + muon_index_bq
+    total_error_bq = np.sqrt(radiogenic_error_bq**2 + radon_error_bq**2 + muon_error_bq**2)
+
+    shape = (len(radiogenic_bkgnd_levels), len(radon_bkgnd_levels), len(hosting_labs), nE, nS)
+
+    grid = {
+        'Xe136_mass'          : np.full(shape, Xe136_mass_kg),
+        'sig_eff'             : sig_eff,
+        'radiogenic_index'    : radiogenic_index_bq * toCKKY,
+        'radiogenic_index_err': radiogenic_error_bq * toCKKY,
+        'radon_index'         : radon_index_bq      * toCKKY,
+        'radon_index_err'     : radon_error_bq      * toCKKY,
+        'muon_index'          : muon_index_bq       * toCKKY,
+        'muon_index_err'      : muon_error_bq       * toCKKY,
+        'total_index'         : total_index_bq      * toCKKY,
+        'total_index_err'     : total_error_bq      * toCKKY,
+        'total_level_Bq'      : total_index_bq,
+        'fom'                 : sig_eff / np.sqrt(total_index_bq)
+    }
+
+    return {key: np.broadcast_to(value, shape) for key, value in grid.items()}
+
+
+
+#####################################################################
+def get_background_index_grid(detectors               : Sequence[str],
+                              radiogenic_bkgnd_levels : Sequence[str],
+                              radon_bkgnd_levels      : Sequence[str],
+                              hosting_labs            : Sequence[str],
+                              energy_resolutions      : Sequence[float],
+                              spatial_defs            : Sequence[str],
+                              muon_levels             : Optional[Dict[Tuple[str, str],
+                                                                      Tuple[float, float]]] = None
+                             )                       -> pd.DataFrame:
+    '''
+    It computes the radiogenic, radon, muon and total background indices (ckky),
+    their errors and the s/sqrt(b) figure of merit for the whole cartesian product
+    of the axes passed. It returns a DataFrame indexed by GRID_AXES.
+
+    The muon normalization is run once for all the (detector, hosting_lab) pairs
+    sharing muon files, and can be skipped passing
+    muon_levels[(detector, hosting_lab)] = (Bq, error).
+    '''
+    muon_levels = {} if muon_levels is None else muon_levels
+    missing     = [(det_name, lab) for det_name in detectors for lab in hosting_labs
+                   if (det_name, lab) not in muon_levels]
+    if missing:
+        muon_levels = {**get_muon_background_levels(sorted({det for det, _ in missing}),
+                                                    sorted({lab for _, lab in missing})),
+                       **muon_levels}
+
+    detector_grids = [get_detector_index_grid(det_name,
+                                              radiogenic_bkgnd_levels,
+                                              radon_bkgnd_levels,
+                                              hosting_labs,
+                                              energy_resolutions,
+                                              spatial_defs,
+                                              muon_levels)
+                      for det_name in detectors]
+
+    grid_index = pd.MultiIndex.from_product([detectors, radiogenic_bkgnd_levels,
+                                             radon_bkgnd_levels, hosting_labs,
+                                             energy_resolutions, spatial_defs],
+                                            names = GRID_AXES)
+
+    columns = detector_grids[0].keys()
+    grid_df = pd.DataFrame({col: np.stack([grid[col] for grid in detector_grids]).ravel()
+                            for col in columns},
+                           index = grid_index)
+    return grid_df
@@ -0,0 +1,93 @@
+# General importings
+import os
+import numpy  as np
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any
+
+
+#####################################################################
+### Synthetic muon samples: energies (GeV) drawn from a falling spectrum
+### within the muon binning range, so no real flux file is needed
+FIXTURE_SEED  = 1234
+FLUX_E_RANGE  = (1., 3000.)
+FLUX_E_SCALE  = 250.   # GeV, exponential slope of the synthetic flux
+N_FLUX_TABLES = 10
+WRITE_CHUNK   = 5000000
+
+
+
+#####################################################################
+def draw_muon_energies(rng    : np.random.Generator,
+                       n_muons: int
+                      )       -> np.ndarray:
+    '''
+    It returns n_muons energies (GeV) of the synthetic flux.
+    '''
+    e_min, e_max = FLUX_E_RANGE
+    max_prob     = 1. - np.exp(-(e_max - e_min) / FLUX_E_SCALE)
+    return e_min - FLUX_E_SCALE * np.log1p(-max_prob * rng.random(n_muons))
+
+
+
+#####################################################################
+def write_flux_file(file_name : str,
+                    n_muons   : int,
+                    seed      : int = FIXTURE_SEED
+                   )         -> None:
+    '''
+    It writes a synthetic flux file with the layout of the real ones:
+    N_FLUX_TABLES table-format tables muon_flux_i with the muon energies (E).
+    '''
+    rng           = np.random.default_rng(seed)
+    tmp_file_name = f'{file_name}.{os.getpid()}.tmp'
+    with pd.HDFStore(tmp_file_name, mode='w') as store:
+        for i, table_size in enumerate(np.diff(np.linspace(0, n_muons, N_FLUX_TABLES + 1).astype(int))):
+            for first in range(0, table_size, WRITE_CHUNK):
+                size = min(WRITE_CHUNK, table_size - first)
+                store.append(f'muon_flux_{i}',
+                             pd.DataFrame({'E'    : draw_muon_energies(rng, size),
+                                           'theta': rng.random(size) * np.pi / 2}))
+    os.replace(tmp_file_name, file_name)
+
+
+
+#####################################################################
+def write_activation_file(file_name       : str,
+                          n_simulated     : int,
+                          activation_prob : float = 4.e-4,
+                          seed            : int = FIXTURE_SEED + 1
+                         )               -> None:
+    '''
+    It writes a synthetic Xe137 activation file with the layout of the real one:
+    a fixed-format 'munnuenergy' table with the energy (MeV) of the activating muons,
+    simulated uniformly in the muon binning range.
+    '''
+    rng           = np.random.default_rng(seed)
+    n_activations = rng.binomial(n_simulated, activation_prob)
+    energies      = rng.uniform(*FLUX_E_RANGE, n_activations) * 1e3
+    tmp_file_name = f'{file_name}.{os.getpid()}.tmp'
+    pd.DataFrame({'Xemunrg': energies}).to_hdf(tmp_file_name, key='munnuenergy', mode='w')
+    os.replace(tmp_file_name, file_name)
+
+
+
+#####################################################################
+def get_fixtures(fixture_dir : str,
+                 n_muons     : int,
+                 n_simulated : int
+                )           -> Dict[str, Any]:
+    '''
+    It returns the synthetic flux & activation files (and number of simulated muons),
+    creating them in fixture_dir only if they do not exist yet.
+    '''
+    os.makedirs(fixture_dir, exist_ok=True)
+    flux_file = os.path.join(fixture_dir, f'flux_{n_muons}muons.h5')
+    acti_file = os.path.join(fixture_dir, f'Xe137Count_sim{n_simulated}muons.h5')
+
+    if not os.path.isfile(flux_file):
+        write_flux_file(flux_file, n_muons)
+    if not os.path.isfile(acti_file):
+        write_activation_file(acti_file, n_simulated)
+
+    return {'flux_file': flux_file, 'acti_file': acti_file, 'num_muons': n_simulated}
@@ -0,0 +1,221 @@
+# General importings
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import http.client
+import numpy as np
+
+from urllib.parse import urlencode, urlsplit
+
+from typing import Tuple, List, Dict, Any, Optional
+
+### Load tests run from any directory, against the modules of this repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+#####################################################################
+### Query mix: background indices over the scenario grid, muon rates and sensitivities
+LOAD_DETECTOR   = 'next_hd'
+LOAD_LABS       = ['LSC', 'LNGS', 'SNOLAB']
+LOAD_RADIOGENIC = ['reference', 'probable', 'optimistic']
+LOAD_RADON      = ['optimistic', 'pessimistic']
+LOAD_ENERGY_RES = ['0.5', '0.7']
+LOAD_SPATIAL    = ['3x3x3', '10x10x10']
+
+
+
+#####################################################################
+def get_queries(n_queries : int,
+                seed      : int = 1
+               )         -> List[str]:
+    '''
+    It returns n_queries random query URLs (path & parameters) of the query mix.
+    '''
+    rng     = random.Random(seed)
+    queries = []
+    for _ in range(n_queries):
+        kind     = rng.random()
+        scenario = {'detector'  : LOAD_DETECTOR,
+                    'energyRes' : rng.choice(LOAD_ENERGY_RES),
+                    'spatialDef': rng.choice(LOAD_SPATIAL)}
+        if kind < 0.6:
+            path   = '/background_index'
+            params = {**scenario, 'radiogenic_bkgnd_level': rng.choice(LOAD_RADIOGENIC),
+                      'radon_bkgnd_level': rng.choice(LOAD_RADON),
+                      'hosting_lab': rng.choice(LOAD_LABS)}
+        elif kind < 0.8:
+            path   = '/muon_rate'
+            params = {'detector': LOAD_DETECTOR, 'hosting_lab': rng.choice(LOAD_LABS),
+                      'bins': rng.choice(['0', '1'])}
+        else:
+            path   = '/sensitivity'
+            params = {**scenario, 'radiogenic_bkgnd_level': rng.choice(LOAD_RADIOGENIC),
+                      'radon_bkgnd_level': rng.choice(LOAD_RADON),
+                      'hosting_lab': rng.choice(LOAD_LABS), 'live_years': '1,2,5,10'}
+        queries.append(f'{path}?{urlencode(params)}')
+    return queries
+
+
+
+#####################################################################
+def run_client(host      : str,
+               port      : int,
+               queries   : List[str],
+               latencies : List[float],
+               errors    : List[str]
+              )         -> None:
+    '''
+    It sends the queries passed one after the other over a keep-alive connection,
+    appending the latency (s) of every query and the failed ones.
+    '''
+    connection = http.client.HTTPConnection(host, port, timeout=60)
+    for query in queries:
+        start = time.perf_counter()
+        try:
+            connection.request('GET', query)
+            response = connection.getresponse()
+            body     = response.read()
+            if response.status != 200:
+                errors.append(f'{query}: {response.status} {body[:200]!r}')
+        except (OSError, http.client.HTTPException) as error:
+            errors.append(f'{query}: {error}')
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=60)
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+
+#####################################################################
+def get_query_counts(host : str,
+                     port : int
+                    )    -> Dict[str, int]:
+    '''
+    It returns the computed, coalesced & cached query counters of the server.
+    '''
+    connection = http.client.HTTPConnection(host, port, timeout=60)
+    connection.request('GET', '/stats')
+    stats = json.loads(connection.getresponse().read())
+    connection.close()
+    return stats['queries']
+
+
+
+#####################################################################
+def run_load_test(host      : str,
+                  port      : int,
+                  n_queries : int,
+                  n_clients : int,
+                  seed      : int = 1
+                 )         -> Dict[str, Any]:
+    '''
+    It sends n_queries queries of the query mix from n_clients concurrent clients.
+    It returns the latency percentiles (ms), throughput (requests/s), errors,
+    and how many queries the server computed, coalesced or took from its results
+    (sensitivity queries without bkgnd_index also run a background_index query).
+    '''
+    counts    = get_query_counts(host, port)
+    queries   = get_queries(n_queries, seed)
+    latencies = [[] for _ in range(n_clients)]
+    errors    = []
+    clients   = [threading.Thread(target=run_client,
+                                  args=(host, port, queries[i::n_clients], latencies[i], errors))
+                 for i in range(n_clients)]
+
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    wall_time = time.perf_counter() - start
+
+    counts    = {key: value - counts.get(key, 0)
+                 for key, value in get_query_counts(host, port).items()}
+    latencies = np.concatenate([np.array(client_latencies) for client_latencies in latencies]) * 1e3
+    return {'n_queries'  : n_queries,
+            'n_clients'  : n_clients,
+            'wall_time'  : wall_time,
+            'throughput' : n_queries / wall_time,
+            'p50_ms'     : float(np.percentile(latencies, 50)),
+            'p99_ms'     : float(np.percentile(latencies, 99)),
+            'max_ms'     : float(latencies.max()),
+            'n_errors'   : len(errors),
+            'errors'     : errors[:10],
+            'computed'   : counts.get('computed' , 0),
+            'coalesced'  : counts.get('coalesced', 0),
+            'cached'     : counts.get('cached'   , 0)}
+
+
+
+#####################################################################
+def print_results(label   : str,
+                  results : Dict[str, Any]
+                 )       -> None:
+    print(f"[{label}] {results['n_queries']} queries from {results['n_clients']} clients "
+          f"in {results['wall_time']:.2f} s: {results['throughput']:.0f} requests/s")
+    print(f"[{label}] latency p50 = {results['p50_ms']:.2f} ms, p99 = {results['p99_ms']:.2f} ms, "
+          f"max = {results['max_ms']:.2f} ms")
+    print(f"[{label}] {results['computed']} computed, {results['coalesced']} coalesced, "
+          f"{results['cached']} from the result cache")
+    for error in results['errors']:
+        print(f"ERROR {error}", file=sys.stderr)
+
+
+
+#####################################################################
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description = 'Load test of the query server: p50/p99 latency and requests/s. '
+                      'Without --url, servers are started in this process: "cold" without '
+                      'result cache (every query computed, except concurrent identical ones), '
+                      'and "cached" with it.')
+    parser.add_argument('--url', default = None,
+                        help = 'running server, e.g. http://127.0.0.1:8765')
+    parser.add_argument('--mode', choices = ['cold', 'cached', 'both'], default = 'both',
+                        help = 'servers started without --url (default: both)')
+    parser.add_argument('-n', '--n-queries', type = int, default = 20000)
+    parser.add_argument('-c', '--clients', type = int, default = 16)
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--save', metavar = 'JSON',
+                        help = 'write the results to a json file')
+    args = parser.parse_args(argv)
+
+    results = {}
+    if args.url is not None:
+        url = urlsplit(args.url)
+        results['server'] = run_load_test(url.hostname, url.port, args.n_queries,
+                                          args.clients, args.seed)
+    else:
+        from query_server import QueryService, make_server, RESULTS_CACHE_SIZE
+
+        modes = ['cold', 'cached'] if args.mode == 'both' else [args.mode]
+        for mode in modes:
+            service = QueryService([LOAD_DETECTOR], LOAD_LABS,
+                                   0 if mode == 'cold' else RESULTS_CACHE_SIZE)
+            server  = make_server(service, port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                results[mode] = run_load_test(*server.server_address[:2], args.n_queries,
+                                              args.clients, args.seed)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    for label, mode_results in results.items():
+        print_results(label, mode_results)
+
+    if args.save:
+        with open(args.save, 'w') as ofile:
+            json.dump(results, ofile, indent=1)
+
+    return 1 if any(mode_results['n_errors'] for mode_results in results.values()) else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
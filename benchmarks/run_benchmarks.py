@@ -0,0 +1,312 @@
+# General importings
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import contextlib
+import statistics
+import tracemalloc
+import dataclasses
+import multiprocessing
+import numpy  as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from typing import Tuple, List, Dict, Any, Optional, Callable
+
+### Benchmarks run from any directory, against the modules of this repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# Specific TONNE stuff
+from fixtures import get_fixtures
+
+
+#####################################################################
+BENCH_LAB      = 'BENCH'
+BENCH_DETECTOR = 'next_hd'
+
+METRICS = ['wall_time', 'peak_rss', 'alloc_peak']
+
+DEFAULT_FIXTURE_DIR = os.path.join(tempfile.gettempdir(), 'tonne_benchmarks')
+
+
+
+#####################################################################
+def register_bench_lab(context: Dict[str, Any]) -> None:
+    '''
+    It registers the synthetic lab (synthetic flux & activation files,
+    LSC muon flux) used by the muon benchmarks.
+    '''
+    import initial_activities
+    import detector_backgrounds
+
+    detector_backgrounds.muon_files[BENCH_LAB] = {'flux_file': context['flux_file'],
+                                                  'acti_file': context['acti_file'],
+                                                  'file_out' : os.devnull,
+                                                  'num_muons': context['num_muons']}
+    initial_activities.muon_flux      [BENCH_LAB] = initial_activities.muon_flux      ['LSC']
+    initial_activities.muon_flux_error[BENCH_LAB] = initial_activities.muon_flux_error['LSC']
+
+
+
+#####################################################################
+def clear_caches(context: Dict[str, Any]) -> None:
+    '''
+    It clears every in-memory and on-disk cache, so benchmarks measure cold runs.
+    '''
+    from detector_dimensions import get_dimensions
+    from rejection_factors   import read_rejection_factors, get_rejection_store
+
+    shutil.rmtree(context['cache_dir'], ignore_errors=True)
+    get_dimensions        .cache_clear()
+    read_rejection_factors.cache_clear()
+    get_rejection_store   .cache_clear()
+
+
+
+#####################################################################
+### Benchmarks: each one returns (prepare, run, number of runs per timing)
+def bench_xe137_normalization(context: Dict[str, Any]) -> Tuple[Callable, Callable, int]:
+    from detector_backgrounds      import get_muon_config
+    from muons.xe137_normalization import xe137_normalization
+
+    config = dataclasses.replace(get_muon_config(BENCH_DETECTOR, BENCH_LAB), flux_cache_dir=None)
+    return (lambda: clear_caches(context),
+            lambda: xe137_normalization(config, suppress_df=True), 1)
+
+
+def bench_xe137_activation_prob(context: Dict[str, Any]) -> Tuple[Callable, Callable, int]:
+    from detector_backgrounds      import get_muon_config
+    from muons.xe137_normalization import xe137_activation_prob
+
+    config = dataclasses.replace(get_muon_config(BENCH_DETECTOR, BENCH_LAB), flux_cache_dir=None)
+    return (lambda: clear_caches(context),
+            lambda: xe137_activation_prob(config), 1)
+
+
+def bench_get_dimensions(context: Dict[str, Any]) -> Tuple[Callable, Callable, int]:
+    from detector_dimensions import get_dimensions, detector_dimensions
+
+    def run():
+        for det_name in detector_dimensions:
+            get_dimensions.cache_clear()
+            get_dimensions(det_name)
+    return (lambda: clear_caches(context), run, 100)
+
+
+def bench_get_rejection_factors(context: Dict[str, Any]) -> Tuple[Callable, Callable, int]:
+    from rejection_factors import get_rejection_factors, read_rejection_factors
+
+    def run():
+        read_rejection_factors.cache_clear()
+        get_rejection_factors(BENCH_DETECTOR)
+    return (lambda: clear_caches(context), run, 20)
+
+
+def bench_background_chain(context: Dict[str, Any]) -> Tuple[Callable, Callable, int]:
+    from initial_activities   import radiogenic_activity, radon_activity
+    from detector_backgrounds import get_radiogenic_background_level
+    from detector_backgrounds import get_radon_background_level
+    from detector_backgrounds import get_muon_background_level
+
+    def run():
+        for level in radiogenic_activity:
+            get_radiogenic_background_level(BENCH_DETECTOR, level)
+        for level in radon_activity:
+            get_radon_background_level(BENCH_DETECTOR, level)
+        get_muon_background_level(BENCH_DETECTOR, BENCH_LAB)
+    return (lambda: clear_caches(context), run, 1)
+
+
+def bench_background_index(context: Dict[str, Any]) -> Tuple[Callable, Callable, int]:
+    from initial_activities import radiogenic_activity, radon_activity
+    from background_index   import get_background_index_grid
+
+    def run():
+        get_background_index_grid([BENCH_DETECTOR], list(radiogenic_activity), list(radon_activity),
+                                  [BENCH_LAB], [0.5, 0.7], ['3x3x3', '10x10x10'])
+    return (lambda: clear_caches(context), run, 1)
+
+
+BENCHMARKS = {
+    'xe137_normalization'   : bench_xe137_normalization,
+    'xe137_activation_prob' : bench_xe137_activation_prob,
+    'get_dimensions'        : bench_get_dimensions,
+    'get_rejection_factors' : bench_get_rejection_factors,
+    'background_chain'      : bench_background_chain,
+    'background_index'      : bench_background_index
+}
+
+
+
+#####################################################################
+def get_peak_rss() -> int:
+    '''
+    It returns the peak resident set size (bytes) of this process and its children.
+    VmHWM is preferred to ru_maxrss, which on linux is inherited across exec.
+    '''
+    scale    = 1 if sys.platform == 'darwin' else 1024
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    if os.path.isfile('/proc/self/status'):
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    self_rss = int(line.split()[1]) * 1024
+    return max(self_rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+
+#####################################################################
+def run_benchmark(name    : str,
+                  context : Dict[str, Any],
+                  repeat  : int
+                 )       -> Dict[str, float]:
+    '''
+    It runs a benchmark (in a fresh process) and returns its best & median
+    wall time per run (s), the peak RSS (bytes) and the peak of the memory
+    allocated by python (bytes, tracemalloc, measured on an extra run
+    with the flux tables read in this process).
+    '''
+    os.chdir(REPO_DIR)
+    with contextlib.redirect_stdout(io.StringIO()):
+        register_bench_lab(context)
+        prepare, run, number = BENCHMARKS[name](context)
+
+        wall_times = []
+        for _ in range(repeat):
+            prepare()
+            start = time.perf_counter()
+            for _ in range(number):
+                run()
+            wall_times.append((time.perf_counter() - start) / number)
+        peak_rss = get_peak_rss()
+
+        # tracemalloc only sees this process: flux tables are read in it for this run
+        import muons.xe137_normalization
+        muons.xe137_normalization.FLUX_READ_WORKERS = 1
+        prepare()
+        tracemalloc.start()
+        run()
+        alloc_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {'wall_time'       : min(wall_times),
+            'wall_time_median': statistics.median(wall_times),
+            'peak_rss'        : peak_rss,
+            'alloc_peak'      : alloc_peak}
+
+
+
+#####################################################################
+def compare_results(results   : Dict[str, Dict[str, float]],
+                    baseline  : Dict[str, Dict[str, float]],
+                    threshold : float
+                   )         -> pd.DataFrame:
+    '''
+    It returns the ratio new / baseline of every metric, flagging as regressions
+    the ratios above 1 + threshold.
+    '''
+    rows = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for metric in METRICS:
+            ratio = metrics[metric] / baseline[name][metric] if baseline[name][metric] else np.nan
+            rows.append({'benchmark' : name,
+                         'metric'    : metric,
+                         'baseline'  : baseline[name][metric],
+                         'new'       : metrics[metric],
+                         'ratio'     : ratio,
+                         'regression': bool(ratio > 1 + threshold)})
+    return pd.DataFrame(rows, columns=['benchmark', 'metric', 'baseline', 'new', 'ratio', 'regression'])
+
+
+
+#####################################################################
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description = 'Runs the benchmarks on synthetic fixtures, recording wall time, '
+                      'peak RSS and python allocations, and compares them with a baseline.')
+    parser.add_argument('benchmarks', nargs = '*',
+                        help = f"benchmarks to run (default: all): {', '.join(BENCHMARKS)}")
+    parser.add_argument('--repeat', type = int, default = 5,
+                        help = 'timings per benchmark (the best one is kept)')
+    parser.add_argument('--n-muons', type = int, default = 5000000,
+                        help = 'muons in the synthetic flux file')
+    parser.add_argument('--n-simulated', type = int, default = 87799000,
+                        help = 'simulated muons of the synthetic activation file')
+    parser.add_argument('--fixture-dir', default = DEFAULT_FIXTURE_DIR,
+                        help = f'where synthetic fixtures are kept (default: {DEFAULT_FIXTURE_DIR})')
+    parser.add_argument('--save', metavar = 'JSON',
+                        help = 'save the results as a baseline')
+    parser.add_argument('--compare', metavar = 'JSON',
+                        help = 'compare the results with a baseline')
+    parser.add_argument('--threshold', type = float, default = 0.25,
+                        help = 'relative increase flagged as regression (default: 0.25)')
+    args  = parser.parse_args(argv)
+    names = args.benchmarks or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark '{name}'")
+
+    print(f"Preparing fixtures in '{args.fixture_dir}' ...", file=sys.stderr)
+    context = get_fixtures(args.fixture_dir, args.n_muons, args.n_simulated)
+    context['cache_dir'] = tempfile.mkdtemp(prefix='tonne_bench_cache_')
+
+    # Cold caches for every benchmark (children read these at import)
+    os.environ['TONNE_FLUX_CACHE']      = os.path.join(context['cache_dir'], 'flux')
+    os.environ['TONNE_REJECTION_CACHE'] = os.path.join(context['cache_dir'], 'rejection')
+    os.environ['TONNE_PIPELINE_CACHE']  = os.path.join(context['cache_dir'], 'pipeline')
+
+    results = {}
+    try:
+        for name in names:
+            # A fresh process per benchmark, so peak RSS is not inherited
+            with ProcessPoolExecutor(max_workers = 1,
+                                     mp_context  = multiprocessing.get_context('spawn')) as executor:
+                results[name] = executor.submit(run_benchmark, name, context, args.repeat).result()
+            print(f"{name:24s} {results[name]['wall_time']:10.4f} s "
+                  f"{results[name]['peak_rss'] / 1024**2:10.1f} MB RSS "
+                  f"{results[name]['alloc_peak'] / 1024**2:10.1f} MB allocated")
+    finally:
+        shutil.rmtree(context['cache_dir'], ignore_errors=True)
+
+    meta = {'n_muons'    : args.n_muons,
+            'n_simulated': args.n_simulated,
+            'repeat'     : args.repeat,
+            'python'     : platform.python_version(),
+            'numpy'      : np.__version__,
+            'pandas'     : pd.__version__,
+            'machine'    : platform.machine(),
+            'date'       : time.strftime('%Y-%m-%d %H:%M:%S')}
+
+    if args.save:
+        with open(args.save, 'w') as ofile:
+            json.dump({'meta': meta, 'results': results}, ofile, indent=2)
+        print(f"Baseline saved to '{args.save}'", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as ifile:
+            baseline = json.load(ifile)
+        if (baseline['meta']['n_muons'], baseline['meta']['n_simulated']) != (args.n_muons, args.n_simulated):
+            print("WARNING: baseline obtained with different fixtures", file=sys.stderr)
+        comparison = compare_results(results, baseline['results'], args.threshold)
+        print(comparison.to_string(index=False))
+        if comparison.regression.any():
+            print(f"{comparison.regression.sum()} regressions beyond {args.threshold:.0%}", file=sys.stderr)
+            return 1
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+# General importings
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any, Optional
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+#####################################################################
+### Modules whose import time is measured
+STARTUP_MODULES = ['system_of_units', 'detector_dimensions', 'initial_activities',
+                   'rejection_factors', 'muons.xe137_normalization', 'detector_backgrounds',
+                   'background_index']
+
+### Heavy modules that must not be loaded by the imports above
+### (their own import time is what fast-import mode saves)
+HEAVY_MODULES = ['matplotlib.pyplot', 'invisible_cities.core.system_of_units',
+                 'invisible_cities.core.configure']
+
+IMPORT_SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'time': elapsed, 'loaded': [mod for mod in {heavy!r} if mod in sys.modules]}}))
+'''
+
+
+
+#####################################################################
+def time_import(module : str,
+                repeat : int
+               )      -> Dict[str, Any]:
+    '''
+    It returns the median import time (s) of the module passed, each import
+    in a fresh interpreter, and the heavy modules it loaded.
+    None if the module can not be imported.
+    '''
+    env    = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_DIR] + sys.path[1:]))
+    script = IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    times  = []
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-c', script], cwd=REPO_DIR, env=env,
+                                 capture_output=True, text=True)
+        if process.returncode:
+            return None
+        result = json.loads(process.stdout.splitlines()[-1])
+        times.append(result['time'])
+    return {'module': module, 'import_time': statistics.median(times),
+            'heavy_loaded': ', '.join(result['loaded'])}
+
+
+
+#####################################################################
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description = 'Measures the import time of the TONNE modules (fresh interpreter per import) '
+                      'and of the heavy modules they no longer load at import.')
+    parser.add_argument('--repeat', type = int, default = 7,
+                        help = 'imports per module (the median is kept)')
+    args = parser.parse_args(argv)
+
+    rows = []
+    for module in STARTUP_MODULES + HEAVY_MODULES:
+        row = time_import(module, args.repeat)
+        if row is None:
+            print(f"{module} can not be imported, skipped", file=sys.stderr)
+            continue
+        row['heavy'] = module in HEAVY_MODULES
+        rows.append(row)
+
+    startup_df = pd.DataFrame(rows).set_index('module')
+    print(startup_df.to_string(formatters={'import_time': '{:.3f} s'.format}))
+
+    # Only fail when a TONNE module pulls in a heavy module
+    loaded = startup_df.loc[~startup_df.heavy & (startup_df.heavy_loaded != '')]
+    if len(loaded):
+        print(f"Heavy modules loaded at import by: {', '.join(loaded.index)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
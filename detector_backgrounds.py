@@ -3,12 +3,11 @@ import math
 import numpy  as np
 import pandas as pd
 
-from typing import Tuple, List, Dict, Any
-
-# Specific IC stuff
-import invisible_cities.core.system_of_units as units
+from typing import Tuple, List, Dict, Any, Mapping, Sequence, Optional
 
 # Specific TONNE stuff
+import system_of_units as units
+
 from detector_dimensions import get_dimensions
 
 from initial_activities import get_radiogenic_activities
@@ -17,10 +16,47 @@ from initial_activities import get_muon_flux
 from initial_activities import get_muon_flux_error
 
 from muons.xe137_normalization import xe137_normalization
+from muons.xe137_normalization import xe137_normalization_kernel
+from muons.xe137_normalization import MuonConfig
+from muons.xe137_normalization import Xe137Rates
+
+from instrumentation import instrument
 #from muons.xe137_normalization import get_xe137_activation_prob
     
 
 #####################################################################
+### Material, dimension (surface or mass) and multiplicity of every radiogenic component
+radiogenic_components = {
+    'READOUT_PLANE'   : ('DiceBoard', 'READOUT_PLANE_surface', 2),
+#    'CATHODE'         : ('SSteel316Ti', 'CATHODE_mass', 1),
+    'FIELD_CAGE'      : ('Teflon',    'FIELD_CAGE_mass',       1),
+    'INNER_SHIELDING' : ('Copper',    'ICS_mass',              1)
+}
+
+
+
+#####################################################################
+def compute_radiogenic_background(det_dim        : Mapping[str, Any],
+                                  radiogenic_act : Dict[str, Dict[str, float]]
+                                 )              -> Dict[str, Dict[str, Any]]:
+    '''
+    It returns the radiogenic background levels for every component and isotope
+    as a nested dictionary {component: {isotope: activity}}.
+    Dimensions may be floats or numpy arrays (see get_dimensions_array).
+    '''
+    det_background = {}
+    for component, (material, dimension, multiplicity) in radiogenic_components.items():
+        det_background[component] = {
+            'Tl208': det_dim[dimension] * multiplicity * radiogenic_act[material]['Tl208'],
+            'Bi214': det_dim[dimension] * multiplicity * radiogenic_act[material]['Bi214']
+        }
+
+    return det_background
+
+
+
+#####################################################################
+@instrument()
 def get_radiogenic_background_level(det_name               : str,
                                     radiogenic_bkgnd_level : str
                                    )                      -> pd.DataFrame:
@@ -33,28 +69,7 @@ def get_radiogenic_background_level(det_name               : str,
     
     radiogenic_act = get_radiogenic_activities(radiogenic_bkgnd_level)
 
-    det_background = {
-    
-        'READOUT_PLANE': {
-            'Tl208': det_dim['READOUT_PLANE_surface'] * 2 * radiogenic_act['DiceBoard']['Tl208'],
-            'Bi214': det_dim['READOUT_PLANE_surface'] * 2 * radiogenic_act['DiceBoard']['Bi214']
-        },
-    
-#        'CATHODE': {
-#            'Tl208': det_dim['CATHODE_mass'] * radiogenic_act['SSteel316Ti']['Tl208'],
-#            'Bi214': det_dim['CATHODE_mass'] * radiogenic_act['SSteel316Ti']['Bi214']
-#        },
-
-        'FIELD_CAGE': {
-            'Tl208': det_dim['FIELD_CAGE_mass'] * radiogenic_act['Teflon']['Tl208'],
-            'Bi214': det_dim['FIELD_CAGE_mass'] * radiogenic_act['Teflon']['Bi214']
-        },
-        
-        'INNER_SHIELDING': {
-            'Tl208': det_dim['ICS_mass'] * radiogenic_act['Copper']['Tl208'],
-            'Bi214': det_dim['ICS_mass'] * radiogenic_act['Copper']['Bi214']
-        }
-    }
+    det_background = compute_radiogenic_background(det_dim, radiogenic_act)
 
     det_background_df = pd.DataFrame(det_background).T
     det_background_df /= units.Bq
@@ -65,42 +80,87 @@ def get_radiogenic_background_level(det_name               : str,
 
 
 #####################################################################
-def get_radon_background_level(det_name          : str,
-                               radon_bkgnd_level : str
-                              )                 -> float:
+def compute_radon_background(det_dim           : Mapping[str, Any],
+                             radon_bkgnd_level : str,
+                             radon_act         : Optional[float] = None
+                            )                 -> Any:
     '''
-    It returns the detector background level expected from the radon contamination
+    It returns the background level expected from the radon contamination.
+    Dimensions may be floats or numpy arrays (see get_dimensions_array).
+    The radon activity of the level passed can be overridden with radon_act.
     '''
-
-    radon_act = get_radon_activity(radon_bkgnd_level)
+    if radon_act is None:
+        radon_act = get_radon_activity(radon_bkgnd_level)
 
     # If 'optimistic' radon activity comes as an absolute background level
     if (radon_bkgnd_level == 'optimistic'):
-        radon_background = radon_act
+        radon_background = radon_act * np.ones_like(det_dim['ACTIVE_surface'])
     
     # Any other case, radon activity comes as an activity per surface unit
     else:
-        det_dim = get_dimensions(det_name)
         radon_background = radon_act * det_dim['ACTIVE_surface']
     return radon_background
 
 
 
 #####################################################################
+@instrument()
+def get_radon_background_level(det_name          : str,
+                               radon_bkgnd_level : str
+                              )                 -> float:
+    '''
+    It returns the detector background level expected from the radon contamination
+    '''
+    det_dim = get_dimensions(det_name)
+    return float(compute_radon_background(det_dim, radon_bkgnd_level))
+
+
+
+#####################################################################
+### Muon flux & Xe137 activation files (and number of simulated muons) per hosting lab
+muon_files = {
+
+    'LSC': {
+        'flux_file' : './muons/lngs_100Mmuons.h5',
+        'acti_file' : './muons/Xe137Count_sim87799000muons.h5',
+        'file_out'  : './muons/lsc_xe137_test.h5',
+        'num_muons' : 87799000
+    },
+
+    'LNGS': {
+        'flux_file' : './muons/lngs_100Mmuons.h5',
+        'acti_file' : './muons/Xe137Count_sim87799000muons.h5',
+        'file_out'  : './muons/lngs_xe137_test.h5',
+        'num_muons' : 87799000
+    },
+
+    'SNOLAB': {
+        'flux_file' : './muons/snolab_100Mmuons.h5',
+        'acti_file' : './muons/Xe137Count_sim87799000muons.h5',
+        'file_out'  : './muons/snolab_xe137_test.h5',
+        'num_muons' : 87799000
+    }
+}
+
+# Muon energy bin edges (GeV)
+MUON_BIN_EDGES = (1, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000,
+                  1100, 1200, 1300, 1400, 1500, 1600, 1700, 1800, 1900, 2000,
+                  2100, 2200, 2300, 2400, 2500, 2600, 2700, 2800, 2900, 3000)
+
+
+
+#####################################################################
+@instrument()
 def get_muon_background_level(det_name    : str,
                               hosting_lab : str
-                             )           -> float:
-
-    det_dim = get_dimensions(det_name)
-    muon_surface = det_dim['MUON_surface']
-    
-    
-    muon_flux       = get_muon_flux(hosting_lab)
-    muon_flux_error = get_muon_flux_error(hosting_lab)
+                             )           -> Tuple[float, float]:
+    '''
+    It returns the Xe137 production rate (Bq) from muons, and its error,
+    for the detector in the hosting lab passed.
+    '''
+    muon_config = get_muon_config(det_name, hosting_lab)
 
-    generate_muon_config_file(det_name, hosting_lab, muon_flux, muon_flux_error, muon_surface)
-    
-    Xe137_background = xe137_normalization(['dummy', 'muons.conf'], suppress_df = True)
+    Xe137_background = xe137_normalization(muon_config, suppress_df = True)
     
     #xe137_act_prob = get_xe137_activation_prob()
     #print(f"Xe137_activation_prob = {xe137_act_prob}")
@@ -109,44 +169,135 @@ def get_muon_background_level(det_name    : str,
 
 
 
+#####################################################################
+@instrument()
+def get_muon_background_rates(det_names    : Sequence[str],
+                              hosting_labs : Sequence[str]
+                             )            -> List[Tuple[List[Tuple[str, str]], Xe137Rates]]:
+    '''
+    It returns the Xe137 production rates from muons (Xe137Rates, with per-bin tables)
+    of every detector in every hosting lab passed, as a list of
+    ([(det_name, hosting_lab), ...], rates) with one entry per group of labs sharing
+    muon files, computed in a single normalization. Pairs follow the rates configurations.
+    '''
+    lab_groups = {}
+    for hosting_lab in hosting_labs:
+        lab_files = muon_files[hosting_lab]
+        group_key = (lab_files['flux_file'], str(lab_files['acti_file']), lab_files['num_muons'])
+        lab_groups.setdefault(group_key, []).append(hosting_lab)
+
+    group_rates = []
+    for labs in lab_groups.values():
+        pairs = [(det_name, hosting_lab) for hosting_lab in labs for det_name in det_names]
+        rates = xe137_normalization_kernel(
+            get_muon_config(*pairs[0]),
+            lab_flux     = [get_muon_flux      (lab) * units.cm2 * units.second for _, lab in pairs],
+            lab_flux_err = [get_muon_flux_error(lab) * units.cm2 * units.second for _, lab in pairs],
+            gen_area     = [get_dimensions(det)['MUON_surface'] / units.cm2     for det, _ in pairs])
+        group_rates.append((pairs, rates))
+
+    return group_rates
+
+
+
+#####################################################################
+@instrument()
+def get_muon_background_levels(det_names    : Sequence[str],
+                               hosting_labs : Sequence[str]
+                              )            -> Dict[Tuple[str, str], Tuple[float, float]]:
+    '''
+    It returns the Xe137 production rates (Bq) from muons, and their errors,
+    of every detector in every hosting lab passed, as {(det_name, hosting_lab): (rate, error)}.
+    All the (detector, lab) pairs sharing muon files are computed in a single normalization.
+    '''
+    muon_levels = {}
+    for pairs, rates in get_muon_background_rates(det_names, hosting_labs):
+        for pair, level, error in zip(pairs, rates.total_xe137PS, rates.perSec_err):
+            muon_levels[pair] = (level, error)
+
+    return muon_levels
+
+
+
+#####################################################################
+def get_lab_muon_config(hosting_lab  : str,
+                        muon_surface : float,
+                        bin_edges    : Sequence[float] = MUON_BIN_EDGES
+                       )            -> MuonConfig:
+    '''
+    It returns the in-memory muons config for a muon generation surface in the hosting lab passed.
+    The muon energy bin edges (GeV) can be changed (see muons/binning_optimizer.py).
+    '''
+    muon_flux       = get_muon_flux(hosting_lab)
+    muon_flux_error = get_muon_flux_error(hosting_lab)
+    lab_files       = muon_files[hosting_lab]
+
+    return MuonConfig(flux_file         = lab_files['flux_file'],
+                      acti_file         = lab_files['acti_file'],
+                      file_out          = lab_files['file_out'],
+                      n_simulated_muons = lab_files['num_muons'],
+                      bin_edges         = tuple(float(edge) for edge in bin_edges),
+                      lab_flux          = muon_flux       * units.cm2 * units.second,
+                      lab_flux_err      = muon_flux_error * units.cm2 * units.second,
+                      gen_area          = muon_surface / units.cm2)
+
+
+
+#####################################################################
+def get_muon_config(det_name    : str,
+                    hosting_lab : str,
+                    bin_edges   : Sequence[float] = MUON_BIN_EDGES
+                   )           -> MuonConfig:
+    '''
+    It returns the in-memory muons config for the detector in the hosting lab passed.
+    '''
+    det_dim = get_dimensions(det_name)
+    return get_lab_muon_config(hosting_lab, det_dim['MUON_surface'], bin_edges)
+
+
+
+#####################################################################
+def get_muon_background_per_surface(hosting_lab : str) -> Tuple[float, float]:
+    '''
+    It returns the Xe137 production rate (Bq) from muons, and its error,
+    per unit of muon surface (the rate scales linearly with MUON_surface),
+    so it can be applied to any detector design.
+    '''
+    muon_config = get_lab_muon_config(hosting_lab, 1.)
+
+    level, error = xe137_normalization(muon_config, suppress_df = True)
+    return level, error
+
+
+
 #####################################################################
 def generate_muon_config_file(det_name        : str,
                               hosting_lab     : str,
                               muon_flux       : float,
                               muon_flux_error : float,
-                              muon_surface    : float
+                              muon_surface    : float,
+                              bin_edges       : Sequence[float] = MUON_BIN_EDGES
                              )               -> None:
-
+    '''
+    It writes the 'muons.conf' file equivalent to the in-memory muons config,
+    to be used running xe137_normalization as a script.
+    '''
     heading_text = f"### Muons config file for {det_name} in {hosting_lab} ###"
 
-    # The flux & Xe137_activation & output file names
-    # Num simulated muons
-    if (hosting_lab == 'LSC'):
-        flux_file_name = './muons/lngs_100Mmuons.h5'
-        acti_file_name = './muons/Xe137Count_sim87799000muons.h5'
-        out_file_name  = './muons/lsc_xe137_test.h5'
-        num_muons      = 87799000
-    elif (hosting_lab == 'LNGS'):
-        flux_file_name = './muons/lngs_100Mmuons.h5'
-        acti_file_name = './muons/Xe137Count_sim87799000muons.h5'
-        out_file_name  = './muons/lngs_xe137_test.h5'
-        num_muons      = 87799000
-    elif (hosting_lab == 'SNOLAB'):
-        flux_file_name = './muons/snolab_100Mmuons.h5'
-        acti_file_name = './muons/Xe137Count_sim87799000muons.h5'
-        out_file_name  = './muons/snolab_xe137_test.h5'
-        num_muons      = 87799000
+    # The flux & Xe137_activation & output file names
+    # Num simulated muons
+    lab_files = muon_files[hosting_lab]
 
     # Bins set
-    bins_set = "1, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 1100, 1200, 1300, 1400, 1500, 1600, 1700, 1800, 1900, 2000, 2100, 2200, 2300, 2400, 2500, 2600, 2700, 2800, 2900, 3000"
+    bins_set = ", ".join(str(edge) for edge in bin_edges)
     
-    # File content
+    # File content
     file_text = f'''{heading_text}
-flux_file = "{flux_file_name}"
-acti_file = "{acti_file_name}"
-file_out  = "{out_file_name}"
+flux_file = "{lab_files['flux_file']}"
+acti_file = "{lab_files['acti_file']}"
+file_out  = "{lab_files['file_out']}"
 
-n_simulated_muons = {num_muons}
+n_simulated_muons = {lab_files['num_muons']}
 
 bin_edges = {bins_set}
 
@@ -162,5 +313,3 @@ gen_area     = {muon_surface / units.cm2:8.4}
     muons_conf_file = open('muons.conf', 'w')
     muons_conf_file.write(file_text)
     muons_conf_file.close()
-
-    
\ No newline at end of file
@@ -1,12 +1,13 @@
 # General importings
 import math
+import types
+import functools
 import numpy  as np
-import pandas as pd
 
-from typing import Tuple, List, Dict, Any
+from typing import Tuple, List, Dict, Any, Mapping
 
-# Specific IC stuff
-import invisible_cities.core.system_of_units as units
+# Specific TONNE stuff
+import system_of_units as units
 
 
 
@@ -61,12 +62,28 @@ SSteel316Ti_density = 7990. * units.kg / units.m3
 
 
 #####################################################################
-def get_dimensions(det_name: str) -> Dict[str, float]:
+def get_dimensions_array(ACTIVE_diam          : Any,
+                         ACTIVE_length        : Any,
+                         FIELD_CAGE_thickness : Any,
+                         ICS_thickness        : Any,
+                         HOLLOWS_width        : Any,
+                         VESSEL_thickness     : Any,
+                         WATER_thickness      : Any = WATER_THICKNESS
+                        )                    -> Dict[str, Any]:
     '''
-    Based on the relevant dimensions of any detector,
-    it computes all the dimensions needed and returns them as a dictionary
+    Based on the relevant dimensions of any detector design,
+    it computes all the dimensions needed and returns them as a dictionary.
+    Base dimensions may be floats or numpy arrays (broadcast against each other),
+    so the geometry of many candidate designs is computed at once.
     '''
-    dimensions = detector_dimensions[det_name]
+    dimensions = {
+        'ACTIVE_diam'         : ACTIVE_diam,
+        'ACTIVE_length'       : ACTIVE_length,
+        'FIELD_CAGE_thickness': FIELD_CAGE_thickness,
+        'ICS_thickness'       : ICS_thickness,
+        'HOLLOWS_width'       : HOLLOWS_width,
+        'VESSEL_thickness'    : VESSEL_thickness
+    }
 
     ### Adding 'ACTIVE' derived dimensions
     dimensions['ACTIVE_surface'] = (dimensions['ACTIVE_diam']/2)**2 * math.pi * 2 + \
@@ -147,8 +164,8 @@ def get_dimensions(det_name: str) -> Dict[str, float]:
                       2 * dimensions['ICS_thickness'] + 2 * dimensions['HOLLOWS_width'] + \
                       2 * dimensions['VESSEL_thickness']
     
-    dimensions['TANK_outerDiam']  = max(detector_length, detector_diam) + \
-                                    2. * WATER_THICKNESS + 2. * TANK_THICKNESS
+    dimensions['TANK_outerDiam']  = np.maximum(detector_length, detector_diam) + \
+                                    2. * WATER_thickness + 2. * TANK_THICKNESS
     dimensions['TANK_topSurface'] = (dimensions['TANK_outerDiam']/2)**2 * math.pi
     dimensions['MUON_surface']   = (dimensions['TANK_outerDiam'] + 2 * MUON_EXTRA_RAD)**2
 
@@ -156,6 +173,20 @@ def get_dimensions(det_name: str) -> Dict[str, float]:
 
 
 
+#####################################################################
+@functools.lru_cache(maxsize=None)
+def get_dimensions(det_name: str) -> Mapping[str, float]:
+    '''
+    Based on the relevant dimensions of any detector,
+    it computes all the dimensions needed and returns them as a read-only dictionary.
+    Dimensions are computed once per detector
+    (call get_dimensions.cache_clear() after editing detector_dimensions).
+    '''
+    dimensions = get_dimensions_array(**detector_dimensions[det_name])
+    return types.MappingProxyType({key: float(value) for key, value in dimensions.items()})
+
+
+
 #####################################################################
 def print_dimensions(det_name: str) -> None:
     '''
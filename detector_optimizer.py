@@ -0,0 +1,253 @@
+# General importings
+import math
+import numpy  as np
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any, Optional
+
+# Specific TONNE stuff
+import system_of_units as units
+
+from detector_dimensions  import detector_dimensions
+from detector_dimensions  import get_dimensions_array
+from detector_dimensions  import Xe_density
+from detector_dimensions  import WATER_THICKNESS
+
+from initial_activities   import get_radiogenic_activities
+
+from detector_backgrounds import radiogenic_components
+from detector_backgrounds import compute_radiogenic_background
+from detector_backgrounds import compute_radon_background
+from detector_backgrounds import get_muon_background_per_surface
+
+from background_index     import get_rejection_arrays
+from background_index     import get_toCKKY
+from background_index     import XE136_ABUNDANCE
+from background_index     import RADIOGENIC_ISOTOPES
+
+from roi_settings         import get_roi_settings
+from sensitivity          import get_halflife_sensitivity
+
+
+#####################################################################
+### Design parameters scanned by the optimizer
+### There is no shielding model: WATER_thickness only enlarges the MUON_surface,
+### so scanning it always gives its minimum.
+DESIGN_PARAMETERS = ['ACTIVE_diam', 'ACTIVE_length', 'ICS_thickness',
+                     'FIELD_CAGE_thickness', 'WATER_thickness']
+
+# Objective -> (figure, sign): the optimizer minimizes sign * figure
+OBJECTIVES = {
+    'sensitivity' : ('T12_sensitivity', -1.),
+    'fom'         : ('fom'            , -1.),
+    'index'       : ('bkgnd_index'    ,  1.)
+}
+
+# Objectives without mass term: they need a fixed Xe136_mass_kg
+FIXED_MASS_OBJECTIVES = ['fom', 'index']
+
+### Live time (years) of the sensitivity objective
+LIVE_YEARS = 10.
+
+
+
+#####################################################################
+def get_design_evaluator(radiogenic_bkgnd_level : str,
+                         radon_bkgnd_level      : str,
+                         hosting_lab            : str,
+                         energyRes              : float,
+                         spatialDef             : str,
+                         ref_det_name           : str = 'next_hd',
+                         muon_level_per_surface : Optional[float] = None,
+                         live_years             : float = LIVE_YEARS
+                        ):
+    '''
+    It returns a function evaluating the background (and the half-life sensitivity
+    after live_years) of detector designs, given as arrays of DESIGN_PARAMETERS,
+    for the scenario passed.
+    Rejection factors (and the non-scanned dimensions) are taken from ref_det_name.
+    muon_level_per_surface (Bq per MUON_surface unit) skips the muon normalization.
+    '''
+    ref_dimensions = detector_dimensions[ref_det_name]
+    radiogenic_act = get_radiogenic_activities(radiogenic_bkgnd_level)
+
+    if muon_level_per_surface is None:
+        muon_level_per_surface, _ = get_muon_background_per_surface(hosting_lab)
+
+    ### Rejection factors of the reference detector
+    sources = list(radiogenic_components)
+    radiogenic_rej, _ = get_rejection_arrays(ref_det_name, sources,
+                                             [energyRes], [spatialDef], RADIOGENIC_ISOTOPES)
+    radon_rej,  _     = get_rejection_arrays(ref_det_name, ['CATHODE'],
+                                             [energyRes], [spatialDef], ['Bi214'])
+    active_rej, _     = get_rejection_arrays(ref_det_name, ['ACTIVE'],
+                                             [energyRes], [spatialDef], ['bb0nu', 'Xe137'])
+    radiogenic_rej    = np.nan_to_num(radiogenic_rej[0, 0])
+    radon_rej         = radon_rej [0, 0, 0, 0]
+    sig_eff           = active_rej[0, 0, 0, 0]
+    Xe137_rej         = active_rej[0, 0, 0, 1]
+
+    ROI_settings = get_roi_settings(energyRes)
+    roi_width    = (ROI_settings['Emax'] - ROI_settings['Emin']) / units.keV
+
+    def evaluate(design: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        det_dim = get_dimensions_array(design['ACTIVE_diam'],
+                                       design['ACTIVE_length'],
+                                       design['FIELD_CAGE_thickness'],
+                                       design['ICS_thickness'],
+                                       ref_dimensions['HOLLOWS_width'],
+                                       ref_dimensions['VESSEL_thickness'],
+                                       design['WATER_thickness'])
+
+        radiogenic_bkgnd = compute_radiogenic_background(det_dim, radiogenic_act)
+        radiogenic_bq    = sum(radiogenic_bkgnd[source][isotope] / units.Bq * radiogenic_rej[i, j]
+                               for i, source  in enumerate(sources)
+                               for j, isotope in enumerate(RADIOGENIC_ISOTOPES))
+
+        radon_bq = compute_radon_background(det_dim, radon_bkgnd_level) / units.Bq * radon_rej
+        muon_bq  = muon_level_per_surface * det_dim['MUON_surface'] * Xe137_rej
+
+        bkgnd_level_bq = radiogenic_bq + radon_bq + muon_bq
+        Xe136_mass_kg  = det_dim['ACTIVE_mass'] * XE136_ABUNDANCE / units.kg
+        bkgnd_index    = bkgnd_level_bq * get_toCKKY(Xe136_mass_kg, energyRes)
+
+        return {'Xe136_mass'     : Xe136_mass_kg,
+                'bkgnd_level_Bq' : bkgnd_level_bq,
+                'bkgnd_index'    : bkgnd_index,
+                'fom'            : sig_eff / np.sqrt(bkgnd_level_bq),
+                'T12_sensitivity': get_halflife_sensitivity(Xe136_mass_kg * live_years, bkgnd_index,
+                                                            roi_width, sig_eff)}
+
+    return evaluate
+
+
+
+#####################################################################
+def get_active_length(ACTIVE_diam   : np.ndarray,
+                      Xe136_mass_kg : float
+                     )             -> np.ndarray:
+    '''
+    It returns the ACTIVE length giving the Xe136 mass passed for every ACTIVE diameter.
+    '''
+    return Xe136_mass_kg * units.kg / \
+           (XE136_ABUNDANCE * Xe_density * math.pi * (ACTIVE_diam / 2)**2)
+
+
+
+#####################################################################
+def scan_designs(evaluate      : Any,
+                 ranges        : Dict[str, Tuple[float, float]],
+                 n_points      : int,
+                 objective     : str,
+                 Xe136_mass_kg : Optional[float] = None,
+                 chunk_size    : int = 1000000
+                )             -> Tuple[Dict[str, float], Dict[str, float]]:
+    '''
+    It evaluates the grid of n_points per scanned parameter in chunks of
+    chunk_size designs (so memory does not depend on the grid size),
+    and returns the best design and its figures.
+    If Xe136_mass_kg is passed, ACTIVE_length is derived from ACTIVE_diam.
+    '''
+    scanned = [par for par in DESIGN_PARAMETERS
+               if not ((par == 'ACTIVE_length') and (Xe136_mass_kg is not None))]
+    axes    = [np.linspace(*ranges[par], n_points) if ranges[par][0] != ranges[par][1]
+               else np.array([ranges[par][0]]) for par in scanned]
+    shape   = tuple(len(axis) for axis in axes)
+    n_total = int(np.prod(shape))
+
+    figure, sign = OBJECTIVES[objective]
+
+    best_score, best_design, best_figures = np.inf, None, None
+    for first in range(0, n_total, chunk_size):
+        flat   = np.arange(first, min(first + chunk_size, n_total))
+        design = {par: axis[idx] for par, axis, idx
+                  in zip(scanned, axes, np.unravel_index(flat, shape))}
+
+        if Xe136_mass_kg is not None:
+            design['ACTIVE_length'] = get_active_length(design['ACTIVE_diam'], Xe136_mass_kg)
+
+        figures = evaluate(design)
+        score   = sign * figures[figure]
+
+        # Designs outside the ACTIVE_length range are discarded
+        if Xe136_mass_kg is not None:
+            length_min, length_max = ranges['ACTIVE_length']
+            score = np.where((design['ACTIVE_length'] >= length_min) &
+                             (design['ACTIVE_length'] <= length_max), score, np.inf)
+
+        best = np.argmin(score)
+        if score[best] < best_score:
+            best_score   = score[best]
+            best_design  = {par: float(values[best]) for par, values in design.items()}
+            best_figures = {key: float(values[best]) for key, values in figures.items()}
+
+    if best_design is None:
+        raise ValueError('No valid design found in the ranges passed')
+
+    return best_design, best_figures
+
+
+
+#####################################################################
+def optimize_design(ranges                 : Dict[str, Tuple[float, float]],
+                    radiogenic_bkgnd_level : str,
+                    radon_bkgnd_level      : str,
+                    hosting_lab            : str,
+                    energyRes              : float,
+                    spatialDef             : str,
+                    objective              : str = 'sensitivity',
+                    Xe136_mass_kg          : Optional[float] = None,
+                    live_years             : float = LIVE_YEARS,
+                    n_points               : int = 20,
+                    n_refinements          : int = 0,
+                    shrink_factor          : float = 0.2,
+                    ref_det_name           : str = 'next_hd',
+                    muon_level_per_surface : Optional[float] = None,
+                    chunk_size             : int = 1000000
+                   )                      -> pd.Series:
+    '''
+    It scans detector designs, with DESIGN_PARAMETERS in the ranges passed
+    ((min, max) in IC units; missing ones fixed to the ref_det_name values),
+    and returns the best one with its Xe136 mass, background level, index and fom.
+
+    objective = 'sensitivity' : maximizes the 90% CL half-life sensitivity after live_years.
+    objective = 'fom'         : maximizes the notebook sig_eff / sqrt(bkgnd) figure of merit
+                                at fixed Xe136_mass_kg.
+    objective = 'index'       : minimizes the background index at fixed Xe136_mass_kg.
+    ('fom' & 'index' have no mass term: with a free mass, they give the smallest design.)
+    WATER_thickness has no shielding effect (see DESIGN_PARAMETERS): better not scanned.
+
+    With n_refinements > 0, every new scan is done around the best design found,
+    in ranges shrunk by shrink_factor (and contained in the original ones).
+    '''
+    if objective not in OBJECTIVES:
+        raise ValueError(f"Unknown objective '{objective}' ({'|'.join(OBJECTIVES)})")
+    if (objective in FIXED_MASS_OBJECTIVES) and (Xe136_mass_kg is None):
+        raise ValueError(f"objective '{objective}' requires a fixed Xe136_mass_kg")
+
+    ref_dimensions = dict(detector_dimensions[ref_det_name], WATER_thickness = WATER_THICKNESS)
+    if Xe136_mass_kg is not None:
+        # ACTIVE_length is derived, its range (if any) only constrains the designs
+        ref_dimensions['ACTIVE_length'] = (0., np.inf)
+    ranges = {par: tuple(ranges.get(par, (ref_dimensions[par], ref_dimensions[par])))
+              if par != 'ACTIVE_length' or Xe136_mass_kg is None
+              else tuple(ranges.get(par, ref_dimensions[par]))
+              for par in DESIGN_PARAMETERS}
+
+    evaluate = get_design_evaluator(radiogenic_bkgnd_level, radon_bkgnd_level, hosting_lab,
+                                    energyRes, spatialDef, ref_det_name, muon_level_per_surface,
+                                    live_years)
+
+    scan_ranges = dict(ranges)
+    for refinement in range(n_refinements + 1):
+        best_design, best_figures = scan_designs(evaluate, scan_ranges, n_points,
+                                                 objective, Xe136_mass_kg, chunk_size)
+
+        for par, (par_min, par_max) in ranges.items():
+            half_width = (scan_ranges[par][1] - scan_ranges[par][0]) * shrink_factor / 2.
+            scan_ranges[par] = (max(par_min, best_design[par] - half_width),
+                                min(par_max, best_design[par] + half_width))
+        if Xe136_mass_kg is not None:
+            scan_ranges['ACTIVE_length'] = ranges['ACTIVE_length']
+
+    return pd.Series({**best_design, **best_figures})
@@ -0,0 +1,313 @@
+# General importings
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+import contextlib
+import tracemalloc
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any, Optional, Callable
+
+
+#####################################################################
+### Instrumentation is opt-in: TONNE_INSTRUMENT=1 (or enable()) switches it on,
+### TONNE_INSTRUMENT=memory also traces python allocations (tracemalloc, slower),
+### and TONNE_TRACE_FILE writes the trace when the process exits.
+INSTRUMENT_ENV   = os.environ.get('TONNE_INSTRUMENT', '')
+TRACE_FILE       = os.environ.get('TONNE_TRACE_FILE')
+
+_enabled         = False
+_trace_memory    = False
+_spans           = []
+_spans_lock      = threading.Lock()
+_local           = threading.local()
+_origin          = time.perf_counter()
+
+
+
+#####################################################################
+def enable(trace_memory: bool = False) -> None:
+    '''
+    It switches the instrumentation on. With trace_memory, the peak of the
+    python allocations (tracemalloc) of every span is recorded too.
+    '''
+    global _enabled, _trace_memory
+    _enabled      = True
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+
+def disable() -> None:
+    '''
+    It switches the instrumentation off (recorded spans are kept).
+    '''
+    global _enabled, _trace_memory
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled, _trace_memory = False, False
+
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+
+def reset() -> None:
+    '''
+    It forgets every recorded span.
+    '''
+    with _spans_lock:
+        _spans.clear()
+
+
+
+#####################################################################
+def read_io_counters() -> Tuple[int, int]:
+    '''
+    It returns the bytes read by this process: all read calls (rchar, page cache
+    included) and from storage (read_bytes). Zeros if /proc/self/io is not available.
+    '''
+    try:
+        with open('/proc/self/io') as io_file:
+            counters = dict(line.split(': ') for line in io_file.read().splitlines())
+        return int(counters['rchar']), int(counters['read_bytes'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+
+def read_peak_rss() -> int:
+    '''
+    It returns the peak resident set size (bytes) of this process so far
+    (0 if /proc/self/status is not available).
+    '''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+
+#####################################################################
+class _Span:
+    '''
+    A running span: it measures wall & CPU time, bytes read and memory
+    between __enter__ and __exit__, and records them.
+    '''
+    __slots__ = ('name', 'args', 'start', 'cpu_start', 'io_start', 'mem_start', 'mem_peak')
+
+    def __init__(self, name: str, args: Dict[str, Any]):
+        self.name = name
+        self.args = args
+
+
+    def __enter__(self) -> '_Span':
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+
+        self.mem_start, self.mem_peak = 0, 0
+        if _trace_memory and tracemalloc.is_tracing():
+            # The parent keeps its own peak, so nested spans can reset the tracemalloc peak
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].mem_peak = max(stack[-1].mem_peak, peak)
+            tracemalloc.reset_peak()
+            self.mem_start = current
+        stack.append(self)
+
+        self.io_start  = read_io_counters()
+        self.cpu_start = time.process_time()
+        self.start     = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc_info) -> None:
+        end     = time.perf_counter()
+        cpu_end = time.process_time()
+        io_end  = read_io_counters()
+
+        stack = _local.stack
+        stack.pop()
+        if _trace_memory and tracemalloc.is_tracing():
+            self.mem_peak = max(self.mem_peak, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1].mem_peak = max(stack[-1].mem_peak, self.mem_peak)
+
+        record = {'name'       : self.name,
+                  'start'      : self.start - _origin,
+                  'wall_time'  : end - self.start,
+                  'cpu_time'   : cpu_end - self.cpu_start,
+                  'bytes_read' : io_end[0] - self.io_start[0],
+                  'disk_read'  : io_end[1] - self.io_start[1],
+                  'mem_peak'   : self.mem_peak - self.mem_start,
+                  'peak_rss'   : read_peak_rss(),
+                  'depth'      : len(stack),
+                  'pid'        : os.getpid(),
+                  'tid'        : threading.get_ident(),
+                  'args'       : self.args}
+        with _spans_lock:
+            _spans.append(record)
+
+
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+
+#####################################################################
+def span(name: str, **args: Any) -> Any:
+    '''
+    It returns a context manager recording a named span (args are kept in the trace).
+    When the instrumentation is disabled it is a shared no-op context.
+    '''
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+
+def instrument(name: Optional[str] = None) -> Callable:
+    '''
+    Decorator recording a span (named after the function by default)
+    for every call of the decorated function.
+    '''
+    def decorator(function: Callable) -> Callable:
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(span_name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+
+#####################################################################
+def call_traced(enabled      : bool,
+                trace_memory : bool,
+                function     : Callable,
+                *args        : Any
+               )            -> Tuple[Any, List[Dict[str, Any]]]:
+    '''
+    It runs function(*args) in a worker process with the instrumentation of the
+    parent (enabled, trace_memory), and returns its result and the spans recorded,
+    their start times made absolute so the parent can merge them (merge_spans).
+    '''
+    if not enabled:
+        return function(*args), []
+
+    enable(trace_memory)
+    reset()    # forked workers inherit the spans of the parent
+    result = function(*args)
+    with _spans_lock:
+        spans = [{**record, 'start': record['start'] + _origin} for record in _spans]
+        _spans.clear()
+    return result, spans
+
+
+
+def merge_spans(spans: List[Dict[str, Any]]) -> None:
+    '''
+    It adds the spans returned by call_traced (recorded in another process,
+    whose pid they keep) to the spans of this process.
+    '''
+    with _spans_lock:
+        _spans.extend({**record, 'start': record['start'] - _origin} for record in spans)
+
+
+
+def traced_map(executor  : Any,
+               function  : Callable,
+               *iterables: Any
+              )         -> Any:
+    '''
+    executor.map(function, *iterables) for process pools, with the spans recorded
+    in the workers merged into the spans of this process.
+    It yields the results in order.
+    '''
+    n_calls = min(len(iterable) for iterable in iterables)
+    calls   = executor.map(call_traced, [_enabled] * n_calls, [_trace_memory] * n_calls,
+                           [function] * n_calls, *iterables)
+    for result, spans in calls:
+        merge_spans(spans)
+        yield result
+
+
+
+#####################################################################
+def get_spans() -> pd.DataFrame:
+    '''
+    It returns a DataFrame with every span recorded in this process (times in s, sizes in bytes),
+    and in the worker processes run through traced_map (with their pid).
+    '''
+    with _spans_lock:
+        spans = list(_spans)
+    return pd.DataFrame(spans, columns=['name', 'start', 'wall_time', 'cpu_time', 'bytes_read',
+                                        'disk_read', 'mem_peak', 'peak_rss', 'depth',
+                                        'pid', 'tid', 'args'])
+
+
+
+def get_summary() -> pd.DataFrame:
+    '''
+    It returns the number of calls and the total wall & CPU time and bytes read
+    per span name, and their largest memory peak, sorted by total wall time.
+    '''
+    spans_df = get_spans()
+    summary  = spans_df.groupby('name').agg(calls      = ('wall_time' , 'size'),
+                                            wall_time  = ('wall_time' , 'sum'),
+                                            cpu_time   = ('cpu_time'  , 'sum'),
+                                            bytes_read = ('bytes_read', 'sum'),
+                                            mem_peak   = ('mem_peak'  , 'max'),
+                                            peak_rss   = ('peak_rss'  , 'max'))
+    return summary.sort_values('wall_time', ascending=False)
+
+
+
+def export_trace(ofile_name: str) -> None:
+    '''
+    It writes the recorded spans as a JSON trace (Trace Event Format),
+    viewable in chrome://tracing or https://ui.perfetto.dev.
+    '''
+    events = []
+    for record in get_spans().to_dict('records'):
+        events.append({'name': record['name'],
+                       'cat' : 'tonne',
+                       'ph'  : 'X',
+                       'ts'  : record['start']     * 1e6,
+                       'dur' : record['wall_time'] * 1e6,
+                       'pid' : record['pid'],
+                       'tid' : record['tid'],
+                       'args': {'cpu_time'  : record['cpu_time'],
+                                'bytes_read': record['bytes_read'],
+                                'disk_read' : record['disk_read'],
+                                'mem_peak'  : record['mem_peak'],
+                                'peak_rss'  : record['peak_rss'],
+                                **{key: str(value) for key, value in record['args'].items()}}})
+
+    with open(ofile_name, 'w') as ofile:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, ofile)
+
+
+
+#####################################################################
+if INSTRUMENT_ENV not in ('', '0'):
+    enable(trace_memory = INSTRUMENT_ENV == 'memory')
+
+if TRACE_FILE:
+    atexit.register(lambda: _spans and export_trace(TRACE_FILE))
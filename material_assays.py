@@ -0,0 +1,330 @@
+# General importings
+import heapq
+import warnings
+import functools
+import numpy  as np
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any, Optional, Sequence
+
+# Specific TONNE stuff
+import system_of_units as units
+
+from detector_dimensions  import get_dimensions
+
+from detector_backgrounds import get_radon_background_level
+from detector_backgrounds import get_muon_background_level
+
+from rejection_factors    import get_rejection_store
+from background_index     import get_Xe136_mass
+from background_index     import get_toCKKY
+
+from instrumentation      import instrument
+
+
+#####################################################################
+### File with the material assays (activities per unit mass or surface)
+ASSAY_FILE_NAME = 'material_assays.csv'
+
+ASSAY_ISOTOPES  = ['Bi214', 'Tl208']
+
+### Material, dimension (surface or mass) and multiplicity of every component
+### that can be assigned an assay (same convention as radiogenic_components)
+assay_components = {
+    'READOUT_PLANE'   : ('DiceBoard',   'READOUT_PLANE_surface', 2),
+    'FIELD_CAGE'      : ('Teflon',      'FIELD_CAGE_mass',       1),
+    'INNER_SHIELDING' : ('Copper',      'ICS_mass',              1),
+    'CATHODE'         : ('SSteel316Ti', 'CATHODE_mass',          1),
+    'VESSEL'          : ('SSteel316Ti', 'VESSEL_mass',           1)
+}
+
+### Unit (denominator) of the assay activities that matches every kind of dimension
+DIMENSION_UNITS = {'mass': 'kg', 'surface': 'm2'}
+
+
+
+#####################################################################
+@functools.lru_cache(maxsize=None)
+@instrument()
+def read_material_assays(file_name: str = ASSAY_FILE_NAME) -> pd.DataFrame:
+    '''
+    It returns the DataFrame read from the material assays file passed,
+    indexed by (material, assay). Missing errors and costs are set to 0.
+    It is parsed only once per file, so it must not be modified.
+    '''
+    assays_df = pd.read_csv(file_name, index_col=['material', 'assay'], comment='#',
+                            skipinitialspace=True)
+    if not assays_df.index.is_unique:
+        duplicated = assays_df.index[assays_df.index.duplicated()]
+        raise ValueError(f"Duplicated assays in '{file_name}': {list(duplicated)}")
+
+    err_columns = [f'{iso}_err' for iso in ASSAY_ISOTOPES]
+    assays_df[err_columns] = assays_df[err_columns].fillna(0.)
+    assays_df['cost']      = assays_df['cost'].fillna(0.)
+    assays_df['is_limit']  = assays_df['is_limit'].fillna(0).astype(bool)
+    return assays_df.sort_index()
+
+
+
+#####################################################################
+def get_material_assays(material  : Optional[str] = None,
+                        file_name : str           = ASSAY_FILE_NAME
+                       )         -> pd.DataFrame:
+    '''
+    It returns a DataFrame with all the assays of the material passed
+    (of every material if None), activities in the units of the file.
+    '''
+    assays_df = read_material_assays(file_name)
+    if material is None:
+        return assays_df.copy()
+    return assays_df.loc[assays_df.index.get_level_values('material') == material].copy()
+
+
+
+#####################################################################
+def get_assay_unit(unit: str) -> float:
+    '''
+    It returns the value of an activity unit of the assays file, as 'mBq/kg'.
+    '''
+    numerator, denominator = unit.split('/')
+    return getattr(units, numerator.strip()) / getattr(units, denominator.strip())
+
+
+
+#####################################################################
+def get_assay_activities(assays_df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    It returns the activities and their errors of the assays passed
+    (in system of units), as arrays of shape (n_assays, n_isotopes).
+    '''
+    scale  = np.array([get_assay_unit(unit) for unit in assays_df['unit']])[:, None]
+    values = assays_df[ASSAY_ISOTOPES].to_numpy(dtype=float) * scale
+    errors = assays_df[[f'{iso}_err' for iso in ASSAY_ISOTOPES]].to_numpy(dtype=float) * scale
+    return values, errors
+
+
+
+#####################################################################
+def get_component_contributions(det_name   : str,
+                                energyRes  : float,
+                                spatialDef : str,
+                                n_sigma    : float = 1.,
+                                file_name  : str   = ASSAY_FILE_NAME
+                               )          -> pd.DataFrame:
+    '''
+    It returns the background index (ckky), and its error, that every candidate
+    assay would contribute to every component of the detector passed,
+    indexed by (component, assay). upper_index = index + n_sigma * error.
+    Components without assays of their material or without rejection factors
+    are not included: they are listed, with the reason, in attrs['unassigned']
+    (and a warning is issued).
+    '''
+    det_dim   = get_dimensions(det_name)
+    store     = get_rejection_store(det_name)
+    toCKKY    = get_toCKKY(get_Xe136_mass(det_name), energyRes)
+    assays_df = read_material_assays(file_name)
+
+    contributions = []
+    unassigned    = {}
+    for component, (material, dimension, multiplicity) in assay_components.items():
+        material_df = assays_df.loc[assays_df.index.get_level_values('material') == material]
+        if material_df.empty:
+            unassigned[component] = f"no {material} assays in '{file_name}'"
+            continue
+
+        rej, rej_err = store.take([component], [energyRes], [spatialDef], ASSAY_ISOTOPES)
+        rej, rej_err = rej[0, 0, 0], rej_err[0, 0, 0]
+        if np.isnan(rej).all():
+            unassigned[component] = f"no '{det_name}' rejection factors"
+            continue
+
+        dimension_unit = DIMENSION_UNITS[dimension.split('_')[-1]]
+        bad_units      = [unit for unit in material_df['unit'] if unit.split('/')[-1] != dimension_unit]
+        if bad_units:
+            raise ValueError(f"{material} assays in {bad_units} can not be used for "
+                             f"{component} ({dimension})")
+
+        ### (n_assays, n_isotopes), missing rejection factors do not contribute
+        act, act_err = get_assay_activities(material_df)
+        level        = det_dim[dimension] * multiplicity / units.Bq
+        index        = np.nansum(level * act * rej, axis=1) * toCKKY
+        index_err    = np.sqrt(np.nansum((level * act     * rej_err)**2 +
+                                         (level * act_err * rej    )**2, axis=1)) * toCKKY
+
+        contributions.append(pd.DataFrame({'component'  : component,
+                                           'assay'      : material_df.index.get_level_values('assay'),
+                                           'material'   : material,
+                                           'index'      : index,
+                                           'index_err'  : index_err,
+                                           'upper_index': index + n_sigma * index_err,
+                                           'cost'       : material_df['cost'].to_numpy(),
+                                           'is_limit'   : material_df['is_limit'].to_numpy()}))
+
+    if unassigned:
+        warnings.warn('Components left out of the material selection: ' +
+                      '; '.join(f'{component} ({reason})' for component, reason in unassigned.items()),
+                      stacklevel=2)
+
+    contrib_df = pd.concat(contributions).set_index(['component', 'assay'])
+    contrib_df.attrs['unassigned'] = unassigned
+    return contrib_df
+
+
+
+#####################################################################
+def get_fixed_index(det_name          : str,
+                    energyRes         : float,
+                    spatialDef        : str,
+                    radon_bkgnd_level : Optional[str] = None,
+                    hosting_lab       : Optional[str] = None
+                   )                 -> Tuple[float, float]:
+    '''
+    It returns the background index (ckky), and its error, not depending on
+    the material choice: radon (if radon_bkgnd_level) and muons (if hosting_lab).
+    '''
+    store  = get_rejection_store(det_name)
+    toCKKY = get_toCKKY(get_Xe136_mass(det_name), energyRes)
+
+    index, variance = 0., 0.
+    if radon_bkgnd_level is not None:
+        radon_bq  = get_radon_background_level(det_name, radon_bkgnd_level) / units.Bq
+        rej       = store.get      ('CATHODE', energyRes, spatialDef, 'Bi214')
+        rej_err   = store.get_error('CATHODE', energyRes, spatialDef, 'Bi214')
+        index    += radon_bq * rej
+        variance += (radon_bq * rej_err)**2
+    if hosting_lab is not None:
+        muon_bq, muon_err = get_muon_background_level(det_name, hosting_lab)
+        rej       = store.get      ('ACTIVE', energyRes, spatialDef, 'Xe137')
+        rej_err   = store.get_error('ACTIVE', energyRes, spatialDef, 'Xe137')
+        index    += muon_bq * rej
+        variance += (muon_bq * rej_err)**2 + (muon_err * rej)**2
+
+    return index * toCKKY, np.sqrt(variance) * toCKKY
+
+
+
+#####################################################################
+def search_assignments(contributions : Sequence[np.ndarray],
+                       costs         : Sequence[np.ndarray],
+                       budget        : float,
+                       n_best        : int = 10
+                      )             -> Tuple[List[Tuple[float, float, Tuple[int, ...]]], int]:
+    '''
+    Branch & bound search of the n_best cheapest choices of one candidate per
+    component whose summed contributions do not exceed the budget.
+    Branches are pruned when even the smallest contributions of the remaining
+    components exceed the budget, or when even their cheapest candidates can not
+    beat the n_best choices already found.
+    It returns the (cost, contribution, candidate indices) of the choices found,
+    cheapest first (ties broken by contribution), and the number of nodes visited.
+    '''
+    n_comp = len(contributions)
+
+    ### Most constraining components first, cheapest candidates first
+    comp_order = sorted(range(n_comp), key=lambda i: -np.ptp(contributions[i]))
+    cand_order = [np.lexsort((contributions[i], costs[i])) for i in comp_order]
+    contribs   = [np.asarray(contributions[i], dtype=float)[order] for i, order in zip(comp_order, cand_order)]
+    comp_costs = [np.asarray(costs[i]        , dtype=float)[order] for i, order in zip(comp_order, cand_order)]
+
+    ### Smallest contribution & cost of the components after every depth
+    min_contrib_rest = np.concatenate([np.cumsum([c.min() for c in contribs  ][::-1])[::-1], [0.]])
+    min_cost_rest    = np.concatenate([np.cumsum([c.min() for c in comp_costs][::-1])[::-1], [0.]])
+
+    best    = []    # heap of (-cost, -contribution, choice): the worst choice on top
+    choice  = [0] * n_comp
+    visited = 0
+
+    def branch(depth: int, cost: float, contrib: float) -> None:
+        nonlocal visited
+        visited += 1
+        if depth == n_comp:
+            entry = (-cost, -contrib, tuple(choice))
+            if len(best) < n_best:
+                heapq.heappush(best, entry)
+            elif entry > best[0]:
+                heapq.heapreplace(best, entry)
+            return
+
+        for pos in range(len(contribs[depth])):
+            new_cost    = cost    + comp_costs[depth][pos]
+            new_contrib = contrib + contribs  [depth][pos]
+            if new_contrib + min_contrib_rest[depth + 1] > budget:
+                continue
+            if len(best) == n_best:
+                # Candidates are sorted by cost: the rest are not cheaper
+                bound_cost = new_cost + min_cost_rest[depth + 1]
+                if bound_cost > -best[0][0]:
+                    break
+                if (bound_cost == -best[0][0] and
+                    new_contrib + min_contrib_rest[depth + 1] >= -best[0][1]):
+                    continue
+            choice[depth] = pos
+            branch(depth + 1, new_cost, new_contrib)
+
+    if n_comp and min_contrib_rest[0] <= budget:
+        branch(0, 0., 0.)
+
+    results = []
+    for neg_cost, neg_contrib, sorted_choice in sorted(best, reverse=True):
+        indices = [0] * n_comp
+        for depth, pos in enumerate(sorted_choice):
+            indices[comp_order[depth]] = int(cand_order[depth][pos])
+        results.append((-neg_cost, -neg_contrib, tuple(indices)))
+    return results, visited
+
+
+
+#####################################################################
+@instrument()
+def select_materials(det_name          : str,
+                     target_index      : float,
+                     energyRes         : float,
+                     spatialDef        : str,
+                     radon_bkgnd_level : Optional[str] = None,
+                     hosting_lab       : Optional[str] = None,
+                     n_sigma           : float         = 1.,
+                     n_best            : int           = 10,
+                     file_name         : str           = ASSAY_FILE_NAME
+                    )                 -> pd.DataFrame:
+    '''
+    It returns the n_best cheapest assignments of assays to the detector components
+    whose total background index (ckky) stays below target_index, including radon
+    and muons if their level / lab are passed.
+    The index of every component is taken at n_sigma over its central value,
+    so the summed bound is conservative (errors are also given in quadrature).
+    Components without candidate assays or rejection factors are not assigned,
+    nor included in the indices: they are listed in attrs['unassigned'].
+    '''
+    contrib_df             = get_component_contributions(det_name, energyRes, spatialDef,
+                                                         n_sigma, file_name)
+    fixed_index, fixed_err = get_fixed_index(det_name, energyRes, spatialDef,
+                                             radon_bkgnd_level, hosting_lab)
+    components             = list(contrib_df.index.unique('component'))
+    candidates             = [contrib_df.loc[component] for component in components]
+
+    budget = target_index - (fixed_index + n_sigma * fixed_err)
+    found, visited = search_assignments([cand_df['upper_index'].to_numpy() for cand_df in candidates],
+                                        [cand_df['cost'       ].to_numpy() for cand_df in candidates],
+                                        budget, n_best)
+
+    rows = []
+    for cost, upper_index, indices in found:
+        chosen = [cand_df.iloc[idx] for cand_df, idx in zip(candidates, indices)]
+        row    = {component: cand_df.index[idx]
+                  for component, cand_df, idx in zip(components, candidates, indices)}
+        row['radiogenic_index']     = sum(assay['index'] for assay in chosen)
+        row['radiogenic_index_err'] = np.sqrt(sum(assay['index_err']**2 for assay in chosen))
+        row['total_index']          = row['radiogenic_index'] + fixed_index
+        row['total_index_err']      = np.sqrt(row['radiogenic_index_err']**2 + fixed_err**2)
+        row['upper_index']          = upper_index + fixed_index + n_sigma * fixed_err
+        row['n_limits']             = sum(bool(assay['is_limit']) for assay in chosen)
+        row['cost']                 = cost
+        rows.append(row)
+
+    selection_df = pd.DataFrame(rows, columns = components + ['radiogenic_index', 'radiogenic_index_err',
+                                                              'total_index', 'total_index_err',
+                                                              'upper_index', 'n_limits', 'cost'])
+    selection_df.attrs['unassigned']    = contrib_df.attrs['unassigned']
+    selection_df.attrs['nodes_visited'] = visited
+    selection_df.attrs['combinations']  = int(np.prod([len(cand_df) for cand_df in candidates]))
+    return selection_df
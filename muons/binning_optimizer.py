@@ -0,0 +1,258 @@
+import sys
+
+import numpy  as np
+import pandas as pd
+
+try:
+    import muons.xe137_normalization as xe137_normalization
+    from muons.xe137_normalization import read_muon_config
+    from muons.xe137_normalization import get_activation_files
+    from muons.xe137_normalization import get_n_simulated_muons
+    from muons.xe137_normalization import histogram_activation_files
+    from muons.xe137_normalization import get_flux_histogram
+except ImportError:
+    ## Run as a script from the muons directory
+    import xe137_normalization
+    from xe137_normalization import read_muon_config
+    from xe137_normalization import get_activation_files
+    from xe137_normalization import get_n_simulated_muons
+    from xe137_normalization import histogram_activation_files
+    from xe137_normalization import get_flux_histogram
+
+
+## Families of candidate binnings explored by scan_binnings
+BINNING_FAMILIES = ['uniform', 'log', 'equal_acti', 'equal_flux', 'equal_rate', 'random']
+
+## Merging bins always reduces the statistical error, but loses the
+## spectral shape: binnings are kept to at least MIN_BINS bins by default
+MIN_BINS = 10
+
+
+class BinningEvaluator:
+    '''
+    Activation & flux counts of a muons config, prefix-summed on a fine
+    energy grid (GeV), so that the Xe137 rate and its error for any binning
+    made of fine-grid edges costs O(n_bins), without reading any file.
+    Binnings are given as fine-grid edge indices, always spanning the whole
+    simulated range (first index 0, last index n_fine_bins).
+    '''
+
+    def __init__(self, fine_edges, acti_counts, flux_counts, sim_muons,
+                 lab_flux, lab_flux_err, gen_area):
+        self.fine_edges   = np.asarray(fine_edges, dtype = float)
+        self.cum_acti     = np.concatenate([[0], np.cumsum(acti_counts)])
+        self.cum_flux     = np.concatenate([[0], np.cumsum(flux_counts)])
+        self.sim_muons    = sim_muons
+        self.lab_flux     = lab_flux
+        self.lab_flux_err = lab_flux_err
+        self.gen_area     = gen_area
+
+
+    @classmethod
+    def from_config(cls, conf_list, fine_width = 1.):
+        '''
+        It builds the evaluator from a muons config (or MuonConfig), on a fine
+        grid of fine_width (GeV) bins covering the config binning range.
+        Flux & activation files are read only once.
+        '''
+        config     = read_muon_config(conf_list)
+        e_min      = config.bin_edges[ 0]
+        e_max      = config.bin_edges[-1]
+        n_fine     = max(int(round((e_max - e_min) / fine_width)), 1)
+        fine_edges = np.linspace(e_min, e_max, n_fine + 1)
+
+        acti_files  = get_activation_files(config.acti_file)
+        acti_counts = histogram_activation_files(acti_files, fine_edges, config.acti_chunk_size)
+        flux_counts = get_flux_histogram(config.flux_file, fine_edges,
+                                         cache_dir = config.flux_cache_dir,
+                                         n_workers = config.n_read_workers)
+
+        return cls(fine_edges, acti_counts, flux_counts,
+                   get_n_simulated_muons(acti_files, config.n_simulated_muons),
+                   config.lab_flux, config.lab_flux_err, config.gen_area)
+
+
+    @property
+    def n_fine_bins(self):
+        return len(self.fine_edges) - 1
+
+
+    def edge_indices(self, bin_edges):
+        '''
+        It returns the fine-grid indices of the (closest) bin edges passed.
+        '''
+        indices = np.searchsorted(self.fine_edges, bin_edges)
+        indices = np.clip(indices, 1, self.n_fine_bins)
+        closer  = (np.abs(self.fine_edges[indices - 1] - bin_edges)
+                   <= np.abs(self.fine_edges[indices] - bin_edges))
+        return indices - closer
+
+
+    def bin_edges(self, edge_indices):
+        '''
+        It returns the bin edges (GeV) of the fine-grid indices passed.
+        '''
+        return self.fine_edges[np.asarray(edge_indices)]
+
+
+    def evaluate(self, edge_indices):
+        '''
+        It returns the total Xe137 rate (per second) and its error for the
+        binnings passed, an array of fine-grid indices of shape (..., n_edges).
+        Binnings with empty (activation or flux) bins have an infinite error.
+        The same expressions as compute_xe137_rates are used, with the
+        simulated muons per bin at their expected value.
+        '''
+        edge_indices = np.asarray(edge_indices)
+        acti   = np.diff(self.cum_acti  [edge_indices], axis = -1).astype(float)
+        flux   = np.diff(self.cum_flux  [edge_indices], axis = -1).astype(float)
+        widths = np.diff(self.fine_edges[edge_indices], axis = -1)
+        sim    = self.sim_muons * widths / (self.fine_edges[-1] - self.fine_edges[0])
+        total_flux = float(self.cum_flux[-1])
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            xe137S   = acti / sim * flux / total_flux * self.lab_flux * self.gen_area
+            rel_err2 = (1 / acti + 1 / sim + 1 / flux + 1 / total_flux
+                        + (self.lab_flux_err / self.lab_flux)**2)
+            total_xe137PS = xe137S.sum(axis = -1)
+            perSec_err    = np.sqrt(np.sum(xe137S**2 * rel_err2, axis = -1))
+
+        empty = ((acti == 0) | (flux == 0)).any(axis = -1)
+        return total_xe137PS, np.where(empty, np.inf, perSec_err)
+
+
+    def relative_error(self, edge_indices):
+        '''
+        It returns the relative error of the total Xe137 rate of the binnings passed.
+        '''
+        total_xe137PS, perSec_err = self.evaluate(edge_indices)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.where(np.isfinite(perSec_err), perSec_err / total_xe137PS, np.inf)
+
+
+    def cumulative_weights(self, family):
+        '''
+        It returns the cumulative weights on the fine grid used to build
+        equal-statistics binnings: activations, flux or expected Xe137 rate.
+        '''
+        if family == 'equal_acti':
+            return self.cum_acti.astype(float)
+        if family == 'equal_flux':
+            return self.cum_flux.astype(float)
+        if family == 'equal_rate':
+            rate = np.diff(self.cum_acti) * np.diff(self.cum_flux) / np.diff(self.fine_edges)
+            return np.concatenate([[0.], np.cumsum(rate)])
+        raise ValueError(f"Unknown equal-statistics family '{family}'")
+
+
+def get_family_edges(evaluator, family, n_bins, rng = None):
+    '''
+    It returns the fine-grid edge indices of a binning of the family passed
+    with (at most) n_bins bins. Coinciding edges are removed.
+    '''
+    n_fine = evaluator.n_fine_bins
+    edges  = evaluator.fine_edges
+
+    if family == 'uniform':
+        indices = np.round(np.linspace(0, n_fine, n_bins + 1)).astype(int)
+    elif family == 'log':
+        if edges[0] <= 0:
+            raise ValueError("Log binnings need a positive lower energy")
+        indices = evaluator.edge_indices(np.geomspace(edges[0], edges[-1], n_bins + 1))
+    elif family == 'random':
+        rng      = np.random.default_rng() if rng is None else rng
+        interior = rng.choice(np.arange(1, n_fine), size = min(n_bins - 1, n_fine - 1),
+                              replace = False)
+        indices  = np.concatenate([[0], np.sort(interior), [n_fine]])
+    else:
+        cum_weights = evaluator.cumulative_weights(family)
+        targets     = np.linspace(0., cum_weights[-1], n_bins + 1)
+        indices     = np.searchsorted(cum_weights, targets)
+
+    indices[ 0] = 0
+    indices[-1] = n_fine
+    return np.unique(indices)
+
+
+def refine_by_merging(evaluator, edge_indices, min_bins = MIN_BINS):
+    '''
+    It greedily removes the interior edge (merging two bins) that most reduces
+    the relative error, while it keeps improving and there are more than
+    min_bins bins. Every step evaluates all the candidate merges at once.
+    '''
+    best     = np.asarray(edge_indices)
+    best_err = evaluator.relative_error(best)
+    while len(best) - 1 > max(min_bins, 1):
+        candidates = np.array([np.delete(best, i) for i in range(1, len(best) - 1)])
+        errors     = evaluator.relative_error(candidates)
+        if errors.min() >= best_err:
+            break
+        best, best_err = candidates[errors.argmin()], errors.min()
+    return best
+
+
+def scan_binnings(evaluator, min_bins = MIN_BINS, max_bins = 60, n_random = 2000,
+                  families = BINNING_FAMILIES, seed = None):
+    '''
+    It evaluates the binnings of every family with min_bins to max_bins bins
+    (n_random of them for the random family, with random numbers of bins).
+    Binnings left with fewer than min_bins bins (coinciding edges) are dropped.
+    It returns a DataFrame with the family, number of bins, total rate,
+    error, relative error and edges (GeV) of every binning, best first.
+    '''
+    rng = np.random.default_rng(seed)
+
+    binnings = []
+    for family in families:
+        if family == 'random':
+            for n_bins in rng.integers(min_bins, max_bins + 1, size = n_random):
+                binnings.append((family, get_family_edges(evaluator, family, n_bins, rng)))
+        else:
+            for n_bins in range(min_bins, max_bins + 1):
+                binnings.append((family, get_family_edges(evaluator, family, n_bins)))
+
+    ## Binnings with the same number of edges are evaluated together
+    n_edges = np.array([len(indices) for _, indices in binnings])
+    totals  = np.empty(len(binnings))
+    errors  = np.empty(len(binnings))
+    for n in np.unique(n_edges):
+        selected = np.flatnonzero(n_edges == n)
+        totals[selected], errors[selected] = evaluator.evaluate(
+            np.array([binnings[i][1] for i in selected]))
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        rel_errors = np.where(np.isfinite(errors), errors / totals, np.inf)
+
+    scan_df = pd.DataFrame({"family"        : [family for family, _ in binnings],
+                            "n_bins"        : n_edges - 1,
+                            "total_xe137PS" : totals,
+                            "perSec_err"    : errors,
+                            "rel_err"       : rel_errors,
+                            "edge_indices"  : [indices for _, indices in binnings]})
+    scan_df = scan_df[scan_df.n_bins >= min_bins]
+    scan_df = scan_df.drop_duplicates(subset = ["family", "n_bins", "rel_err"])
+    scan_df["bin_edges"] = [tuple(evaluator.bin_edges(indices)) for indices in scan_df.edge_indices]
+    return scan_df.sort_values("rel_err").reset_index(drop = True)
+
+
+def optimize_binning(conf_list, min_bins = MIN_BINS, max_bins = 60, n_random = 2000,
+                     fine_width = 1., refine = True, seed = None):
+    '''
+    It returns the bin edges (GeV) minimizing the relative error of the total
+    Xe137 rate among all the scanned binnings (see scan_binnings), refined
+    by greedy bin merging, and the DataFrame with every binning evaluated.
+    '''
+    evaluator = BinningEvaluator.from_config(conf_list, fine_width)
+    scan_df   = scan_binnings(evaluator, min_bins, max_bins, n_random, seed = seed)
+
+    best = scan_df.edge_indices.iloc[0]
+    if refine:
+        best = refine_by_merging(evaluator, best, min_bins)
+    return tuple(float(edge) for edge in evaluator.bin_edges(best)), scan_df
+
+
+if __name__ == '__main__':
+    xe137_normalization.FLUX_READ_WORKERS = None
+    best_edges, scan_df = optimize_binning(sys.argv)
+    print(scan_df[["family", "n_bins", "total_xe137PS", "perSec_err", "rel_err"]].head(10))
+    print('Best bin edges = ', ", ".join(f"{edge:g}" for edge in best_edges))
@@ -1,137 +1,284 @@
 import  os
+import re
 import sys
+import glob
+import hashlib
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses        import dataclass
+
+from typing import Tuple, Optional, Union, List
 
 import numpy  as np
 import pandas as pd
 
-import matplotlib.pyplot as plt
-
-from invisible_cities.core .configure     import            configure
+## matplotlib & invisible_cities configure are only imported when
+## plotting or parsing config files, so importing this module is cheap
 #from invisible_cities.icaro.hst_functions import shift_to_bin_centers
 
+try:
+    from instrumentation import instrument, span, traced_map
+except ImportError:
+    ## Run as a script from the muons directory: no instrumentation
+    import contextlib
+    def instrument(name = None):
+        return lambda function: function
+    def span(name, **args):
+        return contextlib.nullcontext()
+    def traced_map(executor, function, *iterables):
+        return executor.map(function, *iterables)
 
-def xe137_normalization(conf_list, spec_shift = 0,
-                        suppress_df = False):
 
-    config = configure(conf_list).as_namespace
+## Tables holding the muon energies in the flux files
+FLUX_TABLES    = ['muon_flux_' + str(i) for i in range(10)]
 
-    flux_file  = os.path.expandvars(config.flux_file)
-    acti_file  = os.path.expandvars(config.acti_file)
-    out_file   = os.path.expandvars(config.file_out)
-    sim_muons  = int(config.n_simulated_muons)
-    if not hasattr(config, 'log_bins'):
-        log_bins = False
-    else:
-        log_bins = bool(config.log_bins)
-    lab_flux   = float(config.lab_flux)
-    lab_flux_e = float(config.lab_flux_err)
-    gen_area   = float(config.gen_area)
+## Column with the activating muon energy (MeV) in the activation files,
+## read in chunks of ACTI_CHUNK_SIZE rows
+ACTI_COLUMN     = 'Xemunrg'
+ACTI_CHUNK_SIZE = 1000000
 
-    if hasattr(config, 'bin_edges'):
-        bins = config.bin_edges
-    else:
-        bin_range = config.bin_range
-        if log_bins:
-            bins = np.logspace(np.log10(bin_range[0]),
-                               np.log10(bin_range[0]), bin_range[2])
-        else:
-            bins = np.linspace(*bin_range)
+## Default location of the binned-flux cache (None disables it)
+FLUX_CACHE_DIR = os.environ.get('TONNE_FLUX_CACHE',
+                                os.path.join(os.path.expanduser('~'), '.cache', 'tonne', 'flux'))
 
-    binned_sim_muons, _ = np.histogram(np.random.uniform(bins[0]  ,
-                                                         bins[-1] ,
-                                                         sim_muons),
-                                       bins = bins)
+## Default number of processes reading the flux tables (None: one per CPU,
+## 1: read in this process). Library calls read in this process, as they may
+## already run in pool workers: the command-line scripts use one process per CPU
+FLUX_READ_WORKERS = 1
 
-    xe137_df = pd.read_hdf(acti_file)
-    xe137_df['GeV'] = xe137_df.Xemunrg * 1e-3
 
-    xe137_count, _ = np.histogram(xe137_df.GeV.values, bins = bins)
-    xe137_exp      = xe137_count / binned_sim_muons
-    xe137_exp_err  = xe137_exp * np.sqrt(1 / xe137_count + 1 / binned_sim_muons)
+@instrument()
+def get_binned_sim_muons(bins, sim_muons, sim_mode = 'expected', seed = None):
+    '''
+    It returns the number of simulated muons per energy bin, for sim_muons
+    generated uniformly in [bins[0], bins[-1]], using O(n_bins) memory.
+    sim_mode = 'expected' : exact (analytical) expectation per bin.
+    sim_mode = 'sampled'  : one multinomial draw, statistically identical to
+                            histogramming sim_muons uniform values.
+                            Reproducible for a given seed.
+    '''
+    bins       = np.asarray(bins, dtype = float)
+    bin_probs  = np.diff(bins) / (bins[-1] - bins[0])
 
-    ## Get flux in the same bins
-    for i in range(10):
+    if sim_mode == 'expected':
+        return sim_muons * bin_probs
 
-        vals = pd.read_hdf(flux_file, 'muon_flux_'+str(i))
+    if sim_mode == 'sampled':
+        rng = np.random.default_rng(seed)
+        return rng.multinomial(sim_muons, bin_probs)
 
-        histo, _ = np.histogram(vals.E.values + spec_shift, bins = bins)
+    raise ValueError(f"Unknown sim_mode '{sim_mode}' (expected|sampled)")
 
-        try:
-            flux_histo += histo
-        except NameError:
-            flux_histo  = histo
 
-    norm_flux = flux_histo / flux_histo.sum()
-    flux_err  = norm_flux * np.sqrt(1 / flux_histo + 1 / flux_histo.sum())
-    fluxCMS   = norm_flux * lab_flux
-    fluxCMS_e = fluxCMS * np.sqrt((flux_err / norm_flux)**2
-                                  + (lab_flux_e / lab_flux)**2)
-    fluxS     = fluxCMS * gen_area
-    fluxS_e   = gen_area * fluxCMS_e
-    xe137S    = xe137_exp * fluxS ## Xe137 per bin per second
-    xe137S_e  = xe137S * np.sqrt((xe137_exp_err / xe137_exp)**2
-                                 + (fluxS_e / fluxS)**2)
-    xe137Y    = xe137S * 3.1536e7
-    xe137Y_e  = xe137S_e * 3.1536e7
+@instrument()
+def read_flux_energies(flux_file, table):
+    '''
+    It returns the muon energies stored in one table of the flux file.
+    Only the 'E' column is loaded when the table format allows it.
+    '''
+    try:
+        vals = pd.read_hdf(flux_file, table, columns = ['E'])
+    except TypeError:
+        ## Fixed format stores can only be read in their entirety
+        vals = pd.read_hdf(flux_file, table)
+    return vals.E.values
 
-    total_xe137PS = xe137S.sum()
-    perSec_err    = np.sqrt(np.sum(xe137S_e**2))
-    total_xe137PY = xe137Y.sum()
-    perYr_err     = np.sqrt(np.sum(xe137Y_e**2))
-    print('Xe-137 per second = ', total_xe137PS, '+/-', perSec_err)
-    print('Xe-137 per calendar yr = ', total_xe137PY, '+/-', perYr_err)
 
-    if suppress_df:
-        ## Optimisation or error calc,
-        ## just return the per sec prediction
-        return total_xe137PS, perSec_err
+@instrument()
+def histogram_flux_table(flux_file, table, bins, spec_shifts = (0,)):
+    '''
+    It returns the histograms of the muon energies of one flux table,
+    one row per spectral shift. Energies are sorted once, and every shift
+    only costs a searchsorted of the bin edges.
+    '''
+    energies = read_flux_energies(flux_file, table)
+    with span('sort_flux_energies', table = table):
+        energies = np.sort(energies)
+    bins     = np.asarray(bins, dtype = float)
 
+    ## E + shift in [low, high)  <=>  E in [low - shift, high - shift)
+    ## (the last bin is closed, as in np.histogram)
+    shifted_edges = bins[np.newaxis, :] - np.asarray(spec_shifts, dtype = float)[:, np.newaxis]
+    cumulative    = np.searchsorted(energies, shifted_edges, side = 'left')
+    cumulative[:, -1] = np.searchsorted(energies, shifted_edges[:, -1], side = 'right')
+    return np.diff(cumulative, axis = 1)
 
-    plt.errorbar(shift_to_bin_centers(bins), xe137Y, fmt='^',
-                 xerr = np.diff(bins) / 2, yerr = xe137Y_e)
-    plt.xlabel('Muon energy (GeV)')
-    plt.ylabel('Xe-137 expectation per yr per bin')
-    plt.show()
-    
-    ## Output the calculation at each stage to file
-    df = pd.DataFrame({"BinMin"         :     bins[:-1],
-                       "BinMax"         :      bins[1:],
-                       "n_xe137"        :   xe137_count,
-                       "xe137PerMu"     :     xe137_exp,
-                       "Err137PerMu"    : xe137_exp_err,
-                       "NormFlux"       :     norm_flux,
-                       "FluxErr"        :      flux_err,
-                       "FluxPerCM2PerS" :       fluxCMS,
-                       "FluxAreaSErr"   :     fluxCMS_e,
-                       "FluxPerS"       :         fluxS,
-                       "FluxSErr"       :       fluxS_e,
-                       "xe137PerS"      :        xe137S,
-                       "xe137SErr"      :      xe137S_e,
-                       "xe137PerY"      :        xe137Y,
-                       "xe137YErr"      :      xe137Y_e})
 
-    df.to_hdf(out_file, 'xe137')
+def flux_cache_key(flux_file, bins, spec_shift):
+    '''
+    It returns the cache key of a binned flux: flux file path & mtime,
+    bin edges and spectral shift.
+    '''
+    file_stat = os.stat(flux_file)
+    key_text  = repr((os.path.abspath(flux_file), file_stat.st_mtime_ns, file_stat.st_size,
+                      tuple(np.asarray(bins, dtype = float).tolist()), float(spec_shift)))
+    return hashlib.sha1(key_text.encode()).hexdigest()
 
 
+@instrument()
+def get_flux_histograms(flux_file, bins, spec_shifts,
+                        cache_dir = FLUX_CACHE_DIR, n_workers = None):
+    '''
+    It returns the muon flux histograms in the bins passed, one row per
+    spectral shift, adding up all the flux tables. Tables are read &
+    histogrammed concurrently in a single pass for all the shifts not found
+    in the on-disk cache (if cache_dir is not None), and the new histograms
+    are added to the cache, so later calls do not read the flux file at all.
+    n_workers = 1 reads the tables in this process (default: FLUX_READ_WORKERS).
+    '''
+    if n_workers is None:
+        n_workers = FLUX_READ_WORKERS
+    spec_shifts = np.atleast_1d(np.asarray(spec_shifts, dtype = float))
+    flux_histos = np.zeros((len(spec_shifts), len(bins) - 1), dtype = np.int64)
+
+    cache_files = [None] * len(spec_shifts)
+    missing     = np.ones(len(spec_shifts), dtype = bool)
+    if cache_dir is not None:
+        with span('read_flux_cache'):
+            for i, spec_shift in enumerate(spec_shifts):
+                cache_files[i] = os.path.join(cache_dir,
+                                              flux_cache_key(flux_file, bins, spec_shift) + '.npy')
+                if os.path.isfile(cache_files[i]):
+                    flux_histos[i] = np.load(cache_files[i])
+                    missing    [i] = False
+
+    if not missing.any():
+        return flux_histos
+
+    table_args = ([flux_file]            * len(FLUX_TABLES), FLUX_TABLES,
+                  [bins]                 * len(FLUX_TABLES),
+                  [spec_shifts[missing]] * len(FLUX_TABLES))
+    with span('histogram_flux_tables', n_shifts = int(missing.sum())):
+        if n_workers == 1:
+            ## Tables read one after the other in this process
+            flux_histos[missing] = sum(map(histogram_flux_table, *table_args))
+        else:
+            with ProcessPoolExecutor(max_workers = n_workers) as executor:
+                ## Spans of the workers (flux reads, sorting) are merged into this process
+                flux_histos[missing] = sum(traced_map(executor, histogram_flux_table, *table_args))
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok = True)
+        for i in np.flatnonzero(missing):
+            tmp_file = f'{cache_files[i]}.{os.getpid()}.tmp.npy'
+            np.save(tmp_file, flux_histos[i])
+            os.replace(tmp_file, cache_files[i])
+
+    return flux_histos
+
 
-def xe137_activation_prob(conf_list, spec_shift = 0):
+def get_flux_histogram(flux_file, bins, spec_shift = 0,
+                       cache_dir = FLUX_CACHE_DIR, n_workers = None):
     '''
-    It returns the translation factor from muon to Xe137
+    It returns the muon flux histogram in the bins passed for a single
+    spectral shift (see get_flux_histograms).
     '''
+    return get_flux_histograms(flux_file, bins, [spec_shift],
+                               cache_dir, n_workers)[0]
+
+
+def get_activation_files(acti_file):
+    '''
+    It returns the list of activation files passed as a file name,
+    a glob pattern or a list of them (every pattern sorted).
+    '''
+    patterns   = [acti_file] if isinstance(acti_file, str) else list(acti_file)
+    acti_files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expandvars(pattern)))
+        if not matches:
+            raise FileNotFoundError(f"No activation file matches '{pattern}'")
+        acti_files.extend(matches)
+    return acti_files
+
+
+def get_n_simulated_muons(acti_files, n_simulated_muons = None):
+    '''
+    It returns the total number of simulated muons of the activation files:
+    n_simulated_muons if it is a number, the sum of its items if it is a list
+    (one per file) or, if it is None, the sum of the numbers in the file
+    names (..._sim<N>muons...).
+    '''
+    if n_simulated_muons is None:
+        n_per_file = []
+        for acti_file in acti_files:
+            match = re.search(r'sim(\d+)muons', os.path.basename(acti_file))
+            if match is None:
+                raise ValueError(f"Number of simulated muons not found in '{acti_file}'")
+            n_per_file.append(int(match.group(1)))
+        return sum(n_per_file)
+
+    if np.ndim(n_simulated_muons) == 0:
+        return int(n_simulated_muons)
+
+    if len(n_simulated_muons) != len(acti_files):
+        raise ValueError(f"{len(n_simulated_muons)} numbers of simulated muons "
+                         f"for {len(acti_files)} activation files")
+    return int(sum(n_simulated_muons))
 
-    config = configure(conf_list).as_namespace
 
-    flux_file  = os.path.expandvars(config.flux_file)
-    acti_file  = os.path.expandvars(config.acti_file)
-    out_file   = os.path.expandvars(config.file_out)
-    sim_muons  = int(config.n_simulated_muons)
+def iter_activation_energies(acti_file, chunk_size = ACTI_CHUNK_SIZE):
+    '''
+    It yields the activating muon energies (MeV) of one activation file
+    in chunks of chunk_size, reading only that column. Table stores are
+    read with select, fixed stores slicing the block holding the column.
+    '''
+    with pd.HDFStore(acti_file, mode = 'r') as store:
+        keys = store.keys()
+        if len(keys) != 1:
+            raise ValueError(f"'{acti_file}' must hold a single dataset, it holds {len(keys)}")
+        storer = store.get_storer(keys[0])
+
+        if storer.is_table:
+            for chunk in store.select(keys[0], columns = [ACTI_COLUMN], chunksize = chunk_size):
+                yield chunk[ACTI_COLUMN].values
+            return
+
+        group = storer.group
+        for i in range(group._v_attrs.nblocks):
+            items = [item.decode() if isinstance(item, bytes) else item
+                     for item in getattr(group, f'block{i}_items')[:]]
+            if ACTI_COLUMN not in items:
+                continue
+
+            ## pandas stores the block values transposed: one row per entry
+            values = getattr(group, f'block{i}_values')
+            column = items.index(ACTI_COLUMN)
+            if getattr(values.attrs, 'transposed', True):
+                for first in range(0, values.shape[0], chunk_size):
+                    yield values[first:first + chunk_size, column]
+            else:
+                for first in range(0, values.shape[1], chunk_size):
+                    yield values[column, first:first + chunk_size]
+            return
+
+        raise KeyError(f"Column '{ACTI_COLUMN}' not found in '{acti_file}'")
+
+
+@instrument()
+def histogram_activation_files(acti_files, bins, chunk_size = ACTI_CHUNK_SIZE):
+    '''
+    It returns the histogram, in the muon energy bins passed (GeV), of the
+    activating muon energies of all the activation files. Files are read
+    in chunks, so memory does not grow with the number of activations.
+    '''
+    ## Energies are in MeV: the bins are scaled instead of every energy
+    bins_mev    = np.asarray(bins, dtype = float) * 1e3
+    xe137_count = np.zeros(len(bins_mev) - 1, dtype = np.int64)
+    for acti_file in get_activation_files(acti_files):
+        for energies in iter_activation_energies(acti_file, chunk_size):
+            xe137_count += np.histogram(energies, bins = bins_mev)[0]
+    return xe137_count
+
+
+def get_bin_edges(config):
+    '''
+    It returns the muon energy bin edges defined in the config.
+    '''
     if not hasattr(config, 'log_bins'):
         log_bins = False
     else:
         log_bins = bool(config.log_bins)
-    lab_flux   = float(config.lab_flux)
-    lab_flux_e = float(config.lab_flux_err)
-    gen_area   = float(config.gen_area)
 
     if hasattr(config, 'bin_edges'):
         bins = config.bin_edges
@@ -142,33 +289,82 @@ def xe137_activation_prob(conf_list, spec_shift = 0):
                                np.log10(bin_range[0]), bin_range[2])
         else:
             bins = np.linspace(*bin_range)
+    return bins
 
-    binned_sim_muons, _ = np.histogram(np.random.uniform(bins[0]  ,
-                                                         bins[-1] ,
-                                                         sim_muons),
-                                       bins = bins)
-
-    xe137_df = pd.read_hdf(acti_file)
-    xe137_df['GeV'] = xe137_df.Xemunrg * 1e-3
 
-    xe137_count, _ = np.histogram(xe137_df.GeV.values, bins = bins)
-    xe137_exp      = xe137_count / binned_sim_muons
-    xe137_exp_err  = xe137_exp * np.sqrt(1 / xe137_count + 1 / binned_sim_muons)
-
-    ## Get flux in the same bins
-    for i in range(10):
-
-        vals = pd.read_hdf(flux_file, 'muon_flux_'+str(i))
-
-        histo, _ = np.histogram(vals.E.values + spec_shift, bins = bins)
+@dataclass(frozen = True)
+class MuonConfig:
+    '''
+    In-memory muon normalization settings, with the same entries (and units)
+    as the muons config files: fluxes in cm**-2 s**-1 and areas in cm**2.
+    acti_file may be a glob pattern or a list of files, and n_simulated_muons
+    a total, a list (one per file) or None (taken from the file names).
+    '''
+    flux_file         : str
+    acti_file         : Union[str, Tuple[str, ...]]
+    file_out          : str
+    n_simulated_muons : Union[int, Tuple[int, ...], None]
+    bin_edges         : Tuple[float, ...]
+    lab_flux          : float
+    lab_flux_err      : float
+    gen_area          : float
+    sim_muons_mode    : str           = 'expected'
+    seed              : Optional[int] = None
+    flux_cache_dir    : Optional[str] = FLUX_CACHE_DIR
+    n_read_workers    : Optional[int] = None
+    acti_chunk_size   : int           = ACTI_CHUNK_SIZE
+
+
+@instrument()
+def read_muon_config(conf_list : Union[List[str], MuonConfig]) -> MuonConfig:
+    '''
+    It returns the MuonConfig corresponding to conf_list, an argv-like list
+    whose second item is a muons config file. MuonConfig objects are
+    returned untouched.
+    '''
+    if isinstance(conf_list, MuonConfig):
+        return conf_list
 
-        try:
-            flux_histo += histo
-        except NameError:
-            flux_histo  = histo
+    from invisible_cities.core.configure import configure
+    config = configure(conf_list).as_namespace
 
-    norm_flux = flux_histo / flux_histo.sum()
-    flux_err  = norm_flux * np.sqrt(1 / flux_histo + 1 / flux_histo.sum())
+    acti_file         = config.acti_file
+    n_simulated_muons = getattr(config, 'n_simulated_muons', None)
+    if isinstance(acti_file, str):
+        acti_file = os.path.expandvars(acti_file)
+    else:
+        acti_file = tuple(os.path.expandvars(name) for name in acti_file)
+    if (n_simulated_muons is not None) and (np.ndim(n_simulated_muons) > 0):
+        n_simulated_muons = tuple(int(n_muons) for n_muons in n_simulated_muons)
+    elif n_simulated_muons is not None:
+        n_simulated_muons = int(n_simulated_muons)
+
+    return MuonConfig(flux_file         = os.path.expandvars(config.flux_file),
+                      acti_file         = acti_file,
+                      file_out          = os.path.expandvars(config.file_out),
+                      n_simulated_muons = n_simulated_muons,
+                      bin_edges         = tuple(float(edge) for edge in get_bin_edges(config)),
+                      lab_flux          = float(config.lab_flux),
+                      lab_flux_err      = float(config.lab_flux_err),
+                      gen_area          = float(config.gen_area),
+                      sim_muons_mode    = getattr(config, 'sim_muons_mode', 'expected'),
+                      seed              = getattr(config, 'seed', None),
+                      flux_cache_dir    = getattr(config, 'flux_cache_dir', FLUX_CACHE_DIR),
+                      n_read_workers    = getattr(config, 'n_read_workers', None),
+                      acti_chunk_size   = getattr(config, 'acti_chunk_size', ACTI_CHUNK_SIZE))
+
+
+@instrument()
+def compute_xe137_rates(xe137_exp, xe137_exp_err, flux_histo,
+                        lab_flux, lab_flux_e, gen_area):
+    '''
+    It returns a dictionary with the per-bin Xe137 production rates (and
+    all the intermediate quantities) and their totals per second & year.
+    Bins are the last axis, so flux_histo may hold one row per spectral shift.
+    '''
+    flux_sum  = flux_histo.sum(axis = -1, keepdims = True)
+    norm_flux = flux_histo / flux_sum
+    flux_err  = norm_flux * np.sqrt(1 / flux_histo + 1 / flux_sum)
     fluxCMS   = norm_flux * lab_flux
     fluxCMS_e = fluxCMS * np.sqrt((flux_err / norm_flux)**2
                                   + (lab_flux_e / lab_flux)**2)
@@ -180,15 +376,217 @@ def xe137_activation_prob(conf_list, spec_shift = 0):
     xe137Y    = xe137S * 3.1536e7
     xe137Y_e  = xe137S_e * 3.1536e7
 
-    total_xe137PS = xe137S.sum()
-    perSec_err    = np.sqrt(np.sum(xe137S_e**2))
-    total_xe137PY = xe137Y.sum()
-    perYr_err     = np.sqrt(np.sum(xe137Y_e**2))
+    return {"NormFlux"       : norm_flux,
+            "FluxErr"        : flux_err,
+            "FluxPerCM2PerS" : fluxCMS,
+            "FluxAreaSErr"   : fluxCMS_e,
+            "FluxPerS"       : fluxS,
+            "FluxSErr"       : fluxS_e,
+            "xe137PerS"      : xe137S,
+            "xe137SErr"      : xe137S_e,
+            "xe137PerY"      : xe137Y,
+            "xe137YErr"      : xe137Y_e,
+            "total_xe137PS"  : xe137S.sum(axis = -1),
+            "perSec_err"     : np.sqrt(np.sum(xe137S_e**2, axis = -1)),
+            "total_xe137PY"  : xe137Y.sum(axis = -1),
+            "perYr_err"      : np.sqrt(np.sum(xe137Y_e**2, axis = -1))}
+
+
+## Per-bin columns of the normalization table written to file_out
+OUT_COLUMNS = ["n_xe137", "xe137PerMu", "Err137PerMu", "NormFlux", "FluxErr",
+               "FluxPerCM2PerS", "FluxAreaSErr", "FluxPerS", "FluxSErr",
+               "xe137PerS", "xe137SErr", "xe137PerY", "xe137YErr"]
+
+
+@dataclass(frozen = True)
+class Xe137Rates:
+    '''
+    Xe137 production rates from muons for a set of configurations
+    (lab_flux, lab_flux_err, gen_area). Per-bin quantities (per_bin, with
+    the OUT_COLUMNS keys) have shape (n_configs, n_bins) and totals
+    (per second & per calendar year) have shape (n_configs,).
+    '''
+    bin_edges     : np.ndarray
+    lab_flux      : np.ndarray
+    lab_flux_err  : np.ndarray
+    gen_area      : np.ndarray
+    per_bin       : dict
+    total_xe137PS : np.ndarray
+    perSec_err    : np.ndarray
+    total_xe137PY : np.ndarray
+    perYr_err     : np.ndarray
+
+    def __len__(self):
+        return len(self.lab_flux)
+
+    def to_dataframe(self, config_index = 0):
+        '''
+        It returns the per-bin table of one configuration
+        (the calculation at each stage, as written to file_out).
+        '''
+        table = {"BinMin" : self.bin_edges[:-1],
+                 "BinMax" : self.bin_edges[1:]}
+        table.update({column : self.per_bin[column][config_index]
+                      for column in OUT_COLUMNS})
+        return pd.DataFrame(table)
+
+    def totals(self):
+        '''
+        It returns a DataFrame with the total rates of every configuration.
+        '''
+        return pd.DataFrame({"lab_flux"     : self.lab_flux,
+                             "lab_flux_err" : self.lab_flux_err,
+                             "gen_area"     : self.gen_area,
+                             "xe137PerS"    : self.total_xe137PS,
+                             "xe137PerSErr" : self.perSec_err,
+                             "xe137PerY"    : self.total_xe137PY,
+                             "xe137PerYErr" : self.perYr_err})
+
+
+def get_xe137_per_muon(config, sim_mode = None, seed = None):
+    '''
+    It returns the Xe137 activations per energy bin, and the activation
+    probability per simulated muon (and its error) in the config bins.
+    '''
+    acti_files = get_activation_files(config.acti_file)
+    sim_muons  = get_n_simulated_muons(acti_files, config.n_simulated_muons)
+    bins       = np.asarray(config.bin_edges)
+
+    if sim_mode is None:
+        sim_mode = config.sim_muons_mode
+    if seed is None:
+        seed = config.seed
+    binned_sim_muons = get_binned_sim_muons(bins, sim_muons, sim_mode, seed)
+
+    xe137_count    = histogram_activation_files(acti_files, bins, config.acti_chunk_size)
+    xe137_exp      = xe137_count / binned_sim_muons
+    xe137_exp_err  = xe137_exp * np.sqrt(1 / xe137_count + 1 / binned_sim_muons)
+    return xe137_count, xe137_exp, xe137_exp_err
+
+
+@instrument()
+def xe137_normalization_kernel(conf_list, lab_flux = None, lab_flux_err = None,
+                               gen_area = None, spec_shift = 0,
+                               sim_mode = None, seed = None):
+    '''
+    It computes the Xe137 production rates from muons for every configuration
+    given by the (broadcast) arrays lab_flux, lab_flux_err (cm**-2 s**-1)
+    and gen_area (cm**2), the config values being used for those not passed.
+    The activation and flux histograms are built only once, so any number
+    of labs & detectors sharing the muon files costs a single evaluation.
+    It returns an Xe137Rates.
+    '''
+    config = read_muon_config(conf_list)
+    bins   = np.asarray(config.bin_edges, dtype = float)
+
+    xe137_count, xe137_exp, xe137_exp_err = get_xe137_per_muon(config, sim_mode, seed)
+
+    ## Get flux in the same bins
+    flux_histo = get_flux_histogram(config.flux_file, bins, spec_shift,
+                                    cache_dir = config.flux_cache_dir,
+                                    n_workers = config.n_read_workers)
+
+    lab_flux, lab_flux_err, gen_area = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(default if value is None else value, dtype = float))
+          for value, default in ((lab_flux    , config.lab_flux    ),
+                                 (lab_flux_err, config.lab_flux_err),
+                                 (gen_area    , config.gen_area    ))])
+
+    ## Configurations on the first axis, bins on the last one
+    rates = compute_xe137_rates(xe137_exp, xe137_exp_err, flux_histo,
+                                lab_flux    [:, np.newaxis],
+                                lab_flux_err[:, np.newaxis],
+                                gen_area    [:, np.newaxis])
+
+    shape   = (len(lab_flux), len(bins) - 1)
+    per_bin = {"n_xe137"     : xe137_count,
+               "xe137PerMu"  : xe137_exp,
+               "Err137PerMu" : xe137_exp_err}
+    per_bin.update({column : rates[column] for column in OUT_COLUMNS[3:]})
+
+    return Xe137Rates(bin_edges     = bins,
+                      lab_flux      = lab_flux,
+                      lab_flux_err  = lab_flux_err,
+                      gen_area      = gen_area,
+                      per_bin       = {column : np.broadcast_to(values, shape)
+                                       for column, values in per_bin.items()},
+                      total_xe137PS = rates["total_xe137PS"],
+                      perSec_err    = rates["perSec_err"],
+                      total_xe137PY = rates["total_xe137PY"],
+                      perYr_err     = rates["perYr_err"])
+
+
+@instrument()
+def xe137_spectral_shift_scan(conf_list, spec_shifts,
+                              sim_mode = None, seed = None):
+    '''
+    It returns the Xe137 production rate (per second & per calendar year)
+    and its error for every spectral shift of the muon energies passed.
+    The flux file is read (at most) once for the whole scan.
+    '''
+    config = read_muon_config(conf_list)
+    bins   = np.asarray(config.bin_edges)
+
+    _, xe137_exp, xe137_exp_err = get_xe137_per_muon(config, sim_mode, seed)
+
+    flux_histos = get_flux_histograms(config.flux_file, bins, spec_shifts,
+                                      cache_dir = config.flux_cache_dir,
+                                      n_workers = config.n_read_workers)
+
+    rates = compute_xe137_rates(xe137_exp, xe137_exp_err, flux_histos,
+                                config.lab_flux, config.lab_flux_err, config.gen_area)
+
+    return pd.DataFrame({"spec_shift"   : np.atleast_1d(spec_shifts),
+                         "xe137PerS"    : rates["total_xe137PS"],
+                         "xe137PerSErr" : rates["perSec_err"],
+                         "xe137PerY"    : rates["total_xe137PY"],
+                         "xe137PerYErr" : rates["perYr_err"]})
+
+
+@instrument()
+def xe137_normalization(conf_list, spec_shift = 0,
+                        suppress_df = False, sim_mode = None, seed = None):
+    '''
+    It computes the Xe137 production rate from muons.
+    conf_list is either an argv-like list with a muons config file
+    or an in-memory MuonConfig.
+    '''
+    config = read_muon_config(conf_list)
+    rates  = xe137_normalization_kernel(config, spec_shift = spec_shift,
+                                        sim_mode = sim_mode, seed = seed)
+
+    total_xe137PS, perSec_err = rates.total_xe137PS[0], rates.perSec_err[0]
     print('Xe-137 per second = ', total_xe137PS, '+/-', perSec_err)
-    print('Xe-137 per calendar yr = ', total_xe137PY, '+/-', perYr_err)
+    print('Xe-137 per calendar yr = ', rates.total_xe137PY[0], '+/-', rates.perYr_err[0])
 
-    return total_xe137PS, perSec_err
+    if suppress_df:
+        ## Optimisation or error calc,
+        ## just return the per sec prediction
+        return total_xe137PS, perSec_err
+
+    bins = rates.bin_edges
+
+    import matplotlib.pyplot as plt
+    plt.errorbar((bins[1:] + bins[:-1]) / 2, rates.per_bin['xe137PerY'][0], fmt='^',
+                 xerr = np.diff(bins) / 2, yerr = rates.per_bin['xe137YErr'][0])
+    plt.xlabel('Muon energy (GeV)')
+    plt.ylabel('Xe-137 expectation per yr per bin')
+    plt.show()
+
+    ## Output the calculation at each stage to file
+    rates.to_dataframe(0).to_hdf(config.file_out, key = 'xe137')
+
+
+@instrument()
+def xe137_activation_prob(conf_list, spec_shift = 0,
+                          sim_mode = None, seed = None):
+    '''
+    It returns the translation factor from muon to Xe137
+    '''
+    return xe137_normalization(conf_list, spec_shift, suppress_df = True,
+                               sim_mode = sim_mode, seed = seed)
 
 
 if __name__ == '__main__':
+    FLUX_READ_WORKERS = None
     xe137_normalization(sys.argv)
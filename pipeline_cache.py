@@ -0,0 +1,437 @@
+# General importings
+import os
+import sys
+import types
+import pickle
+import hashlib
+import tempfile
+import argparse
+import functools
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any, Optional, Callable, Mapping
+
+# Specific TONNE stuff
+import initial_activities
+import detector_dimensions
+import detector_backgrounds
+import rejection_factors
+import muons.xe137_normalization
+
+
+#####################################################################
+### Default location & size (bytes) of the pipeline cache (None dir disables it)
+PIPELINE_CACHE_DIR = os.environ.get('TONNE_PIPELINE_CACHE',
+                                    os.path.join(os.path.expanduser('~'), '.cache', 'tonne', 'pipeline'))
+PIPELINE_CACHE_SIZE = int(os.environ.get('TONNE_PIPELINE_CACHE_SIZE', 512 * 1024**2))
+
+### Files larger than this are identified by (size, mtime) instead of by their contents
+MAX_HASHED_FILE_SIZE = 64 * 1024**2
+
+CACHE_FILE_EXT = '.pkl'
+
+
+
+#####################################################################
+@functools.lru_cache(maxsize=None)
+def _file_digest(file_name : str,
+                 size      : int,
+                 mtime_ns  : int
+                )         -> str:
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as ifile:
+        for block in iter(lambda: ifile.read(1024**2), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+
+#####################################################################
+def file_signature(file_name: str) -> Tuple[Any, ...]:
+    '''
+    It returns the signature of an input file: its path, size & mtime,
+    and its contents hash for files up to MAX_HASHED_FILE_SIZE.
+    '''
+    file_stat = os.stat(file_name)
+    signature = (os.path.abspath(file_name), file_stat.st_size, file_stat.st_mtime_ns)
+    if file_stat.st_size <= MAX_HASHED_FILE_SIZE:
+        signature += (_file_digest(*signature),)
+    return signature
+
+
+
+#####################################################################
+def module_signature(module: Any) -> Tuple[Any, ...]:
+    '''
+    It returns the signature of the source file of the module passed,
+    so that code changes invalidate its cached results.
+    '''
+    return file_signature(module.__file__)
+
+
+
+#####################################################################
+def get_cache_key(stage  : str,
+                  inputs : Any
+                 )      -> str:
+    '''
+    It returns the cache key of a stage: a hash of the stage name and its inputs
+    (anything with a deterministic repr: strings, numbers, tuples, dicts ...).
+    '''
+    return stage + '-' + hashlib.sha1(repr((stage, inputs)).encode()).hexdigest()
+
+
+
+#####################################################################
+class PipelineCache:
+    '''
+    Content-addressed on-disk cache of pipeline stage results (pickles),
+    bounded to max_size bytes by evicting the least recently used entries.
+    '''
+
+    def __init__(self,
+                 cache_dir : str = PIPELINE_CACHE_DIR,
+                 max_size  : int = PIPELINE_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size  = max_size
+
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + CACHE_FILE_EXT)
+
+
+    def entries(self) -> List[Tuple[str, int, float]]:
+        '''
+        It returns the (file name, size, last use time) of every entry,
+        least recently used first.
+        '''
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(CACHE_FILE_EXT):
+                try:
+                    file_stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.path, file_stat.st_size, file_stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        '''
+        It returns (found, value) for the key passed, marking the entry as used.
+        '''
+        file_name = self._path(key)
+        try:
+            with open(file_name, 'rb') as ifile:
+                value = pickle.load(ifile)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False, None
+        try:
+            os.utime(file_name)
+        except FileNotFoundError:
+            pass
+        return True, value
+
+
+    def put(self,
+            key   : str,
+            value : Any
+           )     -> None:
+        '''
+        It stores the value passed (atomically) and evicts old entries if needed.
+        '''
+        os.makedirs(self.cache_dir, exist_ok=True)
+        file_name     = self._path(key)
+        tmp_file_name = f'{file_name}.{os.getpid()}.tmp'
+        with open(tmp_file_name, 'wb') as ofile:
+            pickle.dump(value, ofile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file_name, file_name)
+        self.evict()
+
+
+    def evict(self) -> int:
+        '''
+        It removes the least recently used entries until the cache fits in max_size.
+        It returns the number of entries removed.
+        '''
+        entries    = self.entries()
+        total_size = sum(size for _, size, _ in entries)
+        n_removed  = 0
+        for file_name, size, _ in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            n_removed  += 1
+        return n_removed
+
+
+    def get_or_compute(self,
+                       stage   : str,
+                       inputs  : Any,
+                       compute : Callable[[], Any]
+                      )       -> Any:
+        '''
+        It returns the cached result of the stage for the inputs passed,
+        running compute() (and caching its result) on a miss.
+        '''
+        key          = get_cache_key(stage, inputs)
+        found, value = self.get(key)
+        if not found:
+            value = compute()
+            self.put(key, value)
+        return value
+
+
+    def clear(self) -> int:
+        '''
+        It removes every entry. It returns the number of entries removed.
+        '''
+        entries = self.entries()
+        for file_name, _, _ in entries:
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+        return len(entries)
+
+
+    def info(self) -> pd.DataFrame:
+        '''
+        It returns a DataFrame with the number of entries and size (bytes) per stage.
+        '''
+        entries = self.entries()
+        info_df = pd.DataFrame({
+            'stage'   : [os.path.basename(name).rsplit('-', 1)[0] for name, _, _ in entries],
+            'size'    : [size for _, size, _ in entries],
+            'last_use': [pd.Timestamp(mtime, unit='s') for _, _, mtime in entries]})
+        return info_df.groupby('stage').agg(entries  = ('size', 'size'),
+                                            size     = ('size', 'sum'),
+                                            last_use = ('last_use', 'max'))
+
+
+
+#####################################################################
+def get_pipeline_cache(cache_dir : Optional[str] = PIPELINE_CACHE_DIR,
+                       max_size  : int = PIPELINE_CACHE_SIZE
+                      )         -> Optional[PipelineCache]:
+    '''
+    It returns the pipeline cache (None if cache_dir is None).
+    '''
+    return None if cache_dir is None else PipelineCache(cache_dir, max_size)
+
+
+
+#####################################################################
+def _cached(stage     : str,
+            inputs    : Any,
+            compute   : Callable[[], Any],
+            cache_dir : Optional[str]
+           )         -> Any:
+    cache = get_pipeline_cache(cache_dir)
+    return compute() if cache is None else cache.get_or_compute(stage, inputs, compute)
+
+
+
+#####################################################################
+def _current_dimensions(compute: Callable[[], Any]) -> Callable[[], Any]:
+    '''
+    It returns compute run after clearing the memoized detector dimensions, so results
+    computed on a miss use the detector_dimensions values hashed into the cache key
+    (even after they are edited in-process).
+    '''
+    def compute_current() -> Any:
+        detector_dimensions.get_dimensions.cache_clear()
+        return compute()
+    return compute_current
+
+
+
+#####################################################################
+### Inputs of every stage
+def get_dimensions_inputs(det_name: str) -> Tuple[Any, ...]:
+    return (det_name, detector_dimensions.detector_dimensions[det_name],
+            module_signature(detector_dimensions))
+
+
+def get_radiogenic_inputs(det_name               : str,
+                          radiogenic_bkgnd_level : str
+                         )                      -> Tuple[Any, ...]:
+    return (get_dimensions_inputs(det_name), radiogenic_bkgnd_level,
+            initial_activities.radiogenic_activity[radiogenic_bkgnd_level],
+            detector_backgrounds.radiogenic_components,
+            module_signature(initial_activities), module_signature(detector_backgrounds))
+
+
+def get_radon_inputs(det_name          : str,
+                     radon_bkgnd_level : str
+                    )                 -> Tuple[Any, ...]:
+    return (get_dimensions_inputs(det_name), radon_bkgnd_level,
+            initial_activities.radon_activity[radon_bkgnd_level],
+            module_signature(initial_activities), module_signature(detector_backgrounds))
+
+
+def get_muon_inputs(det_name    : str,
+                    hosting_lab : str
+                   )           -> Tuple[Any, ...]:
+    lab_files = detector_backgrounds.muon_files[hosting_lab]
+    return (get_dimensions_inputs(det_name), hosting_lab,
+            initial_activities.muon_flux[hosting_lab],
+            initial_activities.muon_flux_error[hosting_lab],
+            lab_files, detector_backgrounds.MUON_BIN_EDGES,
+            file_signature(lab_files['flux_file']),
+            tuple(file_signature(acti_file) for acti_file
+                  in muons.xe137_normalization.get_activation_files(lab_files['acti_file'])),
+            module_signature(initial_activities), module_signature(detector_backgrounds),
+            module_signature(muons.xe137_normalization))
+
+
+def get_rejection_inputs(det_name: str) -> Tuple[Any, ...]:
+    return (det_name, file_signature(rejection_factors.get_rejection_file_name(det_name)),
+            module_signature(rejection_factors))
+
+
+
+#####################################################################
+def cached_get_dimensions(det_name  : str,
+                          cache_dir : Optional[str] = PIPELINE_CACHE_DIR
+                         )         -> Mapping[str, float]:
+    '''
+    Cached version of detector_dimensions.get_dimensions.
+    '''
+    dimensions = _cached('dimensions', get_dimensions_inputs(det_name),
+                         lambda: {key: float(value) for key, value in
+                                  detector_dimensions.get_dimensions_array(
+                                      **detector_dimensions.detector_dimensions[det_name]).items()},
+                         cache_dir)
+    return types.MappingProxyType(dimensions)
+
+
+
+#####################################################################
+def cached_get_radiogenic_background_level(det_name               : str,
+                                           radiogenic_bkgnd_level : str,
+                                           cache_dir              : Optional[str] = PIPELINE_CACHE_DIR
+                                          )                      -> pd.DataFrame:
+    '''
+    Cached version of detector_backgrounds.get_radiogenic_background_level.
+    '''
+    return _cached('radiogenic', get_radiogenic_inputs(det_name, radiogenic_bkgnd_level),
+                   _current_dimensions(lambda: detector_backgrounds.get_radiogenic_background_level(
+                                           det_name, radiogenic_bkgnd_level)),
+                   cache_dir)
+
+
+
+#####################################################################
+def cached_get_radon_background_level(det_name          : str,
+                                      radon_bkgnd_level : str,
+                                      cache_dir         : Optional[str] = PIPELINE_CACHE_DIR
+                                     )                 -> float:
+    '''
+    Cached version of detector_backgrounds.get_radon_background_level.
+    '''
+    return _cached('radon', get_radon_inputs(det_name, radon_bkgnd_level),
+                   _current_dimensions(lambda: detector_backgrounds.get_radon_background_level(
+                                           det_name, radon_bkgnd_level)),
+                   cache_dir)
+
+
+
+#####################################################################
+def cached_get_muon_background_level(det_name    : str,
+                                     hosting_lab : str,
+                                     cache_dir   : Optional[str] = PIPELINE_CACHE_DIR
+                                    )           -> Tuple[float, float]:
+    '''
+    Cached version of detector_backgrounds.get_muon_background_level.
+    '''
+    return _cached('muon', get_muon_inputs(det_name, hosting_lab),
+                   _current_dimensions(lambda: detector_backgrounds.get_muon_background_level(
+                                           det_name, hosting_lab)),
+                   cache_dir)
+
+
+
+#####################################################################
+def cached_get_rejection_factors(det_name  : str,
+                                 cache_dir : Optional[str] = PIPELINE_CACHE_DIR
+                                )         -> pd.DataFrame:
+    '''
+    Cached version of rejection_factors.get_rejection_factors.
+    '''
+    return _cached('rejection', get_rejection_inputs(det_name),
+                   lambda: rejection_factors.get_rejection_factors(det_name), cache_dir)
+
+
+
+#####################################################################
+def check_dimension_edits(det_name  : str,
+                          cache_dir : str
+                         )         -> List[str]:
+    '''
+    It edits the ICS thickness of the detector in-process, and returns the cached
+    stages whose results do not follow the edit (every stage should).
+    '''
+    base_dims = detector_dimensions.detector_dimensions[det_name]
+    results   = []
+    try:
+        for ICS_thickness in (base_dims['ICS_thickness'], 0.5 * base_dims['ICS_thickness']):
+            detector_dimensions.detector_dimensions[det_name] = {**base_dims,
+                                                                 'ICS_thickness': ICS_thickness}
+            results.append({
+                'dimensions': cached_get_dimensions(det_name, cache_dir)['ICS_mass'],
+                'radiogenic': cached_get_radiogenic_background_level(det_name, 'reference',
+                                                                     cache_dir).loc['INNER_SHIELDING'].sum(),
+                'expected'  : detector_dimensions.get_dimensions_array(
+                                  **detector_dimensions.detector_dimensions[det_name])['ICS_mass']})
+    finally:
+        detector_dimensions.detector_dimensions[det_name] = base_dims
+        detector_dimensions.get_dimensions.cache_clear()
+
+    failed = [stage for stage in ('dimensions', 'radiogenic')
+              if results[0][stage] == results[1][stage]]
+    if results[1]['dimensions'] != results[1]['expected']:
+        failed.append('dimensions')
+    return sorted(set(failed))
+
+
+
+#####################################################################
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description = 'Inspects, clears or checks the pipeline cache '
+                                                   '(check: cached results follow in-process edits '
+                                                   'of detector_dimensions, in a temporary cache).')
+    parser.add_argument('command', choices = ['info', 'clear', 'check'])
+    parser.add_argument('--cache-dir', default = PIPELINE_CACHE_DIR,
+                        help = f'cache directory (default: {PIPELINE_CACHE_DIR})')
+    args  = parser.parse_args(argv)
+    cache = PipelineCache(args.cache_dir)
+
+    if args.command == 'info':
+        info_df = cache.info()
+        print(f"Pipeline cache at '{cache.cache_dir}' "
+              f"({info_df['size'].sum() / 1024**2:.2f} of {cache.max_size / 1024**2:.0f} MB used)")
+        if len(info_df):
+            print(info_df.to_string())
+    elif args.command == 'clear':
+        print(f"{cache.clear()} entries removed from '{cache.cache_dir}'")
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            failed = check_dimension_edits('next_hd', tmp_dir)
+        if failed:
+            print(f"Stale cached results after editing detector_dimensions: {', '.join(failed)}")
+            return 1
+        print('Cached results follow in-process edits of detector_dimensions')
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
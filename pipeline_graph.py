@@ -0,0 +1,341 @@
+# General importings
+import time
+import numpy  as np
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any, Optional, Callable, Sequence, Mapping
+
+# Specific TONNE stuff
+import system_of_units as units
+
+from detector_dimensions  import detector_dimensions
+from detector_dimensions  import get_dimensions_array
+
+from initial_activities   import radiogenic_activity
+from initial_activities   import radon_activity
+from initial_activities   import muon_flux
+from initial_activities   import muon_flux_error
+
+from detector_backgrounds import radiogenic_components
+from detector_backgrounds import compute_radiogenic_background
+from detector_backgrounds import compute_radon_background
+from detector_backgrounds import get_lab_muon_config
+
+from background_index     import check_rejection_settings
+from background_index     import get_rejection_arrays
+from background_index     import get_toCKKY
+from background_index     import RADIOGENIC_ISOTOPES
+from background_index     import XE136_ABUNDANCE
+
+from muons.xe137_normalization import xe137_normalization_kernel
+
+from instrumentation      import span
+
+
+#####################################################################
+### Base dimensions of the detectors (inputs of the geometry node)
+BASE_DIMENSIONS = ['ACTIVE_diam', 'ACTIVE_length', 'FIELD_CAGE_thickness',
+                   'ICS_thickness', 'HOLLOWS_width', 'VESSEL_thickness']
+
+
+
+#####################################################################
+def same_value(old : Any,
+               new : Any
+              )   -> bool:
+    '''
+    It returns whether two node values are equal (dictionaries, sequences,
+    numpy arrays and scalars), so unchanged results do not invalidate their dependents.
+    '''
+    if type(old) is not type(new):
+        return False
+    if isinstance(old, dict):
+        return (old.keys() == new.keys()) and all(same_value(old[key], new[key]) for key in old)
+    if isinstance(old, (tuple, list)):
+        return (len(old) == len(new)) and all(same_value(o, n) for o, n in zip(old, new))
+    if isinstance(old, np.ndarray):
+        return (old.shape == new.shape) and np.array_equal(old, new, equal_nan=True)
+    try:
+        return bool(old == new)
+    except (TypeError, ValueError):
+        return False
+
+
+
+#####################################################################
+class PipelineGraph:
+    '''
+    Graph of pipeline nodes, evaluated on demand. Inputs are set by name, and
+    every node is a function of the values of the nodes (or inputs) it depends on.
+    Setting an input only invalidates the nodes downstream of it: they are
+    recomputed on the next get, and the ones whose value does not change
+    stop the invalidation (their dependents keep their cached values).
+    Every get records which nodes were recomputed and how long they took (get_report).
+    '''
+
+    def __init__(self):
+        self.functions  = {}    # node -> function (None for inputs)
+        self.inputs     = {}    # node -> names of the nodes it depends on
+        self.values     = {}
+        self.changed_at = {}    # revision of the last change of every value
+        self.checked_at = {}    # revision every node was last brought up to date
+        self.revision   = 0
+        self.report     = {}
+
+
+    def add_input(self,
+                  name  : str,
+                  value : Any
+                 )     -> None:
+        if name in self.functions:
+            raise ValueError(f"Node '{name}' already defined")
+        self.functions [name] = None
+        self.inputs    [name] = []
+        self.values    [name] = value
+        self.changed_at[name] = self.revision
+        self.checked_at[name] = self.revision
+
+
+    def add_node(self,
+                 name     : str,
+                 function : Callable,
+                 inputs   : Sequence[str]
+                )        -> None:
+        '''
+        It adds a node computed as function(*[values of inputs]).
+        Inputs must be defined first, so the graph has no cycles.
+        '''
+        if name in self.functions:
+            raise ValueError(f"Node '{name}' already defined")
+        unknown = [node for node in inputs if node not in self.functions]
+        if unknown:
+            raise ValueError(f"Node '{name}' depends on undefined nodes: {unknown}")
+        self.functions[name] = function
+        self.inputs   [name] = list(inputs)
+
+
+    def nodes(self) -> List[str]:
+        return list(self.functions)
+
+
+    def set(self, **values: Any) -> None:
+        '''
+        It sets the values of the inputs passed (by name).
+        Values equal to the current ones do not invalidate anything.
+        '''
+        for name in values:
+            if self.functions.get(name, 0) is not None:
+                raise KeyError(f"'{name}' is not an input of the graph")
+
+        self.revision += 1
+        for name, value in values.items():
+            if not same_value(self.values[name], value):
+                self.values    [name] = value
+                self.changed_at[name] = self.revision
+            self.checked_at[name] = self.revision
+
+
+    def _update(self, name: str) -> None:
+        if self.checked_at.get(name) == self.revision:
+            return
+
+        for node in self.inputs[name]:
+            self._update(node)
+
+        last_computed = self.checked_at.get(name, -1)
+        if (name in self.values) and all(self.changed_at[node] <= last_computed
+                                         for node in self.inputs[name]):
+            self.report[name] = {'recomputed': False, 'changed': False, 'time': 0.}
+        else:
+            start = time.perf_counter()
+            with span(f'pipeline_graph.{name}'):
+                value = self.functions[name](*[self.values[node] for node in self.inputs[name]])
+            changed = (name not in self.values) or not same_value(self.values[name], value)
+            if changed:
+                self.values    [name] = value
+                self.changed_at[name] = self.revision
+            self.report[name] = {'recomputed': True, 'changed': changed,
+                                 'time': time.perf_counter() - start}
+
+        self.checked_at[name] = self.revision
+
+
+    def get(self, *names: str) -> Any:
+        '''
+        It returns the value of the node passed (a tuple for several nodes),
+        recomputing the invalidated nodes it depends on.
+        '''
+        self.report = {}
+        for name in names:
+            self._update(name)
+        values = tuple(self.values[name] for name in names)
+        return values[0] if len(names) == 1 else values
+
+
+    def get_report(self) -> pd.DataFrame:
+        '''
+        It returns, for every node visited by the last get, whether it was
+        recomputed, whether its value changed and the time (s) it took.
+        '''
+        report_df = pd.DataFrame.from_dict(self.report, orient='index',
+                                           columns=['recomputed', 'changed', 'time'])
+        report_df.index.name = 'node'
+        return report_df
+
+
+
+#####################################################################
+def compute_muon_per_surface(hosting_lab     : str,
+                             muon_flux       : float,
+                             muon_flux_error : float
+                            )               -> Tuple[float, float]:
+    '''
+    It returns the Xe137 production rate (Bq) from muons, and its error,
+    per unit of muon surface for the muon flux passed in the hosting lab
+    (see get_muon_background_per_surface).
+    '''
+    rates = xe137_normalization_kernel(get_lab_muon_config(hosting_lab, 1.),
+                                       lab_flux     = muon_flux       * units.cm2 * units.second,
+                                       lab_flux_err = muon_flux_error * units.cm2 * units.second)
+    return float(rates.total_xe137PS[0]), float(rates.perSec_err[0])
+
+
+
+#####################################################################
+def compute_indices(Xe136_mass       : float,
+                    toCKKY           : float,
+                    rejection        : Mapping[str, Any],
+                    radiogenic_index : Tuple[float, float],
+                    radon_index      : Tuple[float, float],
+                    muon_index       : Tuple[float, float]
+                   )                -> Dict[str, float]:
+    '''
+    It returns the background indices (ckky), their errors and the figure of merit
+    (as get_detector_index_grid) from the background indices (Bq, error) of every source.
+    '''
+    total_index_bq = radiogenic_index[0] + radon_index[0] + muon_index[0]
+    total_error_bq = np.sqrt(radiogenic_index[1]**2 + radon_index[1]**2 + muon_index[1]**2)
+
+    return {'Xe136_mass'          : Xe136_mass,
+            'sig_eff'             : rejection['sig_eff'],
+            'radiogenic_index'    : radiogenic_index[0] * toCKKY,
+            'radiogenic_index_err': radiogenic_index[1] * toCKKY,
+            'radon_index'         : radon_index[0]      * toCKKY,
+            'radon_index_err'     : radon_index[1]      * toCKKY,
+            'muon_index'          : muon_index[0]       * toCKKY,
+            'muon_index_err'      : muon_index[1]       * toCKKY,
+            'total_index'         : total_index_bq      * toCKKY,
+            'total_index_err'     : total_error_bq      * toCKKY,
+            'total_level_Bq'      : total_index_bq,
+            'fom'                 : rejection['sig_eff'] / np.sqrt(total_index_bq)}
+
+
+
+#####################################################################
+def get_scenario_graph(det_name               : str,
+                       radiogenic_bkgnd_level : str,
+                       radon_bkgnd_level      : str,
+                       hosting_lab            : str,
+                       energyRes              : float,
+                       spatialDef             : str
+                      )                      -> PipelineGraph:
+    '''
+    It returns the pipeline graph of a scenario, whose 'indices' node holds
+    the background indices and figure of merit (as get_detector_index_grid).
+    Inputs, initialized with the scenario values:
+      - the base dimensions of the detector (BASE_DIMENSIONS),
+      - the radiogenic activities, named '<material>.<isotope>' (e.g. 'Teflon.Tl208'),
+      - 'radon_activity', 'muon_flux', 'muon_flux_error',
+      - 'det_name' (rejection factors), 'hosting_lab', 'energyRes' and 'spatialDef'.
+    The muon normalization only depends on the hosting lab and its flux,
+    geometry changes just rescale it with the muon surface.
+    '''
+    graph = PipelineGraph()
+
+    ### Inputs
+    for dimension in BASE_DIMENSIONS:
+        graph.add_input(dimension, detector_dimensions[det_name][dimension])
+
+    activity_names = []
+    for material, activities in radiogenic_activity[radiogenic_bkgnd_level].items():
+        for isotope in RADIOGENIC_ISOTOPES:
+            activity_names.append((material, isotope))
+            graph.add_input(f'{material}.{isotope}', activities[isotope])
+
+    graph.add_input('radon_activity' , radon_activity [radon_bkgnd_level])
+    graph.add_input('muon_flux'      , muon_flux      [hosting_lab])
+    graph.add_input('muon_flux_error', muon_flux_error[hosting_lab])
+    graph.add_input('det_name'       , det_name)
+    graph.add_input('hosting_lab'    , hosting_lab)
+    graph.add_input('energyRes'      , energyRes)
+    graph.add_input('spatialDef'     , spatialDef)
+
+    ### Geometry & background levels (Bq)
+    components = list(radiogenic_components)
+
+    def radiogenic_activities(*values):
+        activities = {}
+        for (material, isotope), value in zip(activity_names, values):
+            activities.setdefault(material, {})[isotope] = value
+        return activities
+
+    def radiogenic_level(dimensions, activities):
+        background = compute_radiogenic_background(dimensions, activities)
+        return np.array([[background[component][isotope] for isotope in RADIOGENIC_ISOTOPES]
+                         for component in components]) / units.Bq
+
+    def radon_level(dimensions, radon_act):
+        return float(compute_radon_background(dimensions, radon_bkgnd_level, radon_act)) / units.Bq
+
+    def muon_level(per_surface, dimensions):
+        return (per_surface[0] * dimensions['MUON_surface'],
+                per_surface[1] * dimensions['MUON_surface'])
+
+    graph.add_node('dimensions'           , lambda *values: get_dimensions_array(*values),
+                   BASE_DIMENSIONS)
+    graph.add_node('radiogenic_activities', radiogenic_activities,
+                   [f'{material}.{isotope}' for material, isotope in activity_names])
+    graph.add_node('radiogenic_level'     , radiogenic_level, ['dimensions', 'radiogenic_activities'])
+    graph.add_node('radon_level'          , radon_level     , ['dimensions', 'radon_activity'])
+    graph.add_node('muon_per_surface'     , compute_muon_per_surface,
+                   ['hosting_lab', 'muon_flux', 'muon_flux_error'])
+    graph.add_node('muon_level'           , muon_level      , ['muon_per_surface', 'dimensions'])
+
+    ### Rejection factors & Bq -> ckky conversion
+    def rejection(det, energy_res, spatial_def):
+        check_rejection_settings(det, [energy_res], [spatial_def])
+        rad_rej, rad_rej_err = get_rejection_arrays(det, components, [energy_res], [spatial_def],
+                                                    RADIOGENIC_ISOTOPES)
+        rn_rej,  rn_rej_err  = get_rejection_arrays(det, ['CATHODE'], [energy_res], [spatial_def],
+                                                    ['Bi214'])
+        act_rej, act_rej_err = get_rejection_arrays(det, ['ACTIVE'], [energy_res], [spatial_def],
+                                                    ['bb0nu', 'Xe137'])
+        return {'radiogenic'    : rad_rej    [0, 0], 'radiogenic_err': rad_rej_err[0, 0],
+                'radon'         : rn_rej [0, 0, 0, 0], 'radon_err'   : rn_rej_err [0, 0, 0, 0],
+                'sig_eff'       : act_rej[0, 0, 0, 0],
+                'Xe137'         : act_rej[0, 0, 0, 1], 'Xe137_err'   : act_rej_err[0, 0, 0, 1]}
+
+    graph.add_node('rejection' , rejection, ['det_name', 'energyRes', 'spatialDef'])
+    graph.add_node('Xe136_mass', lambda dimensions: dimensions['ACTIVE_mass'] * XE136_ABUNDANCE / units.kg,
+                   ['dimensions'])
+    graph.add_node('toCKKY'    , get_toCKKY, ['Xe136_mass', 'energyRes'])
+
+    ### Background indices (Bq, error) of every source
+    def radiogenic_index(level, rej):
+        return (float(np.nansum(level * rej['radiogenic'])),
+                float(np.sqrt(np.nansum((level * rej['radiogenic_err'])**2))))
+
+    def radon_index(level, rej):
+        return level * rej['radon'], level * rej['radon_err']
+
+    def muon_index(level, rej):
+        return (level[0] * rej['Xe137'],
+                float(np.sqrt((level[0] * rej['Xe137_err'])**2 + (level[1] * rej['Xe137'])**2)))
+
+    graph.add_node('radiogenic_index', radiogenic_index, ['radiogenic_level', 'rejection'])
+    graph.add_node('radon_index'     , radon_index     , ['radon_level'     , 'rejection'])
+    graph.add_node('muon_index'      , muon_index      , ['muon_level'      , 'rejection'])
+    graph.add_node('indices'         , compute_indices ,
+                   ['Xe136_mass', 'toCKKY', 'rejection', 'radiogenic_index', 'radon_index', 'muon_index'])
+
+    return graph
@@ -0,0 +1,458 @@
+# General importings
+import math
+import numpy  as np
+import pandas as pd
+
+from statistics import NormalDist
+
+from typing import Tuple, List, Dict, Any, Optional, Sequence
+
+# Specific TONNE stuff
+import system_of_units as units
+
+from detector_backgrounds import get_radiogenic_background_level
+from detector_backgrounds import get_muon_background_level
+from detector_backgrounds import get_muon_background_levels
+
+from background_index     import get_rejection_arrays
+from background_index     import RADIOGENIC_ISOTOPES
+
+from rejection_factors    import get_rejection_store
+
+from pseudo_experiments   import get_experiment_model
+from pseudo_experiments   import RADON_SOURCE
+from pseudo_experiments   import XE137_SOURCE
+from pseudo_experiments   import SIGNAL_SOURCE
+
+from instrumentation      import instrument
+
+
+#####################################################################
+### Signal strength mu = 1 corresponds to this bb0nu half-life (years)
+REFERENCE_HALFLIFE = 1.e27
+
+### Newton iterations
+FIT_MAX_ITER  = 100
+FIT_TOLERANCE = 1.e-8
+
+### Iterations & tolerance (on sqrt(q_mu)) locating the upper limits
+LIMIT_ITER      = 40
+LIMIT_TOLERANCE = 1.e-6
+
+
+
+#####################################################################
+def get_fit_model(det_name               : str,
+                  radiogenic_bkgnd_level : str,
+                  radon_bkgnd_level      : str,
+                  hosting_lab            : str,
+                  energyRes              : float,
+                  spatialDef             : str,
+                  live_years             : float,
+                  n_bins                 : int = 10,
+                  muon_level             : Optional[Tuple[float, float]] = None
+                 )                      -> Dict[str, Any]:
+    '''
+    It returns the binned model of the ROI energy spectrum fitted by fit_experiments:
+    the expected counts (yields) of the background sources and of the signal
+    (at REFERENCE_HALFLIFE), their shapes (fraction of counts per bin, flat for
+    backgrounds and gaussian at Qbb for the signal) and the relative errors of the
+    yields, constraining one log-normal nuisance parameter per yield:
+    rejection factor errors (radiogenic components, radon, Xe137 and signal efficiency),
+    and the muon level error (lab muon flux & Xe137 normalization statistics).
+    '''
+    if muon_level is None:
+        muon_level = get_muon_background_level(det_name, hosting_lab)
+    exp_model = get_experiment_model(det_name, radiogenic_bkgnd_level, radon_bkgnd_level,
+                                     hosting_lab, energyRes, spatialDef, live_years,
+                                     REFERENCE_HALFLIFE, muon_level)
+    sources   = exp_model['sources']
+    store     = get_rejection_store(det_name)
+
+    ### Relative errors of the radiogenic components (rejection factor errors)
+    radiogenic_df   = get_radiogenic_background_level(det_name, radiogenic_bkgnd_level)
+    components      = list(radiogenic_df.index)
+    rej, rej_err    = get_rejection_arrays(det_name, components, [energyRes], [spatialDef],
+                                           RADIOGENIC_ISOTOPES)
+    radiogenic_bq   = radiogenic_df.loc[components, RADIOGENIC_ISOTOPES].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        radiogenic_rel = np.sqrt(np.nansum((radiogenic_bq * rej_err[0, 0])**2, axis=1)) / \
+                         np.nansum(radiogenic_bq * rej[0, 0], axis=1)
+
+    def rel_error(source, isotope):
+        value = store.get(source, energyRes, spatialDef, isotope)
+        error = store.get_error(source, energyRes, spatialDef, isotope)
+        return error / value if value > 0 else 0.
+
+    muon_rel  = muon_level[1] / muon_level[0] if muon_level[0] > 0 else 0.
+    rel_errors = dict(zip(components, radiogenic_rel))
+    rel_errors[RADON_SOURCE]  = rel_error('CATHODE', 'Bi214')
+    rel_errors[XE137_SOURCE]  = math.sqrt(rel_error('ACTIVE', 'Xe137')**2 + muon_rel**2)
+    rel_errors[SIGNAL_SOURCE] = rel_error('ACTIVE', 'bb0nu')
+
+    ### Shapes: fraction of the counts of every source in every bin
+    bin_edges = np.linspace(exp_model['Emin'], exp_model['Emax'], n_bins + 1)
+    gauss     = NormalDist(exp_model['Qbb'], exp_model['sigma'])
+    sig_cdf   = np.array([gauss.cdf(edge) for edge in bin_edges])
+    shapes    = np.tile(np.diff(bin_edges) / (bin_edges[-1] - bin_edges[0]), (len(sources), 1))
+    shapes[sources.index(SIGNAL_SOURCE)] = np.diff(sig_cdf) / (sig_cdf[-1] - sig_cdf[0])
+
+    return {
+        'sources'    : sources,
+        'yields'     : exp_model['mean_counts'],
+        'rel_errors' : np.nan_to_num(np.array([rel_errors[source] for source in sources])),
+        'shapes'     : shapes,
+        'signal'     : sources.index(SIGNAL_SOURCE),
+        'bin_edges'  : bin_edges,
+        'live_years' : live_years
+    }
+
+
+
+#####################################################################
+def get_nuisance_widths(model: Dict[str, Any]) -> np.ndarray:
+    '''
+    It returns the widths of the log-normal nuisance parameters: yield = y0 * exp(width * theta).
+    '''
+    return np.log1p(model['rel_errors'])
+
+
+
+#####################################################################
+def get_expected_counts(model  : Dict[str, Any],
+                        params : np.ndarray
+                       )      -> np.ndarray:
+    '''
+    It returns the expected counts per bin, shape (n_exps, n_bins), for the fit
+    parameters passed, shape (n_exps, 1 + n_sources): signal strength mu and
+    one nuisance parameter theta per source.
+    '''
+    yields = model['yields'] * np.exp(get_nuisance_widths(model) * params[:, 1:])
+    yields[:, model['signal']] *= params[:, 0]
+    return yields @ model['shapes']
+
+
+
+#####################################################################
+def get_nll_derivatives(model  : Dict[str, Any],
+                        counts : np.ndarray,
+                        params : np.ndarray
+                       )      -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    It returns the negative log-likelihood (binned extended Poisson likelihood and
+    gaussian constraints of the nuisance parameters, constant terms dropped)
+    of every experiment, and its analytic gradient and hessian.
+    Shapes: counts (n_exps, n_bins), params (n_exps, n_par), returns (n_exps,),
+    (n_exps, n_par) and (n_exps, n_par, n_par).
+    '''
+    widths  = get_nuisance_widths(model)
+    signal  = model['signal']
+    shapes  = model['shapes']
+    mu, theta = params[:, 0], params[:, 1:]
+
+    unit_yields = model['yields'] * np.exp(widths * theta)          # mu = 1
+    yields      = unit_yields.copy()
+    yields[:, signal] *= mu
+    expected    = np.maximum(yields @ shapes, 1.e-300)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_term = np.where(counts > 0, counts * np.log(expected), 0.)
+    nll = np.sum(expected - log_term, axis=1) + 0.5 * np.sum(theta**2, axis=1)
+
+    ### Derivatives of the expected counts (n_exps, n_par, n_bins)
+    n_exps, n_par = params.shape
+    jacobian = np.empty((n_exps, n_par, shapes.shape[1]))
+    jacobian[:, 0 ] = unit_yields[:, signal, None] * shapes[signal]
+    jacobian[:, 1:] = (widths * yields)[..., None] * shapes
+
+    ratio    = counts / expected
+    weight   = 1. - ratio
+    gradient = np.einsum('epb,eb->ep', jacobian, weight)
+    gradient[:, 1:] += theta
+
+    hessian  = np.einsum('epb,eb,eqb->epq', jacobian, ratio / expected, jacobian)
+
+    ### Second derivatives of the expected counts: d2/dtheta2 & d2/dmu dtheta_signal
+    diag_second = np.einsum('ec,cb,eb->ec', widths**2 * yields, shapes, weight)
+    cross       = widths[signal] * np.einsum('e,b,eb->e', unit_yields[:, signal],
+                                              shapes[signal], weight)
+    idx = np.arange(1, n_par)
+    hessian[:, idx, idx]               += diag_second + 1.
+    hessian[:, 0, 1 + signal]          += cross
+    hessian[:, 1 + signal, 0]          += cross
+
+    return nll, gradient, hessian
+
+
+
+#####################################################################
+def fit_experiments(model    : Dict[str, Any],
+                    counts   : np.ndarray,
+                    mu_fixed : Optional[Any]        = None,
+                    init     : Optional[np.ndarray] = None,
+                    max_iter : int                  = FIT_MAX_ITER,
+                    tol      : float                = FIT_TOLERANCE
+                   )        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    It fits all the experiments passed (binned counts, shape (n_exps, n_bins)) at once,
+    minimizing the negative log-likelihood with batched damped Newton iterations
+    (Levenberg-Marquardt), with mu >= 0. If mu_fixed (a value or one per experiment)
+    only the nuisance parameters are fitted (conditional fit).
+    It returns the best parameters (n_exps, 1 + n_sources), the minimum negative
+    log-likelihoods and whether every fit converged.
+    '''
+    counts = np.asarray(counts, dtype=float)
+    n_exps = counts.shape[0]
+    n_par  = 1 + len(model['yields'])
+
+    if init is not None:
+        params = np.array(init, dtype=float)
+    else:
+        params = np.zeros((n_exps, n_par))
+        signal_total = model['yields'][model['signal']]
+        bkgnd_total  = model['yields'].sum() - signal_total
+        params[:, 0] = np.maximum(counts.sum(axis=1) - bkgnd_total, 0.) / signal_total
+    if mu_fixed is not None:
+        params[:, 0] = mu_fixed
+
+    free = np.ones((n_exps, n_par), dtype=bool)
+    if mu_fixed is not None:
+        free[:, 0] = False
+
+    damping   = np.full(n_exps, 1.e-3)
+    converged = np.zeros(n_exps, dtype=bool)
+    eye       = np.eye(n_par)
+
+    nll, gradient, hessian = get_nll_derivatives(model, counts, params)
+    for _ in range(max_iter):
+        ### Active set: mu stays at its bound if the likelihood pushes it below 0
+        active = free.copy()
+        active[:, 0] &= ~((params[:, 0] <= 0.) & (gradient[:, 0] > 0.))
+
+        both  = active[:, :, None] & active[:, None, :]
+        hess  = np.where(both, hessian, eye)
+        grad  = np.where(active, gradient, 0.)
+        scale = np.maximum(np.abs(np.diagonal(hess, axis1=1, axis2=2)), 1.e-12)
+        step  = np.linalg.solve(hess + damping[:, None, None] * (scale[:, :, None] * eye),
+                                grad[..., None])[..., 0]
+
+        decrement = np.einsum('ep,ep->e', grad, step)
+        converged = np.abs(decrement) < tol
+        if converged.all():
+            break
+
+        trial         = params - step
+        trial[:, 0]   = np.maximum(trial[:, 0], 0.)
+        trial_results = get_nll_derivatives(model, counts, trial)
+
+        better = (trial_results[0] <= nll) & ~converged
+        params [better] = trial[better]
+        nll    [better] = trial_results[0][better]
+        gradient[better] = trial_results[1][better]
+        hessian [better] = trial_results[2][better]
+        damping = np.where(better, np.maximum(damping / 10., 1.e-9),
+                                   np.minimum(damping * 10., 1.e+9))
+
+    return params, nll, converged
+
+
+
+#####################################################################
+def generate_binned_experiments(model  : Dict[str, Any],
+                                n_exps : int,
+                                mu     : float = 0.,
+                                seed   : Optional[Any] = None
+                               )      -> np.ndarray:
+    '''
+    It returns the binned counts (n_exps, n_bins) of pseudo-experiments Poisson
+    fluctuated around the nominal model with signal strength mu.
+    Binned counts of event-level pseudo-experiments (pseudo_experiments.py) are
+    statistically equivalent.
+    '''
+    rng      = np.random.default_rng(seed)
+    params   = np.zeros((1, 1 + len(model['yields'])))
+    params[0, 0] = mu
+    expected = get_expected_counts(model, params)[0]
+    return rng.poisson(expected, size=(n_exps, len(expected))).astype(float)
+
+
+
+#####################################################################
+def bin_events(model       : Dict[str, Any],
+               events_df   : pd.DataFrame,
+               experiments : np.ndarray
+              )           -> np.ndarray:
+    '''
+    It returns the binned counts (n_exps, n_bins) of the experiments passed
+    from the events written by pseudo_experiments.py.
+    '''
+    exp_pos = np.searchsorted(experiments, events_df['experiment'].to_numpy())
+    bin_pos = np.clip(np.digitize(events_df['energy'].to_numpy(), model['bin_edges']) - 1,
+                      0, len(model['bin_edges']) - 2)
+    counts  = np.zeros((len(experiments), len(model['bin_edges']) - 1))
+    np.add.at(counts, (exp_pos, bin_pos), 1.)
+    return counts
+
+
+
+#####################################################################
+def get_test_statistics(model   : Dict[str, Any],
+                        counts  : np.ndarray,
+                        mu_test : float
+                       )       -> Dict[str, np.ndarray]:
+    '''
+    It returns, for every experiment, the best signal strength (mu_hat), the discovery
+    test statistic q0 = -2 ln(L(0) / L(mu_hat)) and the one-sided upper-limit test
+    statistic q_mu = -2 ln(L(mu_test) / L(mu_hat)) (0 if mu_hat > mu_test),
+    profiling the nuisance parameters.
+    '''
+    best, best_nll, _ = fit_experiments(model, counts)
+    _, null_nll,    _ = fit_experiments(model, counts, mu_fixed=0.)
+    _, test_nll,    _ = fit_experiments(model, counts, mu_fixed=mu_test)
+
+    mu_hat = best[:, 0]
+    return {'mu_hat': mu_hat,
+            'q0'    : np.maximum(2. * (null_nll - best_nll), 0.),
+            'q_mu'  : np.where(mu_hat > mu_test, 0., np.maximum(2. * (test_nll - best_nll), 0.))}
+
+
+
+#####################################################################
+@instrument()
+def get_upper_limits(model  : Dict[str, Any],
+                     counts : np.ndarray,
+                     cl     : float = 0.9
+                    )      -> np.ndarray:
+    '''
+    It returns the upper limits on the signal strength of every experiment at the CL
+    passed: the mu where the profiled q_mu reaches its asymptotic threshold
+    (one-sided, Phi^-1(cl)**2), located by batched conditional fits.
+    sqrt(q_mu) is nearly linear in mu, so a bracketed regula falsi (Illinois)
+    on it converges in a few iterations.
+    '''
+    threshold = NormalDist().inv_cdf(cl)**2
+    best, best_nll, _ = fit_experiments(model, counts)
+
+    def root_q(mu, init):
+        params, nll, _ = fit_experiments(model, counts, mu_fixed=mu, init=init)
+        return np.sqrt(np.maximum(2. * (nll - best_nll), 0.)) - math.sqrt(threshold), params
+
+    ### Upper edges: grow until q_mu is above the threshold
+    signal_total = model['yields'][model['signal']]
+    low, f_low   = best[:, 0].copy(), np.full(len(counts), -math.sqrt(threshold))
+    high         = low + (np.sqrt(counts.sum(axis=1)) + 2.) / signal_total
+    init         = best.copy()
+    for _ in range(60):
+        f_high, params = root_q(high, init)
+        below = f_high < 0.
+        if not below.any():
+            break
+        low   = np.where(below, high, low)
+        f_low = np.where(below, f_high, f_low)
+        high  = np.where(below, 2. * high, high)
+    init = params
+
+    side = np.zeros(len(counts))    # last bracket edge moved: -1 low, +1 high
+    for _ in range(LIMIT_ITER):
+        middle = high - f_high * (high - low) / (f_high - f_low)
+        f_middle, init = root_q(middle, init)
+        below = f_middle < 0.
+
+        # Illinois: halve the value at the edge kept twice in a row
+        f_high = np.where( below & (side < 0), f_high / 2., f_high)
+        f_low  = np.where(~below & (side > 0), f_low  / 2., f_low)
+        low,  f_low  = np.where(below, middle, low ), np.where(below, f_middle, f_low )
+        high, f_high = np.where(below, high, middle), np.where(below, f_high, f_middle)
+        side = np.where(below, -1., 1.)
+
+        if np.all((np.abs(f_middle) < LIMIT_TOLERANCE) | (high - low <= LIMIT_TOLERANCE * high)):
+            return middle
+
+    return middle
+
+
+
+#####################################################################
+@instrument()
+def get_median_sensitivity(model  : Dict[str, Any],
+                           n_exps : int = 2000,
+                           cl     : float = 0.9,
+                           seed   : Optional[Any] = None
+                          )      -> Dict[str, Any]:
+    '''
+    It returns the median upper limit on the signal strength, and the corresponding
+    half-life sensitivity (years), of n_exps background-only pseudo-experiments,
+    with the upper limits of every experiment.
+    '''
+    counts = generate_binned_experiments(model, n_exps, 0., seed)
+    limits = get_upper_limits(model, counts, cl)
+    median = float(np.median(limits))
+    return {'mu_up_median'    : median,
+            'T12_sensitivity' : REFERENCE_HALFLIFE / median,
+            'mu_up'           : limits}
+
+
+
+#####################################################################
+@instrument()
+def get_test_statistic_distributions(model   : Dict[str, Any],
+                                     mu_test : float,
+                                     n_exps  : int = 10000,
+                                     seed    : Optional[Any] = None
+                                    )       -> Dict[str, np.ndarray]:
+    '''
+    It returns the test statistics (see get_test_statistics) of n_exps pseudo-experiments
+    generated with mu = 0 ('bkgnd') and with mu = mu_test ('signal').
+    '''
+    seeds = np.random.SeedSequence(seed).spawn(2)
+    return {
+        'bkgnd' : get_test_statistics(model, generate_binned_experiments(model, n_exps, 0.,
+                                                                         seeds[0]), mu_test),
+        'signal': get_test_statistics(model, generate_binned_experiments(model, n_exps, mu_test,
+                                                                         seeds[1]), mu_test)
+    }
+
+
+
+#####################################################################
+@instrument()
+def map_sensitivity_grid(detectors               : Sequence[str],
+                         radiogenic_bkgnd_levels : Sequence[str],
+                         radon_bkgnd_levels      : Sequence[str],
+                         hosting_labs            : Sequence[str],
+                         energy_resolutions      : Sequence[float],
+                         spatial_defs            : Sequence[str],
+                         live_years              : float,
+                         n_exps                  : int   = 2000,
+                         cl                      : float = 0.9,
+                         n_bins                  : int   = 10,
+                         seed                    : Optional[int] = None
+                        )                       -> pd.DataFrame:
+    '''
+    It returns the median half-life sensitivity (profile likelihood, n_exps
+    background-only pseudo-experiments each) of every scenario of the grid passed.
+    '''
+    muon_levels = get_muon_background_levels(detectors, hosting_labs)
+    scenarios   = [(det, rad, rn, lab, res, sdef)
+                   for det in detectors for rad in radiogenic_bkgnd_levels
+                   for rn in radon_bkgnd_levels for lab in hosting_labs
+                   for res in energy_resolutions for sdef in spatial_defs]
+    seeds       = np.random.SeedSequence(seed).spawn(len(scenarios))
+
+    rows = []
+    for scenario, seed_seq in zip(scenarios, seeds):
+        det, rad, rn, lab, res, sdef = scenario
+        model  = get_fit_model(det, rad, rn, lab, res, sdef, live_years, n_bins,
+                               muon_levels[(det, lab)])
+        result = get_median_sensitivity(model, n_exps, cl, seed_seq)
+        rows.append({'detector'              : det,
+                     'radiogenic_bkgnd_level': rad,
+                     'radon_bkgnd_level'     : rn,
+                     'hosting_lab'           : lab,
+                     'energyRes'             : res,
+                     'spatialDef'            : sdef,
+                     'bkgnd_counts'          : model['yields'].sum() - model['yields'][model['signal']],
+                     'mu_up_median'          : result['mu_up_median'],
+                     'T12_sensitivity'       : result['T12_sensitivity']})
+
+    return pd.DataFrame(rows)
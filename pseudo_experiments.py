@@ -0,0 +1,260 @@
+# General importings
+import os
+import sys
+import math
+import time
+import argparse
+import numpy  as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from typing import Tuple, List, Dict, Any, Optional, Sequence
+
+# Specific TONNE stuff
+import system_of_units as units
+
+from detector_backgrounds import get_radiogenic_background_level
+from detector_backgrounds import get_radon_background_level
+from detector_backgrounds import get_muon_background_level
+
+from background_index     import get_rejection_arrays
+from background_index     import get_Xe136_mass
+from background_index     import RADIOGENIC_ISOTOPES
+
+from rejection_factors    import get_rejection_store
+from roi_settings         import get_roi_settings
+
+from sensitivity          import AVOGADRO
+from sensitivity          import XE136_MOLAR_MASS
+
+
+#####################################################################
+### Xe136 Q-value, where the signal peaks (energyRes is the FWHM in % at Qbb)
+QBB = 2457.83 * units.keV
+
+FWHM_TO_SIGMA = 1. / (2. * math.sqrt(2. * math.log(2.)))
+
+### Sources of the pseudo-experiment events besides the radiogenic components
+RADON_SOURCE  = 'RADON'
+XE137_SOURCE  = 'XE137'
+SIGNAL_SOURCE = 'SIGNAL'
+
+
+
+#####################################################################
+def get_experiment_model(det_name               : str,
+                         radiogenic_bkgnd_level : str,
+                         radon_bkgnd_level      : str,
+                         hosting_lab            : str,
+                         energyRes              : float,
+                         spatialDef             : str,
+                         live_years             : float,
+                         signal_halflife        : Optional[float] = None,
+                         muon_level             : Optional[Tuple[float, float]] = None
+                        )                      -> Dict[str, Any]:
+    '''
+    It returns the expected counts in the ROI for the live time (years) passed,
+    split by source: every radiogenic component, radon on the cathode, Xe137 in the
+    active volume and the bb0nu signal (if its half-life, in years, is passed),
+    with the ROI limits and energy resolution (keV) used to draw the event energies.
+    '''
+    ROI_settings = get_roi_settings(energyRes)
+    live_seconds = live_years * units.year / units.second
+
+    radiogenic_df = get_radiogenic_background_level(det_name, radiogenic_bkgnd_level)
+    components    = list(radiogenic_df.index)
+    rad_rej, _    = get_rejection_arrays(det_name, components, [energyRes], [spatialDef],
+                                         RADIOGENIC_ISOTOPES)
+    radiogenic_bq = np.nansum(radiogenic_df.loc[components, RADIOGENIC_ISOTOPES].to_numpy(dtype=float)
+                              * rad_rej[0, 0], axis=1)
+
+    store       = get_rejection_store(det_name)
+    radon_bq    = get_radon_background_level(det_name, radon_bkgnd_level) / units.Bq * \
+                  store.get('CATHODE', energyRes, spatialDef, 'Bi214')
+    if muon_level is None:
+        muon_level = get_muon_background_level(det_name, hosting_lab)
+    Xe137_bq    = muon_level[0] * store.get('ACTIVE', energyRes, spatialDef, 'Xe137')
+
+    sources     = components + [RADON_SOURCE, XE137_SOURCE]
+    mean_counts = list(radiogenic_bq * live_seconds) + [radon_bq * live_seconds,
+                                                        Xe137_bq * live_seconds]
+
+    if signal_halflife is not None:
+        sig_eff  = store.get('ACTIVE', energyRes, spatialDef, 'bb0nu')
+        exposure = get_Xe136_mass(det_name) * live_years
+        sources.append(SIGNAL_SOURCE)
+        mean_counts.append(math.log(2.) * AVOGADRO * sig_eff * exposure /
+                           (XE136_MOLAR_MASS * signal_halflife))
+
+    return {
+        'sources'     : sources,
+        'mean_counts' : np.nan_to_num(np.array(mean_counts, dtype=float)),
+        'Emin'        : ROI_settings['Emin'] / units.keV,
+        'Emax'        : ROI_settings['Emax'] / units.keV,
+        'Qbb'         : QBB / units.keV,
+        'sigma'       : energyRes / 100. * QBB / units.keV * FWHM_TO_SIGMA
+    }
+
+
+
+#####################################################################
+def generate_experiments(model     : Dict[str, Any],
+                         first_exp : int,
+                         n_exps    : int,
+                         seed_seq  : np.random.SeedSequence,
+                         events    : bool = True
+                        )         -> Tuple[pd.DataFrame, Optional[pd.DataFrame]]:
+    '''
+    It returns n_exps pseudo-experiments (numbered from first_exp) as two DataFrames:
+    the Poisson-fluctuated counts of every source per experiment, and (if events)
+    every event (experiment, source code, energy in keV). Background energies are
+    flat in the ROI, signal energies gaussian at Qbb (truncated to the ROI).
+    '''
+    rng         = np.random.default_rng(seed_seq)
+    mean_counts = model['mean_counts']
+    n_sources   = len(mean_counts)
+
+    counts      = rng.poisson(mean_counts, size=(n_exps, n_sources)).astype(np.int32)
+    n_events    = counts.sum(axis=1)
+    experiments = np.arange(first_exp, first_exp + n_exps, dtype=np.int64)
+
+    experiments_df = pd.DataFrame(counts, columns=model['sources'])
+    experiments_df.insert(0, 'experiment', experiments)
+    experiments_df['n_events'] = n_events.astype(np.int32)
+    if not events:
+        return experiments_df, None
+
+    event_exp   = np.repeat(experiments, n_events)
+    event_src   = np.repeat(np.tile(np.arange(n_sources, dtype=np.int8), n_exps), counts.ravel())
+    energies    = rng.uniform(model['Emin'], model['Emax'], size=len(event_src))
+
+    if SIGNAL_SOURCE in model['sources']:
+        is_signal = np.flatnonzero(event_src == model['sources'].index(SIGNAL_SOURCE))
+        while len(is_signal):
+            energies[is_signal] = rng.normal(model['Qbb'], model['sigma'], size=len(is_signal))
+            is_signal = is_signal[(energies[is_signal] < model['Emin']) |
+                                  (energies[is_signal] > model['Emax'])]
+
+    events_df = pd.DataFrame({'experiment': event_exp,
+                              'source'    : event_src,
+                              'energy'    : energies.astype(np.float32)})
+    return experiments_df, events_df
+
+
+
+#####################################################################
+def run_pseudo_experiments(model      : Dict[str, Any],
+                           ofile_name : str,
+                           n_exps     : int,
+                           chunk_size : int           = 1000000,
+                           n_workers  : Optional[int] = None,
+                           seed       : Optional[int] = None,
+                           events     : bool          = True,
+                           complevel  : int           = 0,
+                           verbose    : bool          = False
+                          )          -> Dict[str, Any]:
+    '''
+    It generates n_exps pseudo-experiments in chunks of chunk_size over a pool
+    of n_workers processes (n_workers = 1 runs them in this process), every chunk
+    with its own seeded stream, so results do not depend on the number of workers.
+    Chunks are appended, as they come, to the 'experiments' and (if events)
+    'events' tables of the HDF5 output file, and the model to its 'model' table.
+    Compression (blosc, complevel > 0) makes the file ~5 times smaller,
+    but writing the events several times slower.
+    It returns the number of experiments and events, wall time and throughput.
+    '''
+    n_chunks = math.ceil(n_exps / chunk_size)
+    seeds    = np.random.SeedSequence(seed).spawn(n_chunks)
+    firsts   = [i * chunk_size for i in range(n_chunks)]
+    sizes    = [min(chunk_size, n_exps - first) for first in firsts]
+    n_events = 0
+    start    = time.perf_counter()
+
+    compression = {'complevel': complevel, 'complib': 'blosc'} if complevel else {}
+    with pd.HDFStore(ofile_name, mode='w', **compression) as store:
+
+        def write(chunk):
+            nonlocal n_events
+            experiments_df, events_df = chunk
+            store.append('experiments', experiments_df, index=False)
+            if events:
+                store.append('events', events_df, index=False)
+            n_events += int(experiments_df.n_events.sum())
+            if verbose:
+                done = experiments_df.experiment.iloc[-1] + 1
+                rate = done / (time.perf_counter() - start)
+                print(f"{done} / {n_exps} experiments ({rate:.3g} exps/s)", file=sys.stderr)
+
+        if n_workers == 1:
+            for first, size, seed_seq in zip(firsts, sizes, seeds):
+                write(generate_experiments(model, first, size, seed_seq, events))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                # Chunks submitted in windows, so pending results stay bounded
+                window = 2 * (n_workers or os.cpu_count() or 1)
+                for pos in range(0, n_chunks, window):
+                    futures = [executor.submit(generate_experiments, model, first, size,
+                                               seed_seq, events)
+                               for first, size, seed_seq in zip(firsts[pos:pos + window],
+                                                                sizes [pos:pos + window],
+                                                                seeds [pos:pos + window])]
+                    for future in futures:
+                        write(future.result())
+
+        store.put('model', pd.DataFrame({'source'     : model['sources'],
+                                         'mean_counts': model['mean_counts']}), format='table')
+        store.get_storer('model').attrs.settings = {key: model[key] for key in
+                                                    ('Emin', 'Emax', 'Qbb', 'sigma')}
+
+    wall_time = time.perf_counter() - start
+    return {'n_experiments': n_exps,
+            'n_events'     : n_events,
+            'wall_time'    : wall_time,
+            'throughput'   : n_exps / wall_time}
+
+
+
+#####################################################################
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description = 'Generates pseudo-experiments (ROI counts by source and event energies) '
+                      'of a scenario and streams them to an HDF5 file.')
+    parser.add_argument('det_name')
+    parser.add_argument('radiogenic_bkgnd_level')
+    parser.add_argument('radon_bkgnd_level')
+    parser.add_argument('hosting_lab')
+    parser.add_argument('energyRes', type = float)
+    parser.add_argument('spatialDef')
+    parser.add_argument('-o', '--output', required = True,
+                        help = 'output HDF5 file')
+    parser.add_argument('-n', '--n-experiments', type = int, default = 10000000)
+    parser.add_argument('-t', '--live-years', type = float, default = 10.)
+    parser.add_argument('--halflife', type = float, default = None,
+                        help = 'bb0nu half-life (years) of the signal (default: no signal)')
+    parser.add_argument('--chunk-size', type = int, default = 1000000)
+    parser.add_argument('-j', '--jobs', type = int, default = None,
+                        help = 'worker processes (default: one per CPU)')
+    parser.add_argument('--seed', type = int, default = None)
+    parser.add_argument('--no-events', action = 'store_true',
+                        help = 'only write the counts per source, not every event')
+    parser.add_argument('--complevel', type = int, default = 0,
+                        help = 'blosc compression level (default: no compression)')
+    parser.add_argument('-q', '--quiet', action = 'store_true')
+    args = parser.parse_args(argv)
+
+    model = get_experiment_model(args.det_name, args.radiogenic_bkgnd_level, args.radon_bkgnd_level,
+                                 args.hosting_lab, args.energyRes, args.spatialDef,
+                                 args.live_years, args.halflife)
+    stats = run_pseudo_experiments(model, args.output, args.n_experiments, args.chunk_size,
+                                   args.jobs, args.seed, not args.no_events, args.complevel,
+                                   verbose = not args.quiet)
+
+    print(f"{stats['n_experiments']} experiments ({stats['n_events']} events) "
+          f"in {stats['wall_time']:.1f} s: {stats['throughput']:.3g} experiments/s")
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
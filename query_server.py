@@ -0,0 +1,394 @@
+# General importings
+import sys
+import json
+import time
+import inspect
+import argparse
+import threading
+import collections
+import numpy  as np
+
+from concurrent.futures import Future
+from http.server        import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse       import urlsplit, parse_qs
+
+from typing import Tuple, List, Dict, Any, Optional, Callable, Sequence
+
+# Specific TONNE stuff
+from detector_dimensions  import detector_dimensions
+
+from initial_activities   import radiogenic_activity
+from initial_activities   import radon_activity
+
+from detector_backgrounds import get_muon_background_rates
+from detector_backgrounds import muon_files
+
+from background_index     import get_detector_index_grid
+
+from rejection_factors    import get_rejection_store
+from sensitivity          import get_detector_sensitivity
+from sensitivity          import get_statistical_tables
+
+
+#####################################################################
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+### Results of the most recent distinct queries kept in memory
+RESULTS_CACHE_SIZE = 4096
+
+
+
+#####################################################################
+class QueryError(ValueError):
+    '''
+    Wrong or missing query parameters (answered with a 400 status).
+    '''
+
+
+
+#####################################################################
+class QueryCoalescer:
+    '''
+    It runs every distinct query once: concurrent identical queries wait for
+    the running one and share its result, and the results of the last
+    max_results distinct queries are kept (queries are pure functions of
+    the preloaded data).
+    '''
+
+    def __init__(self, max_results: int = RESULTS_CACHE_SIZE):
+        self.max_results = max_results
+        self.lock        = threading.Lock()
+        self.running     = {}
+        self.results     = collections.OrderedDict()
+        self.counts      = collections.Counter()
+
+
+    def run(self,
+            key     : Any,
+            compute : Callable[[], Any]
+           )       -> Any:
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                self.counts['cached'] += 1
+                return self.results[key]
+            future = self.running.get(key)
+            owner  = future is None
+            if owner:
+                future = self.running[key] = Future()
+                self.counts['computed'] += 1
+            else:
+                self.counts['coalesced'] += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            result = compute()
+        except BaseException as error:
+            with self.lock:
+                del self.running[key]
+            future.set_exception(error)
+            raise
+
+        with self.lock:
+            del self.running[key]
+            self.results[key] = result
+            if len(self.results) > self.max_results:
+                self.results.popitem(last=False)
+        future.set_result(result)
+        return result
+
+
+
+#####################################################################
+class QueryService:
+    '''
+    Background-index, muon-rate and sensitivity queries over the preloaded
+    muon normalizations (with their per-bin tables) and rejection factors
+    of the detectors and hosting labs passed. The results of the last
+    max_results distinct queries are kept (0: every query is computed,
+    only concurrent identical ones are coalesced).
+    '''
+
+    def __init__(self,
+                 det_names    : Sequence[str],
+                 hosting_labs : Sequence[str],
+                 max_results  : int = RESULTS_CACHE_SIZE):
+        self.det_names    = list(det_names)
+        self.hosting_labs = list(hosting_labs)
+
+        start = time.perf_counter()
+        for det_name in self.det_names:
+            get_rejection_store(det_name)
+        get_statistical_tables(0.9)
+        get_statistical_tables(discovery_sigma=3.)
+
+        self.muon_rates = {}
+        for pairs, rates in get_muon_background_rates(self.det_names, self.hosting_labs):
+            for config_index, pair in enumerate(pairs):
+                self.muon_rates[pair] = (rates, config_index)
+        self.muon_levels = {pair: (float(rates.total_xe137PS[i]), float(rates.perSec_err[i]))
+                            for pair, (rates, i) in self.muon_rates.items()}
+
+        self.load_time = time.perf_counter() - start
+        self.coalescer = QueryCoalescer(max_results)
+        self.queries   = {'/background_index': self.background_index,
+                          '/muon_rate'       : self.muon_rate,
+                          '/sensitivity'     : self.sensitivity}
+
+
+    @staticmethod
+    def check_value(name  : str,
+                    value : Any,
+                    known : Sequence[Any]
+                   )     -> None:
+        if value not in known:
+            raise QueryError(f"Unknown {name} '{value}' ({', '.join(str(key) for key in known)})")
+
+
+    @staticmethod
+    def check_float(name    : str,
+                    value   : str,
+                    minimum : float,
+                    strict  : bool
+                   )       -> float:
+        '''
+        It returns the value passed as a float, checking it is above (strict)
+        or not below minimum.
+        '''
+        try:
+            number = float(value)
+        except ValueError:
+            raise QueryError(f"Wrong {name} '{value}'") from None
+        if not (np.isfinite(number) and ((number > minimum) if strict else (number >= minimum))):
+            raise QueryError(f"{name} must be {'>' if strict else '>='} {minimum:g}, got '{value}'")
+        return number
+
+
+    def check_pair(self,
+                   det_name    : str,
+                   hosting_lab : str
+                  )           -> None:
+        self.check_value('detector'   , det_name   , self.det_names)
+        self.check_value('hosting_lab', hosting_lab, self.hosting_labs)
+
+
+    def check_settings(self,
+                       det_name   : str,
+                       energyRes  : str,
+                       spatialDef : str
+                      )          -> float:
+        '''
+        It checks the detector and rejection settings passed, and returns energyRes.
+        '''
+        self.check_value('detector', det_name, self.det_names)
+        try:
+            energy_res = float(energyRes)
+        except ValueError:
+            raise QueryError(f"Wrong energyRes '{energyRes}'") from None
+        _, energy_resolutions, spatial_defs, _ = get_rejection_store(det_name).axes
+        self.check_value('energyRes' , energy_res, energy_resolutions)
+        self.check_value('spatialDef', spatialDef, spatial_defs)
+        return energy_res
+
+
+    def background_index(self,
+                         detector               : str,
+                         radiogenic_bkgnd_level : str,
+                         radon_bkgnd_level      : str,
+                         hosting_lab            : str,
+                         energyRes              : str,
+                         spatialDef             : str
+                        )                      -> Dict[str, float]:
+        self.check_pair(detector, hosting_lab)
+        energy_res = self.check_settings(detector, energyRes, spatialDef)
+        self.check_value('radiogenic_bkgnd_level', radiogenic_bkgnd_level, list(radiogenic_activity))
+        self.check_value('radon_bkgnd_level'     , radon_bkgnd_level     , list(radon_activity))
+        grid = get_detector_index_grid(detector, [radiogenic_bkgnd_level], [radon_bkgnd_level],
+                                       [hosting_lab], [energy_res], [spatialDef],
+                                       self.muon_levels)
+        return {key: float(values.ravel()[0]) for key, values in grid.items()}
+
+
+    def muon_rate(self,
+                  detector    : str,
+                  hosting_lab : str,
+                  bins        : str = '0'
+                 )           -> Dict[str, Any]:
+        self.check_pair(detector, hosting_lab)
+        level, error = self.muon_levels[(detector, hosting_lab)]
+        result = {'xe137PerS': level, 'xe137PerSErr': error}
+        if bins not in ('0', 'false'):
+            rates, config_index = self.muon_rates[(detector, hosting_lab)]
+            result['bins'] = rates.to_dataframe(config_index).to_dict(orient='list')
+        return result
+
+
+    def sensitivity(self,
+                    detector    : str,
+                    energyRes   : str,
+                    spatialDef  : str,
+                    live_years  : str,
+                    bkgnd_index : Optional[str] = None,
+                    method      : str = 'feldman_cousins',
+                    cl          : str = '0.9',
+                    **scenario  : str
+                   )           -> Dict[str, List[float]]:
+        '''
+        Sensitivity for the background index passed (ckky), or the one of the scenario
+        (radiogenic_bkgnd_level, radon_bkgnd_level & hosting_lab). live_years: comma-separated.
+        '''
+        if bkgnd_index is None:
+            bkgnd_index = self.run('/background_index', {'detector': detector, 'energyRes': energyRes,
+                                                         'spatialDef': spatialDef, **scenario})['total_index']
+        elif scenario:
+            raise QueryError(f"Unexpected parameters: {', '.join(sorted(scenario))}")
+
+        energy_res     = self.check_settings(detector, energyRes, spatialDef)
+        bkgnd_index    = self.check_float('bkgnd_index', bkgnd_index, 0., strict=False)
+        live_years     = [self.check_float('live_years', years, 0., strict=True)
+                          for years in live_years.split(',')]
+        cl             = self.check_float('cl', cl, 0., strict=True)
+        if cl >= 1:
+            raise QueryError(f"cl must be < 1, got '{cl}'")
+        sensitivity_df = get_detector_sensitivity(detector, energy_res, spatialDef,
+                                                  bkgnd_index, live_years, method, cl)
+        return sensitivity_df.to_dict(orient='list')
+
+
+    def run(self,
+            path   : str,
+            params : Dict[str, str]
+           )      -> Any:
+        '''
+        It returns the result of the query passed (path & parameters), running it
+        only once for concurrent or repeated identical queries.
+        '''
+        if path not in self.queries:
+            raise KeyError(path)
+        try:
+            # Only missing or unexpected parameters are client errors
+            inspect.signature(self.queries[path]).bind(**params)
+        except TypeError as error:
+            raise QueryError(str(error)) from None
+        key = (path, tuple(sorted(params.items())))
+        return self.coalescer.run(key, lambda: self.queries[path](**params))
+
+
+    def stats(self) -> Dict[str, Any]:
+        return {'detectors'   : self.det_names,
+                'hosting_labs': self.hosting_labs,
+                'load_time'   : self.load_time,
+                'result_cache': self.coalescer.max_results,
+                'queries'     : dict(self.coalescer.counts)}
+
+
+
+#####################################################################
+def to_json(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {str(key): to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [to_json(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+
+#####################################################################
+class QueryHandler(BaseHTTPRequestHandler):
+    '''
+    GET /<query>?<parameters> -> JSON result ({"error": ...} on failure),
+    GET /stats -> loaded data & query counters.
+    '''
+    protocol_version        = 'HTTP/1.1'
+    disable_nagle_algorithm = True    # headers & body are sent separately on kept-alive connections
+    service                 = None
+    quiet                   = True
+
+    def do_GET(self) -> None:
+        url    = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == '/stats':
+                status, body = 200, self.service.stats()
+            elif url.path not in self.service.queries:
+                status, body = 404, {'error': f"Unknown query '{url.path}' "
+                                              f"({', '.join(self.service.queries)}, /stats)"}
+            else:
+                status, body = 200, self.service.run(url.path, params)
+        except (QueryError, ValueError) as error:
+            status, body = 400, {'error': str(error)}
+        except Exception as error:
+            status, body = 500, {'error': f'{type(error).__name__}: {error}'}
+
+        content = json.dumps(to_json(body)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+
+#####################################################################
+def make_server(service : QueryService,
+                host    : str  = DEFAULT_HOST,
+                port    : int  = DEFAULT_PORT,
+                quiet   : bool = True
+               )       -> ThreadingHTTPServer:
+    '''
+    It returns the (not yet serving) HTTP server answering the queries
+    of the service passed, one thread per connection.
+    '''
+    handler = type('ServiceQueryHandler', (QueryHandler,), {'service': service, 'quiet': quiet})
+    server  = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+
+#####################################################################
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description = 'Serves background-index, muon-rate and sensitivity queries (HTTP/JSON) '
+                      'with the muon and rejection data preloaded.')
+    parser.add_argument('--host', default = DEFAULT_HOST)
+    parser.add_argument('-p', '--port', type = int, default = DEFAULT_PORT)
+    parser.add_argument('-d', '--detectors', nargs = '+', default = ['next_hd'],
+                        choices = list(detector_dimensions))
+    parser.add_argument('-l', '--labs', nargs = '+', default = list(muon_files),
+                        choices = list(muon_files))
+    parser.add_argument('--no-result-cache', action = 'store_true',
+                        help = 'compute every query (only concurrent identical ones are coalesced)')
+    parser.add_argument('-v', '--verbose', action = 'store_true',
+                        help = 'log every request')
+    args = parser.parse_args(argv)
+
+    service = QueryService(args.detectors, args.labs,
+                           0 if args.no_result_cache else RESULTS_CACHE_SIZE)
+    server  = make_server(service, args.host, args.port, not args.verbose)
+    print(f"Data loaded in {service.load_time:.1f} s, serving on "
+          f"http://{args.host}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,25 +1,238 @@
-# General importings
+# General importings
+import os
 import math
+import hashlib
+import functools
 import numpy  as np
 import pandas as pd
 
-from typing import Tuple, List, Dict, Any
+from typing import Tuple, List, Dict, Any, Optional, Sequence
 
-# Specific IC stuff
-import invisible_cities.core.system_of_units as units
+# Specific TONNE stuff
+import system_of_units as units
 
+from instrumentation import instrument
 
 
 #####################################################################
-def get_rejection_factors(det_name: str) -> pd.DataFrame:
+### Isotopes (columns) with rejection factors in the csv files
+REJECTION_ISOTOPES = ['bb0nu', 'Xe137', 'Bi214', 'Tl208']
+
+### Default location of the binary rejection-factor files (None disables them)
+REJECTION_CACHE_DIR = os.environ.get('TONNE_REJECTION_CACHE',
+                                     os.path.join(os.path.expanduser('~'), '.cache', 'tonne', 'rejection'))
+
+
+
+#####################################################################
+def get_rejection_file_name(det_name: str) -> str:
     '''
-    It returns a DataFrame with all the existing rejection factors
-    for the setector passed.
+    It returns the name of the csv file with the rejection factors of the detector passed.
     '''
+    return f"rejection_factors.{det_name}.csv"
 
-    ifile_name = f"rejection_factors.{det_name}.csv"
 
-    factors_df = pd.read_csv(ifile_name,
+
+#####################################################################
+@functools.lru_cache(maxsize=None)
+@instrument()
+def read_rejection_factors(det_name: str) -> pd.DataFrame:
+    '''
+    It returns the DataFrame read from the rejection factors file of the detector passed.
+    It is parsed only once per detector, so it must not be modified.
+    '''
+    factors_df = pd.read_csv(get_rejection_file_name(det_name),
                              index_col=['source', 'energyRes', 'spatialDef'],
                              comment='#')
     return factors_df
+
+
+
+#####################################################################
+def get_rejection_factors(det_name: str) -> pd.DataFrame:
+    '''
+    It returns a DataFrame with all the existing rejection factors
+    for the setector passed.
+    '''
+    return read_rejection_factors(det_name).copy()
+
+
+
+#####################################################################
+class RejectionFactorStore:
+    '''
+    Rejection factors (and errors) of a detector as dense read-only arrays
+    indexed by (source, energyRes, spatialDef, isotope).
+    Missing rejection factors are stored as NaN.
+    '''
+
+    def __init__(self,
+                 sources            : Sequence[str],
+                 energy_resolutions : Sequence[float],
+                 spatial_defs       : Sequence[str],
+                 isotopes           : Sequence[str],
+                 values             : np.ndarray,
+                 errors             : np.ndarray):
+
+        self.axes   = (list(sources), [float(res) for res in energy_resolutions],
+                       list(spatial_defs), list(isotopes))
+        self.values = np.asarray(values, dtype=float)
+        self.errors = np.asarray(errors, dtype=float)
+        self.values.setflags(write=False)
+        self.errors.setflags(write=False)
+
+        self._positions = [{key: pos for pos, key in enumerate(axis)} for axis in self.axes]
+
+
+    @classmethod
+    @instrument()
+    def from_dataframe(cls, factors_df: pd.DataFrame) -> 'RejectionFactorStore':
+        '''
+        It builds the store from a rejection factors DataFrame (see get_rejection_factors).
+        '''
+        sources            = list(factors_df.index.get_level_values('source'    ).unique())
+        energy_resolutions = list(factors_df.index.get_level_values('energyRes' ).unique())
+        spatial_defs       = list(factors_df.index.get_level_values('spatialDef').unique())
+
+        grid_index = pd.MultiIndex.from_product([sources, energy_resolutions, spatial_defs],
+                                                names = factors_df.index.names)
+        grid_df    = factors_df.reindex(grid_index)
+
+        shape  = (len(sources), len(energy_resolutions), len(spatial_defs), len(REJECTION_ISOTOPES))
+        values = grid_df[REJECTION_ISOTOPES].to_numpy(dtype=float).reshape(shape)
+        errors = grid_df[[f'{iso}_err' for iso in REJECTION_ISOTOPES]].to_numpy(dtype=float).reshape(shape)
+
+        return cls(sources, energy_resolutions, spatial_defs, REJECTION_ISOTOPES, values, errors)
+
+
+    @classmethod
+    @instrument()
+    def from_binary(cls, file_name: str) -> 'RejectionFactorStore':
+        '''
+        It loads the store from a binary (npz) file written by to_binary.
+        '''
+        with np.load(file_name) as data:
+            return cls(data['sources'].tolist(), data['energy_resolutions'].tolist(),
+                       data['spatial_defs'].tolist(), data['isotopes'].tolist(),
+                       data['values'], data['errors'])
+
+
+    def to_binary(self, file_name: str) -> None:
+        '''
+        It writes the store to a binary (npz) file, much faster to load than the csv.
+        '''
+        sources, energy_resolutions, spatial_defs, isotopes = self.axes
+        tmp_file_name = f'{file_name}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_file_name,
+                 sources = np.array(sources), energy_resolutions = np.array(energy_resolutions),
+                 spatial_defs = np.array(spatial_defs), isotopes = np.array(isotopes),
+                 values = self.values, errors = self.errors)
+        os.replace(tmp_file_name, file_name)
+
+
+    def position(self,
+                 source     : str,
+                 energyRes  : float,
+                 spatialDef : str,
+                 isotope    : str
+                )          -> Tuple[int, int, int, int]:
+        '''
+        It returns the array position of the rejection factor passed.
+        '''
+        return tuple(positions[key] for positions, key
+                     in zip(self._positions, (source, float(energyRes), spatialDef, isotope)))
+
+
+    def get(self,
+            source     : str,
+            energyRes  : float,
+            spatialDef : str,
+            isotope    : str
+           )          -> float:
+        '''
+        It returns a single rejection factor.
+        '''
+        return self.values[self.position(source, energyRes, spatialDef, isotope)]
+
+
+    def get_error(self,
+                  source     : str,
+                  energyRes  : float,
+                  spatialDef : str,
+                  isotope    : str
+                 )          -> float:
+        '''
+        It returns the error of a single rejection factor.
+        '''
+        return self.errors[self.position(source, energyRes, spatialDef, isotope)]
+
+
+    def view(self,
+             source     : Optional[str]   = None,
+             energyRes  : Optional[float] = None,
+             spatialDef : Optional[str]   = None,
+             isotope    : Optional[str]   = None
+            )          -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        It returns (values, errors) views (no copies) fixing the axes passed,
+        and keeping whole the ones left as None.
+        '''
+        keys  = (source, None if energyRes is None else float(energyRes), spatialDef, isotope)
+        index = tuple(slice(None) if key is None else positions[key]
+                      for positions, key in zip(self._positions, keys))
+        return self.values[index], self.errors[index]
+
+
+    @instrument()
+    def take(self,
+             sources            : Sequence[str],
+             energy_resolutions : Sequence[float],
+             spatial_defs       : Sequence[str],
+             isotopes           : Sequence[str]
+            )                  -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        It returns (values, errors) arrays for the cartesian product of the keys passed,
+        with shape (sources, energy_resolutions, spatial_defs, isotopes).
+        Unknown keys give NaN rejection factors.
+        '''
+        key_lists = (sources, [float(res) for res in energy_resolutions], spatial_defs, isotopes)
+        positions = [np.array([axis_positions.get(key, -1) for key in keys])
+                     for axis_positions, keys in zip(self._positions, key_lists)]
+
+        index   = np.ix_(*[np.maximum(pos, 0) for pos in positions])
+        missing = functools.reduce(np.logical_or, [(pos < 0).reshape(idx.shape)
+                                                   for pos, idx in zip(positions, index)])
+
+        values  = np.where(missing, np.nan, self.values[index])
+        errors  = np.where(missing, np.nan, self.errors[index])
+        return values, errors
+
+
+
+#####################################################################
+@functools.lru_cache(maxsize=None)
+@instrument()
+def get_rejection_store(det_name  : str,
+                        cache_dir : Optional[str] = REJECTION_CACHE_DIR
+                       )         -> RejectionFactorStore:
+    '''
+    It returns the RejectionFactorStore of the detector passed, loaded once per detector.
+    If cache_dir is not None, a binary copy of the csv file is kept there
+    (and rebuilt whenever the csv file changes).
+    '''
+    if cache_dir is None:
+        return RejectionFactorStore.from_dataframe(read_rejection_factors(det_name))
+
+    ifile_name = get_rejection_file_name(det_name)
+    file_stat  = os.stat(ifile_name)
+    key_text   = repr((os.path.abspath(ifile_name), file_stat.st_mtime_ns, file_stat.st_size))
+    cache_file = os.path.join(cache_dir, f"rejection_factors.{det_name}." +
+                              hashlib.sha1(key_text.encode()).hexdigest() + ".npz")
+
+    if os.path.isfile(cache_file):
+        return RejectionFactorStore.from_binary(cache_file)
+
+    store = RejectionFactorStore.from_dataframe(read_rejection_factors(det_name))
+    os.makedirs(cache_dir, exist_ok=True)
+    store.to_binary(cache_file)
+    return store
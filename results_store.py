@@ -0,0 +1,296 @@
+# General importings
+import os
+import json
+import numpy  as np
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any, Optional, Sequence, Union
+
+# Specific TONNE stuff
+from detector_backgrounds import get_muon_background_rates
+from background_index     import GRID_AXES
+
+
+#####################################################################
+### Store layout: <root>/meta.json with the schema and number of rows of every table,
+### and <root>/<table>/<column>.bin with the raw values of every column.
+### String columns are stored as int32 codes, their categories kept in meta.json.
+META_FILE_NAME = 'meta.json'
+STORE_VERSION  = 1
+
+CATEGORY_DTYPE = np.dtype('int32')
+
+### Predicate operators accepted by ResultsStore.select
+PREDICATE_OPS = {'==': np.equal,      '!=': np.not_equal,
+                 '<' : np.less,       '<=': np.less_equal,
+                 '>' : np.greater,    '>=': np.greater_equal}
+
+
+
+#####################################################################
+class ResultsStore:
+    '''
+    Columnar on-disk store of results tables. Tables only grow (append), every column
+    being a raw binary file read back as a read-only memory map, so opening a store
+    and reading a column cost no copy, whatever the number of rows.
+    meta.json (replaced atomically) holds the committed number of rows of every
+    table: an interrupted append leaves the store as it was.
+    A store has a single writer at a time.
+    '''
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        meta_file     = os.path.join(root_dir, META_FILE_NAME)
+        if os.path.isfile(meta_file):
+            with open(meta_file) as ifile:
+                self.meta = json.load(ifile)
+        else:
+            self.meta = {'version': STORE_VERSION, 'tables': {}}
+        self._maps = {}
+
+
+    def tables(self) -> List[str]:
+        return list(self.meta['tables'])
+
+
+    def n_rows(self, table: str) -> int:
+        return self.meta['tables'][table]['n_rows'] if table in self.meta['tables'] else 0
+
+
+    def columns(self, table: str) -> List[str]:
+        return list(self.meta['tables'][table]['columns'])
+
+
+    def categories(self,
+                   table  : str,
+                   column : str
+                  )      -> Optional[List[Any]]:
+        '''
+        It returns the categories of a string column (None for numeric columns).
+        '''
+        return self.meta['tables'][table]['columns'][column].get('categories')
+
+
+    def _column_file(self,
+                     table  : str,
+                     column : str
+                    )      -> str:
+        return os.path.join(self.root_dir, table, f'{column}.bin')
+
+
+    def _write_meta(self) -> None:
+        meta_file     = os.path.join(self.root_dir, META_FILE_NAME)
+        tmp_file_name = f'{meta_file}.{os.getpid()}.tmp'
+        with open(tmp_file_name, 'w') as ofile:
+            json.dump(self.meta, ofile, indent=1)
+        os.replace(tmp_file_name, meta_file)
+
+
+    @staticmethod
+    def _check_values(table  : str,
+                      column : str,
+                      values : np.ndarray,
+                      dtype  : np.dtype
+                     )      -> np.ndarray:
+        '''
+        It returns the values of a numeric column cast to its stored dtype,
+        raising a ValueError instead of writing values the cast would change
+        (NaN into integers, fractions, overflows, rounding, strings).
+        '''
+        where = f"column '{column}' of table '{table}' ({dtype.name})"
+        if (values.dtype.kind == 'f') and (dtype.kind in 'biu') and np.isnan(values).any():
+            raise ValueError(f"NaN values can not be stored in integer {where}")
+        if not np.can_cast(values.dtype, dtype, 'same_kind'):
+            raise ValueError(f"{values.dtype.name} values can not be stored in {where}")
+        if np.can_cast(values.dtype, dtype, 'safe') and not ((values.dtype.kind in 'iu') and
+                                                            (dtype.kind == 'f')):
+            return values.astype(dtype, copy=False)
+
+        if (dtype.kind in 'iu') and len(values):
+            limits = np.iinfo(dtype)
+            if (values.min() < limits.min) or (values.max() > limits.max):
+                raise ValueError(f"Values out of range for {where}")
+        # Unsafe casts (e.g. float64 into float32, or large integers into floats)
+        # are only done if no value changes
+        with np.errstate(over='ignore', invalid='ignore'):
+            cast = values.astype(dtype)
+        if not np.array_equal(cast.astype(values.dtype), values, equal_nan=(values.dtype.kind == 'f')):
+            raise ValueError(f"{values.dtype.name} values would be rounded in {where}")
+        return cast
+
+
+    #################################################################
+    def append(self,
+               table   : str,
+               data_df : pd.DataFrame
+              )       -> Tuple[int, int]:
+        '''
+        It appends the rows of the DataFrame passed (its index is ignored) to the table,
+        created with the DataFrame columns & dtypes on the first append.
+        String & categorical columns become categorical codes, extended with new categories.
+        It returns the (first, last + 1) row numbers of the appended rows.
+        Empty DataFrames are not appended (nor define the table schema).
+        '''
+        tables = self.meta['tables']
+        if len(data_df) == 0:
+            return self.n_rows(table), self.n_rows(table)
+
+        if table not in tables:
+            schema = {}
+            for column, values in data_df.items():
+                if values.dtype.kind in 'biuf':
+                    schema[column] = {'dtype': np.dtype(values.dtype).str}
+                else:
+                    schema[column] = {'dtype': CATEGORY_DTYPE.str, 'categories': []}
+            tables[table] = {'n_rows': 0, 'columns': schema}
+            os.makedirs(os.path.join(self.root_dir, table), exist_ok=True)
+
+        schema = tables[table]['columns']
+        if list(data_df.columns) != list(schema):
+            raise ValueError(f"Columns {list(data_df.columns)} do not match table "
+                             f"'{table}' columns {list(schema)}")
+
+        # Numeric columns are checked before anything is written or changed
+        arrays = {column: self._check_values(table, column, np.asarray(values),
+                                             np.dtype(schema[column]['dtype']))
+                  for column, values in data_df.items() if 'categories' not in schema[column]}
+
+        for column, values in data_df.items():
+            spec = schema[column]
+            if 'categories' in spec:
+                categories     = spec['categories']
+                codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+                known          = set(categories)
+                categories.extend(value.item() if isinstance(value, np.generic) else value
+                                  for value in uniques if value not in known)
+                positions      = {category: code for code, category in enumerate(categories)}
+                mapping        = np.array([positions[value] for value in uniques] + [-1],
+                                          dtype=CATEGORY_DTYPE)
+                arrays[column] = mapping[codes]    # missing values (code -1) kept as -1
+
+        first = tables[table]['n_rows']
+        for column in data_df.columns:
+            # Rows beyond the committed ones (interrupted append) are overwritten
+            with open(self._column_file(table, column), 'ab') as ofile:
+                ofile.truncate(first * np.dtype(schema[column]['dtype']).itemsize)
+                ofile.write(np.ascontiguousarray(arrays[column]).tobytes())
+
+        tables[table]['n_rows'] = first + len(data_df)
+        self._write_meta()
+        self._maps = {key: value for key, value in self._maps.items() if key[0] != table}
+        return first, first + len(data_df)
+
+
+    #################################################################
+    def column(self,
+               table  : str,
+               column : str
+              )      -> np.ndarray:
+        '''
+        It returns the values (codes for string columns) of a column as a
+        read-only memory map: no data is read until it is used.
+        '''
+        key = (table, column)
+        if key not in self._maps:
+            spec   = self.meta['tables'][table]['columns'][column]
+            n_rows = self.n_rows(table)
+            if n_rows == 0:
+                self._maps[key] = np.empty(0, dtype=spec['dtype'])
+            else:
+                self._maps[key] = np.memmap(self._column_file(table, column), mode='r',
+                                            dtype=np.dtype(spec['dtype']), shape=(n_rows,))
+        return self._maps[key]
+
+
+    def get_mask(self,
+                 table : str,
+                 where : Optional[Dict[str, Any]] = None
+                )     -> np.ndarray:
+        '''
+        It returns the boolean mask of the rows passing every predicate in where:
+        {column: value}, {column: [values]} or {column: (op, value)}, op in PREDICATE_OPS.
+        Predicates on string columns are evaluated on their codes.
+        '''
+        mask = np.ones(self.n_rows(table), dtype=bool)
+        for column, predicate in (where or {}).items():
+            values     = self.column(table, column)
+            categories = self.categories(table, column)
+
+            if isinstance(predicate, tuple):
+                op, value = predicate
+                if categories is not None:
+                    if op not in ('==', '!='):
+                        raise ValueError(f"Only == and != predicates on string column '{column}'")
+                    value = categories.index(value) if value in categories else -1
+                mask &= PREDICATE_OPS[op](values, value)
+                continue
+
+            targets = predicate if isinstance(predicate, (list, set, np.ndarray)) else [predicate]
+            if categories is not None:
+                targets = [categories.index(value) for value in targets if value in categories]
+            mask &= np.isin(values, targets)
+        return mask
+
+
+    def select(self,
+               table    : str,
+               where    : Optional[Dict[str, Any]] = None,
+               columns  : Optional[Sequence[str]]  = None,
+               as_frame : bool                     = True
+              )        -> Union[pd.DataFrame, Dict[str, np.ndarray]]:
+        '''
+        It returns the rows passing the predicates in where (see get_mask) for the columns
+        passed (all by default). Predicates are evaluated on the memory-mapped columns,
+        and only the selected rows of the requested columns are read.
+        String columns are returned as pandas Categoricals (codes as_frame = False).
+        '''
+        columns = self.columns(table) if columns is None else list(columns)
+        rows    = None if not where else np.flatnonzero(self.get_mask(table, where))
+
+        selected = {}
+        for column in columns:
+            values = self.column(table, column)
+            values = np.asarray(values) if rows is None else values[rows]
+            if as_frame and self.categories(table, column) is not None:
+                values = pd.Categorical.from_codes(values, self.categories(table, column))
+            selected[column] = values
+
+        if not as_frame:
+            return selected
+        return pd.DataFrame(selected, index=rows)
+
+
+
+#####################################################################
+def append_grid_results(store   : ResultsStore,
+                        grid_df : pd.DataFrame,
+                        table   : str = 'scenarios'
+                       )       -> Tuple[int, int]:
+    '''
+    It appends the scenario results passed (a DataFrame indexed by GRID_AXES, as
+    returned by get_background_index_grid, or with GRID_AXES columns) to the table.
+    '''
+    results_df = grid_df.reset_index() if set(GRID_AXES) <= set(grid_df.index.names) else grid_df
+    return store.append(table, results_df.reset_index(drop=True))
+
+
+
+#####################################################################
+def append_muon_tables(store        : ResultsStore,
+                       det_names    : Sequence[str],
+                       hosting_labs : Sequence[str],
+                       table        : str = 'muon_bins'
+                      )            -> Tuple[int, int]:
+    '''
+    It appends the per-bin Xe137 normalization tables (as written to file_out)
+    of every detector in every hosting lab passed to the table.
+    '''
+    tables = []
+    for pairs, rates in get_muon_background_rates(det_names, hosting_labs):
+        for config_index, (det_name, hosting_lab) in enumerate(pairs):
+            bins_df = rates.to_dataframe(config_index)
+            bins_df.insert(0, 'detector',    det_name)
+            bins_df.insert(1, 'hosting_lab', hosting_lab)
+            bins_df.insert(2, 'bin',         np.arange(len(bins_df), dtype=np.int32))
+            tables.append(bins_df)
+    return store.append(table, pd.concat(tables, ignore_index=True))
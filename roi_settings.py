@@ -1,12 +1,10 @@
 # General importings
 import math
-import numpy  as np
-import pandas as pd
 
 from typing import Tuple, List, Dict, Any
 
-# Specific IC stuff
-import invisible_cities.core.system_of_units as units
+# Specific TONNE stuff
+import system_of_units as units
 
 
 #####################################################################
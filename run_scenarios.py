@@ -0,0 +1,232 @@
+# General importings
+import io
+import os
+import sys
+import time
+import argparse
+import functools
+import contextlib
+import traceback
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from typing import Tuple, List, Dict, Any, Optional
+
+# Specific TONNE stuff
+from pipeline_cache       import cached_get_muon_background_level
+from pipeline_cache       import PIPELINE_CACHE_DIR
+
+from initial_activities   import radiogenic_activity
+from initial_activities   import radon_activity
+
+from background_index     import check_rejection_settings
+from background_index     import get_detector_index_grid
+from background_index     import GRID_AXES
+
+from results_store        import ResultsStore
+from results_store        import append_grid_results
+
+
+#####################################################################
+def read_scenarios(ifile_name: str) -> pd.DataFrame:
+    '''
+    It reads the scenario file: a csv file with one scenario per row and
+    GRID_AXES as columns ('#' starts a comment).
+    '''
+    scenarios = pd.read_csv(ifile_name, comment='#', skipinitialspace=True)
+
+    missing = [axis for axis in GRID_AXES if axis not in scenarios.columns]
+    if missing:
+        raise ValueError(f"Scenario file '{ifile_name}' misses columns: {', '.join(missing)}")
+
+    return scenarios[GRID_AXES]
+
+
+
+#####################################################################
+def check_scenario(scenario: Dict[str, Any]) -> None:
+    '''
+    It raises a ValueError if the scenario has unknown background levels, or settings
+    without ROI settings or rejection factors (see check_rejection_settings).
+    '''
+    if scenario['radiogenic_bkgnd_level'] not in radiogenic_activity:
+        raise ValueError(f"Unknown radiogenic_bkgnd_level '{scenario['radiogenic_bkgnd_level']}'")
+    if scenario['radon_bkgnd_level'] not in radon_activity:
+        raise ValueError(f"Unknown radon_bkgnd_level '{scenario['radon_bkgnd_level']}'")
+    check_rejection_settings(scenario['detector'], [scenario['energyRes']], [scenario['spatialDef']])
+
+
+
+#####################################################################
+def get_muon_level(det_name    : str,
+                   hosting_lab : str,
+                   cache_dir   : Optional[str],
+                   verbose     : bool
+                  )           -> Tuple[float, float]:
+    '''
+    It returns the (cached) muon background level (Bq, error) of the pair passed.
+    The normalization printout goes to stderr (nowhere if not verbose),
+    so it does not mix with the output of the runner.
+    '''
+    with contextlib.redirect_stdout(sys.stderr if verbose else io.StringIO()):
+        return cached_get_muon_background_level(det_name, hosting_lab, cache_dir)
+
+
+
+#####################################################################
+def evaluate_scenario(scenario   : Dict[str, Any],
+                      muon_level : Tuple[float, float]
+                     )          -> Dict[str, Any]:
+    '''
+    It returns the background indices (ckky), their errors and the figure of merit
+    of a single scenario, given its muon background level (Bq, error).
+    '''
+    grid = get_detector_index_grid(scenario['detector'],
+                                   [scenario['radiogenic_bkgnd_level']],
+                                   [scenario['radon_bkgnd_level']],
+                                   [scenario['hosting_lab']],
+                                   [scenario['energyRes']],
+                                   [scenario['spatialDef']],
+                                   {(scenario['detector'], scenario['hosting_lab']): muon_level})
+    return {**scenario, **{key: float(values.ravel()[0]) for key, values in grid.items()}}
+
+
+
+#####################################################################
+def write_results(results_df : pd.DataFrame,
+                  ofile_name : str
+                 )          -> None:
+    '''
+    It writes the results table: hdf5 for '.h5' files, appended to the results
+    store for '.store' directories (see results_store), csv otherwise.
+    '''
+    if os.path.splitext(ofile_name)[1] == '.store':
+        append_grid_results(ResultsStore(ofile_name), results_df)
+    elif os.path.splitext(ofile_name)[1] in ('.h5', '.hdf5'):
+        results_df.to_hdf(ofile_name, key='scenarios', mode='w')
+    else:
+        results_df.to_csv(ofile_name, index=False)
+
+
+
+#####################################################################
+def run_scenarios(scenarios : pd.DataFrame,
+                  n_workers : Optional[int] = None,
+                  verbose   : bool = True,
+                  cache_dir : Optional[str] = PIPELINE_CACHE_DIR
+                 )         -> Tuple[pd.DataFrame, List[str]]:
+    '''
+    It evaluates every scenario over a pool of n_workers processes.
+    Scenarios are checked first (see check_scenario), the wrong ones reported as failures.
+    Muon normalizations are run then, once per (detector, hosting_lab) pair,
+    and kept in the pipeline cache (cache_dir = None disables it).
+    It returns the results table and the list of failures.
+    '''
+    def progress(message):
+        if verbose:
+            print(message, file=sys.stderr, flush=True)
+
+    scenario_list  = scenarios.to_dict('records')
+    failures       = []
+    valid          = []
+    for i, scenario in enumerate(scenario_list):
+        try:
+            check_scenario(scenario)
+            valid.append(i)
+        except Exception as error:
+            failures.append(f"scenario {scenario}: {type(error).__name__}: {error}")
+
+    muon_pairs     = sorted({(scenario_list[i]['detector'], scenario_list[i]['hosting_lab'])
+                             for i in valid})
+    muon_levels    = {}
+    results        = []
+    start          = time.time()
+    muon_level     = functools.partial(get_muon_level, cache_dir=cache_dir, verbose=verbose)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+
+        ### Muon normalizations
+        futures = {executor.submit(muon_level, *pair): pair for pair in muon_pairs}
+        for done, future in enumerate(as_completed(futures), 1):
+            pair = futures[future]
+            try:
+                muon_levels[pair] = future.result()
+                progress(f"[muons {done}/{len(muon_pairs)}] {pair[0]} in {pair[1]} "
+                         f"({time.time() - start:.1f} s)")
+            except Exception:
+                failures.append(f"muons {pair}:\n{traceback.format_exc()}")
+                progress(f"[muons {done}/{len(muon_pairs)}] {pair[0]} in {pair[1]} FAILED")
+
+        ### Scenarios
+        futures = {executor.submit(evaluate_scenario, scenario_list[i],
+                                   muon_levels[(scenario_list[i]['detector'],
+                                                scenario_list[i]['hosting_lab'])]): i
+                   for i in valid
+                   if (scenario_list[i]['detector'], scenario_list[i]['hosting_lab']) in muon_levels}
+        n_skipped = len(valid) - len(futures)
+        if n_skipped:
+            failures.append(f"{n_skipped} scenarios skipped after muon failures")
+
+        for done, future in enumerate(as_completed(futures), 1):
+            index = futures[future]
+            try:
+                results.append((index, future.result()))
+            except Exception:
+                failures.append(f"scenario {scenario_list[index]}:\n{traceback.format_exc()}")
+            if (done == len(futures)) or (done % max(len(futures) // 20, 1) == 0):
+                progress(f"[scenarios {done}/{len(futures)}] ({time.time() - start:.1f} s)")
+
+    results_df = pd.DataFrame([result for _, result in sorted(results, key=lambda res: res[0])],
+                              columns = None if results else GRID_AXES)
+    return results_df, failures
+
+
+
+#####################################################################
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description = 'Computes the background index of every scenario (csv file with '
+                      f"columns {', '.join(GRID_AXES)}) and writes one results table.")
+    parser.add_argument('scenario_file',
+                        help = 'csv file with one scenario per row')
+    parser.add_argument('-o', '--output', default = 'scenarios_results.csv',
+                        help = "results file ('.h5' for hdf5, '.store' for a results store, csv otherwise)")
+    parser.add_argument('-j', '--jobs', type = int, default = None,
+                        help = 'number of worker processes (default: number of cores)')
+    parser.add_argument('-q', '--quiet', action = 'store_true',
+                        help = 'do not report progress')
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'do not use the pipeline cache')
+    args = parser.parse_args(argv)
+
+    try:
+        scenarios = read_scenarios(args.scenario_file)
+    except Exception as error:
+        print(f"ERROR reading scenarios: {error}", file=sys.stderr)
+        return 2
+
+    results_df, failures = run_scenarios(scenarios, args.jobs, not args.quiet,
+                                         None if args.no_cache else PIPELINE_CACHE_DIR)
+
+    if len(results_df):
+        ofile_name = args.output
+        try:
+            write_results(results_df, ofile_name)
+        except Exception:
+            # The results are not lost: they go to a csv file in the working directory
+            failures.append(f"writing '{ofile_name}':\n{traceback.format_exc()}")
+            ofile_name = os.path.splitext(os.path.basename(ofile_name))[0] + '.recovered.csv'
+            write_results(results_df, ofile_name)
+        if not args.quiet:
+            print(f"{len(results_df)} scenarios written to '{ofile_name}'", file=sys.stderr)
+
+    for failure in failures:
+        print(f"ERROR {failure}", file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,342 @@
+# General importings
+import os
+import math
+import hashlib
+import functools
+import numpy  as np
+import pandas as pd
+
+from typing import Tuple, List, Dict, Any, Optional
+
+# Specific TONNE stuff
+import system_of_units as units
+
+from rejection_factors import get_rejection_store
+from roi_settings      import get_roi_settings
+from background_index  import get_Xe136_mass
+
+
+#####################################################################
+### Physical constants
+AVOGADRO        = 6.02214076e23   # 1 / mol
+XE136_MOLAR_MASS = 0.1359          # kg / mol
+
+### Expected background grid (counts) of the precomputed statistical tables.
+### Out of the grid: limits are constant below, and scale as sqrt(b) above.
+TABLE_BKGND_MIN    = 1.e-3
+TABLE_BKGND_MAX    = 1.e+2
+TABLE_BKGND_POINTS = 201
+
+UPPER_LIMIT_METHODS = ['poisson', 'feldman_cousins']
+
+### Signal step used to locate the Feldman-Cousins upper limits
+FC_SIGNAL_STEP = 0.05
+
+### Default location of the precomputed tables (None disables it)
+STATS_CACHE_DIR = os.environ.get('TONNE_STATS_CACHE',
+                                 os.path.join(os.path.expanduser('~'), '.cache', 'tonne', 'stats'))
+
+
+
+#####################################################################
+def poisson_pmf(n  : np.ndarray,
+                mu : np.ndarray
+               )  -> np.ndarray:
+    '''
+    It returns the Poisson probabilities of the (integer) counts n for the means mu.
+    '''
+    n        = np.asarray(n)
+    log_fact = np.concatenate([[0.], np.cumsum(np.log(np.arange(1, n.max() + 1)))])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_pmf = n * np.log(mu) - mu - log_fact[n]
+    return np.where(n == 0, np.exp(-mu) * np.ones_like(log_pmf), np.exp(log_pmf))
+
+
+
+#####################################################################
+def bisect(condition : Any,
+           low       : np.ndarray,
+           high      : np.ndarray,
+           n_iter    : int = 50
+          )         -> np.ndarray:
+    '''
+    Vectorized bisection: it returns (for every element) the boundary x
+    between condition(x) == True (below) and False (above), in [low, high].
+    '''
+    low, high = np.array(low, dtype=float), np.array(high, dtype=float)
+    for _ in range(n_iter):
+        mid       = (low + high) / 2.
+        below     = condition(mid)
+        low       = np.where(below, mid, low)
+        high      = np.where(below, high, mid)
+    return (low + high) / 2.
+
+
+
+#####################################################################
+def get_fc_lower_edges(signals : np.ndarray,
+                       bkgnd   : float,
+                       n_max   : int,
+                       cl      : float
+                      )       -> np.ndarray:
+    '''
+    It returns the lower edge of the Feldman-Cousins acceptance interval
+    (counts in [0, n_max]) for every signal mean passed.
+    '''
+    n        = np.arange(n_max + 1)
+    prob     = poisson_pmf(n[None, :], signals[:, None] + bkgnd)
+    prob_max = poisson_pmf(n, np.maximum(n - bkgnd, 0.) + bkgnd)
+    ratio    = prob / prob_max[None, :]
+
+    order       = np.argsort(-ratio, axis=1, kind='stable')
+    sorted_prob = np.take_along_axis(prob, order, axis=1)
+    # Counts are accepted (by decreasing ratio) until the CL is reached
+    accepted    = (np.cumsum(sorted_prob, axis=1) - sorted_prob) < cl
+    return np.where(accepted, np.take_along_axis(n[None, :].repeat(len(signals), 0), order, axis=1),
+                    n_max + 1).min(axis=1)
+
+
+
+#####################################################################
+def get_upper_limits(bkgnd  : float,
+                     n_max  : int,
+                     cl     : float,
+                     method : str
+                    )      -> np.ndarray:
+    '''
+    It returns the signal upper limits at the CL passed for every number
+    of observed counts in [0, n_max] with the expected background passed.
+    '''
+    n = np.arange(n_max + 1)
+
+    if method == 'feldman_cousins':
+        # Largest signal whose acceptance interval still contains n
+        # (acceptance intervals computed with counts well above the largest signal).
+        # The lower edges are not always monotonic in the signal, so the last
+        # signal accepting n is located in a grid and then refined by bisection.
+        signal_max  = n_max + 10.
+        n_counts    = get_table_n_max(signal_max + bkgnd)
+        signal_grid = np.arange(0., signal_max + FC_SIGNAL_STEP, FC_SIGNAL_STEP)
+        lower_edges = get_fc_lower_edges(signal_grid, bkgnd, n_counts, cl)
+        last        = np.array([np.flatnonzero(lower_edges <= count)[-1] for count in n])
+        return bisect(lambda s: get_fc_lower_edges(s, bkgnd, n_counts, cl) <= n,
+                      signal_grid[last], signal_grid[last] + FC_SIGNAL_STEP, n_iter=20)
+
+    if method == 'poisson':
+        # Classical limit: P(N <= n | s + b) = 1 - CL (not below 0)
+        def cdf_above(mu):
+            counts = np.arange(n_max + 1)
+            cdf    = np.cumsum(poisson_pmf(counts[None, :], mu[:, None]), axis=1)
+            return cdf[n, n] > 1. - cl
+        total_up = bisect(cdf_above, np.zeros(len(n)), np.full(len(n), n_max + 10.))
+        return np.maximum(total_up - bkgnd, 0.)
+
+    raise ValueError(f"Unknown method '{method}' ({'|'.join(UPPER_LIMIT_METHODS)})")
+
+
+
+#####################################################################
+def get_table_n_max(bkgnd: float) -> int:
+    '''
+    It returns the largest observed count considered for the background passed.
+    '''
+    return int(math.ceil(bkgnd + 10. * math.sqrt(bkgnd) + 20.))
+
+
+
+#####################################################################
+def compute_statistical_tables(cl              : float = 0.9,
+                               discovery_sigma : float = 3.
+                              )               -> Dict[str, np.ndarray]:
+    '''
+    It computes, on the expected background grid, the average (over background-only
+    experiments) signal upper limits at the CL passed for every UPPER_LIMIT_METHODS,
+    and the signal giving a discovery_sigma discovery with 50% probability.
+    '''
+    bkgnds = np.logspace(math.log10(TABLE_BKGND_MIN), math.log10(TABLE_BKGND_MAX),
+                         TABLE_BKGND_POINTS)
+    p_value = math.erfc(discovery_sigma / math.sqrt(2.)) / 2.
+
+    tables = {'bkgnd': bkgnds}
+    for method in UPPER_LIMIT_METHODS:
+        tables[method] = np.array([
+            np.sum(poisson_pmf(np.arange(get_table_n_max(b) + 1), b) *
+                   get_upper_limits(b, get_table_n_max(b), cl, method))
+            for b in bkgnds])
+
+    discovery = []
+    for b in bkgnds:
+        n_max    = get_table_n_max(b)
+        n        = np.arange(n_max + 1)
+        survival = 1. - np.cumsum(poisson_pmf(n, b)) + poisson_pmf(n, b)   # P(N >= n | b)
+        n_crit   = int(n[survival <= p_value][0])
+        # Signal giving P(N >= n_crit | s + b) = 0.5
+        signal   = bisect(lambda s: np.sum(poisson_pmf(np.arange(n_crit), s + b)) > 0.5,
+                          0., n_crit + 10.)
+        discovery.append(float(signal))
+    tables['discovery'] = np.array(discovery)
+
+    return tables
+
+
+
+#####################################################################
+@functools.lru_cache(maxsize=None)
+def get_statistical_tables(cl              : float = 0.9,
+                           discovery_sigma : float = 3.,
+                           cache_dir       : Optional[str] = STATS_CACHE_DIR
+                          )               -> Dict[str, np.ndarray]:
+    '''
+    It returns the precomputed statistical tables (see compute_statistical_tables),
+    computed once and kept on disk (if cache_dir is not None).
+    '''
+    key_text   = repr((cl, discovery_sigma, TABLE_BKGND_MIN, TABLE_BKGND_MAX, TABLE_BKGND_POINTS))
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, 'stat_tables.' +
+                                  hashlib.sha1(key_text.encode()).hexdigest() + '.npz')
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as data:
+                return {key: data[key] for key in data.files}
+
+    tables = compute_statistical_tables(cl, discovery_sigma)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_file, **tables)
+        os.replace(tmp_file, cache_file)
+
+    return tables
+
+
+
+#####################################################################
+def interpolate_table(tables : Dict[str, np.ndarray],
+                      column : str,
+                      bkgnd  : np.ndarray
+                     )      -> np.ndarray:
+    '''
+    It interpolates (linearly in log(b)) a statistical table column
+    for the expected backgrounds passed.
+    '''
+    bkgnd     = np.asarray(bkgnd, dtype=float)
+    log_bkgnd = np.log(np.clip(bkgnd, TABLE_BKGND_MIN, TABLE_BKGND_MAX))
+    values    = np.interp(log_bkgnd, np.log(tables['bkgnd']), tables[column])
+    # Asymptotic sqrt(b) scaling above the table
+    return values * np.sqrt(np.maximum(bkgnd / TABLE_BKGND_MAX, 1.))
+
+
+
+#####################################################################
+def get_signal_upper_limit(bkgnd  : np.ndarray,
+                           method : str   = 'feldman_cousins',
+                           cl     : float = 0.9
+                          )      -> np.ndarray:
+    '''
+    It returns the average signal upper limit (counts) for the expected backgrounds passed.
+    '''
+    if method not in UPPER_LIMIT_METHODS:
+        raise ValueError(f"Unknown method '{method}' ({'|'.join(UPPER_LIMIT_METHODS)})")
+    return interpolate_table(get_statistical_tables(cl), method, bkgnd)
+
+
+
+#####################################################################
+def get_discovery_signal(bkgnd           : np.ndarray,
+                         discovery_sigma : float = 3.
+                        )               -> np.ndarray:
+    '''
+    It returns the signal (counts) giving a discovery_sigma discovery
+    with 50% probability, for the expected backgrounds passed.
+    '''
+    return interpolate_table(get_statistical_tables(discovery_sigma=discovery_sigma),
+                             'discovery', bkgnd)
+
+
+
+#####################################################################
+def signal_to_halflife(signal   : np.ndarray,
+                       sig_eff  : float,
+                       exposure : np.ndarray
+                      )        -> np.ndarray:
+    '''
+    It returns the Xe136 bb0nu half-life (years) giving the signal counts passed,
+    for the signal efficiency and exposure (kg.year of Xe136) passed.
+    '''
+    return math.log(2.) * AVOGADRO * sig_eff * exposure / (XE136_MOLAR_MASS * signal)
+
+
+
+#####################################################################
+def get_halflife_sensitivity(exposure    : np.ndarray,
+                             bkgnd_index : float,
+                             roi_width   : float,
+                             sig_eff     : float,
+                             method      : str   = 'feldman_cousins',
+                             cl          : float = 0.9
+                            )           -> np.ndarray:
+    '''
+    It returns the half-life sensitivity (years) at the CL passed for the exposures
+    (kg.year of Xe136), background index (ckky), ROI width (keV) and signal efficiency passed.
+    '''
+    exposure = np.asarray(exposure, dtype=float)
+    bkgnd    = bkgnd_index * roi_width * exposure
+    return signal_to_halflife(get_signal_upper_limit(bkgnd, method, cl), sig_eff, exposure)
+
+
+
+#####################################################################
+def get_discovery_potential(exposure        : np.ndarray,
+                            bkgnd_index     : float,
+                            roi_width       : float,
+                            sig_eff         : float,
+                            discovery_sigma : float = 3.
+                           )               -> np.ndarray:
+    '''
+    It returns the half-life (years) discovered at discovery_sigma with 50% probability
+    for the exposures (kg.year of Xe136), background index (ckky), ROI width (keV)
+    and signal efficiency passed.
+    '''
+    exposure = np.asarray(exposure, dtype=float)
+    bkgnd    = bkgnd_index * roi_width * exposure
+    return signal_to_halflife(get_discovery_signal(bkgnd, discovery_sigma), sig_eff, exposure)
+
+
+
+#####################################################################
+def get_detector_sensitivity(det_name        : str,
+                             energyRes       : float,
+                             spatialDef      : str,
+                             bkgnd_index     : float,
+                             live_years      : np.ndarray,
+                             method          : str   = 'feldman_cousins',
+                             cl              : float = 0.9,
+                             discovery_sigma : float = 3.
+                            )               -> pd.DataFrame:
+    '''
+    It returns the half-life sensitivity and discovery potential of the detector
+    (Xe136 mass from its dimensions, signal efficiency from its rejection factors)
+    with the background index (ckky) passed, as a function of the live time (years).
+    Live times must be positive, and the background index non-negative.
+    '''
+    live_years = np.asarray(live_years, dtype=float)
+    if not (np.isfinite(live_years).all() and (live_years > 0).all()):
+        raise ValueError(f"Live times must be positive, got {live_years.tolist()}")
+    if not (np.isfinite(bkgnd_index) and (bkgnd_index >= 0)):
+        raise ValueError(f"The background index must be non-negative, got {bkgnd_index}")
+
+    ROI_settings = get_roi_settings(energyRes)
+    roi_width    = (ROI_settings['Emax'] - ROI_settings['Emin']) / units.keV
+    sig_eff      = get_rejection_store(det_name).get('ACTIVE', energyRes, spatialDef, 'bb0nu')
+    exposure     = get_Xe136_mass(det_name) * live_years
+
+    return pd.DataFrame({
+        'live_years'       : live_years,
+        'exposure'         : exposure,
+        'bkgnd_counts'     : bkgnd_index * roi_width * exposure,
+        'T12_sensitivity'  : get_halflife_sensitivity(exposure, bkgnd_index, roi_width,
+                                                      sig_eff, method, cl),
+        'T12_discovery'    : get_discovery_potential (exposure, bkgnd_index, roi_width,
+                                                      sig_eff, discovery_sigma)
+    })
@@ -0,0 +1,210 @@
+# Lightweight units table, with the same values as invisible_cities.core.system_of_units
+# (CLHEP system of units: mm, ns, MeV, eplus), so that importing the TONNE modules
+# does not need invisible_cities.
+
+#####################################################################
+pi     = 3.14159265358979323846
+twopi  = 2 * pi
+halfpi = pi / 2
+pi2    = pi * pi
+
+
+### Length [L]
+millimeter  = 1.
+millimeter2 = millimeter * millimeter
+millimeter3 = millimeter * millimeter2
+
+centimeter  = 10. * millimeter
+centimeter2 = centimeter * centimeter
+centimeter3 = centimeter * centimeter2
+
+decimeter   = 100. * millimeter
+decimeter2  = decimeter * decimeter
+decimeter3  = decimeter * decimeter2
+
+meter       = 1000. * millimeter
+meter2      = meter * meter
+meter3      = meter * meter2
+
+kilometer   = 1000. * meter
+kilometer2  = kilometer * kilometer
+kilometer3  = kilometer * kilometer2
+
+micrometer  = 1.e-6  * meter
+nanometer   = 1.e-9  * meter
+angstrom    = 1.e-10 * meter
+fermi       = 1.e-15 * meter
+
+barn        = 1.e-28 * meter2
+millibarn   = 1.e-3  * barn
+microbarn   = 1.e-6  * barn
+nanobarn    = 1.e-9  * barn
+picobarn    = 1.e-12 * barn
+
+liter       = 1.e+3  * centimeter3
+L           = liter
+dL          = 1.e-1  * liter
+cL          = 1.e-2  * liter
+mL          = 1.e-3  * liter
+
+nm  = nanometer
+um  = micrometer
+mm  = millimeter
+mm2 = millimeter2
+mm3 = millimeter3
+cm  = centimeter
+cm2 = centimeter2
+cm3 = centimeter3
+dm  = decimeter
+dm2 = decimeter2
+dm3 = decimeter3
+m   = meter
+m2  = meter2
+m3  = meter3
+km  = kilometer
+km2 = kilometer2
+km3 = kilometer3
+
+
+### Angle
+radian      = 1.
+milliradian = 1.e-3 * radian
+degree      = (pi / 180.0) * radian
+steradian   = 1.
+
+rad  = radian
+mrad = milliradian
+sr   = steradian
+deg  = degree
+
+
+### Time [T]
+nanosecond  = 1.
+second      = 1.e+9  * nanosecond
+millisecond = 1.e-3  * second
+microsecond = 1.e-6  * second
+picosecond  = 1.e-12 * second
+minute      = 60. * second
+hour        = 60. * minute
+day         = 24. * hour
+year        = 365.25 * day
+
+hertz     = 1. / second
+kilohertz = 1.e+3 * hertz
+megahertz = 1.e+6 * hertz
+
+ns  = nanosecond
+mus = microsecond
+ms  = millisecond
+s   = second
+ps  = picosecond
+
+Hz  = hertz
+kHz = kilohertz
+MHz = megahertz
+
+
+### Electric charge [Q]
+eplus   = 1.                    # positron charge
+e_SI    = 1.602176487e-19       # positron charge in coulomb
+coulomb = eplus / e_SI
+
+
+### Energy [E]
+megaelectronvolt = 1.
+electronvolt     = 1.e-6  * megaelectronvolt
+kiloelectronvolt = 1.e-3  * megaelectronvolt
+gigaelectronvolt = 1.e+3  * megaelectronvolt
+teraelectronvolt = 1.e+6  * megaelectronvolt
+petaelectronvolt = 1.e+9  * megaelectronvolt
+
+joule = electronvolt / e_SI
+
+MeV = megaelectronvolt
+eV  = electronvolt
+keV = kiloelectronvolt
+GeV = gigaelectronvolt
+TeV = teraelectronvolt
+PeV = petaelectronvolt
+
+
+### Mass [E][T^2][L^-2]
+kilogram  = joule * second * second / (meter * meter)
+gram      = 1.e-3 * kilogram
+milligram = 1.e-3 * gram
+
+kg = kilogram
+g  = gram
+mg = milligram
+
+
+### Power, force & pressure
+watt       = joule / second
+newton     = joule / meter
+hep_pascal = newton / m2
+pascal     = hep_pascal
+bar        = 100000 * pascal
+atmosphere = 101325 * pascal
+
+W    = watt
+Pa   = pascal
+mbar = 1.e-3 * bar
+atm  = atmosphere
+
+
+### Electric current, potential, resistance & capacitance
+ampere      = coulomb / second
+milliampere = 1.e-3 * ampere
+microampere = 1.e-6 * ampere
+nanoampere  = 1.e-9 * ampere
+
+megavolt = megaelectronvolt / eplus
+kilovolt = 1.e-3 * megavolt
+volt     = 1.e-6 * megavolt
+
+ohm   = volt / ampere
+farad = coulomb / volt
+millifarad = 1.e-3  * farad
+microfarad = 1.e-6  * farad
+nanofarad  = 1.e-9  * farad
+picofarad  = 1.e-12 * farad
+
+V  = volt
+kV = kilovolt
+MV = megavolt
+A  = ampere
+mA = milliampere
+
+
+### Temperature & amount of substance
+kelvin = 1.
+mole   = 1.
+
+K   = kelvin
+mol = mole
+
+
+### Activity [T^-1]
+becquerel = 1. / second
+curie     = 3.7e+10 * becquerel
+
+Bq  = becquerel
+kBq = 1.e+3 * becquerel
+mBq = 1.e-3 * becquerel
+muBq = 1.e-6 * becquerel
+Ci  = curie
+mCi = 1.e-3 * curie
+muCi = 1.e-6 * curie
+
+
+### Absorbed dose [L^2][T^-2]
+gray      = joule / kilogram
+kilogray  = 1.e+3 * gray
+milligray = 1.e-3 * gray
+microgray = 1.e-6 * gray
+
+
+### Miscellaneous
+perCent     = 0.01
+perThousand = 0.001
+perMillion  = 0.000001
@@ -0,0 +1,228 @@
+# General importings
+import os
+import math
+import numpy  as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from typing import Tuple, List, Dict, Any, Optional, Sequence
+
+# Specific TONNE stuff
+import system_of_units as units
+
+from initial_activities   import get_muon_flux
+from initial_activities   import get_muon_flux_error
+
+from detector_backgrounds import radiogenic_components
+from detector_backgrounds import get_radiogenic_background_level
+from detector_backgrounds import get_radon_background_level
+from detector_backgrounds import get_muon_background_level
+
+from background_index     import get_rejection_arrays
+from background_index     import get_Xe136_mass
+from background_index     import get_toCKKY
+from background_index     import RADIOGENIC_ISOTOPES
+
+
+#####################################################################
+DEFAULT_QUANTILES = (0.025, 0.16, 0.5, 0.84, 0.975)
+
+
+
+#####################################################################
+def get_toy_model(det_name               : str,
+                  radiogenic_bkgnd_level : str,
+                  radon_bkgnd_level      : str,
+                  hosting_lab            : str,
+                  energyRes              : float,
+                  spatialDef             : str,
+                  activity_rel_err       : Optional[Dict[str, float]] = None,
+                  radon_rel_err          : float = 0.,
+                  muon_level             : Optional[Tuple[float, float]] = None
+                 )                      -> Dict[str, Any]:
+    '''
+    It returns the nominal values and uncertainties (as plain numpy arrays)
+    needed to evaluate background index toys of the scenario passed.
+
+    initial_activities holds no activity uncertainties, so the relative errors
+    of the material activities (activity_rel_err = {material: rel_err}) and of
+    the radon activity (radon_rel_err) are passed explicitly (0 by default).
+    The muon level error is split into the lab muon flux error and the rest
+    (Xe137 activation & flux binning statistics).
+    '''
+    activity_rel_err = {} if activity_rel_err is None else activity_rel_err
+
+    radiogenic_df = get_radiogenic_background_level(det_name, radiogenic_bkgnd_level)
+    sources       = list(radiogenic_df.index)
+
+    radiogenic_rej, radiogenic_rej_err = get_rejection_arrays(det_name, sources,
+                                                              [energyRes], [spatialDef],
+                                                              RADIOGENIC_ISOTOPES)
+    radon_rej, radon_rej_err = get_rejection_arrays(det_name, ['CATHODE'],
+                                                    [energyRes], [spatialDef], ['Bi214'])
+    Xe137_rej, Xe137_rej_err = get_rejection_arrays(det_name, ['ACTIVE'],
+                                                    [energyRes], [spatialDef], ['Xe137'])
+
+    if muon_level is None:
+        muon_level = get_muon_background_level(det_name, hosting_lab)
+    muon_bq, muon_bq_err = muon_level
+    flux_rel_err = get_muon_flux_error(hosting_lab) / get_muon_flux(hosting_lab)
+    stat_rel_err = math.sqrt(max((muon_bq_err / muon_bq)**2 - flux_rel_err**2, 0.))
+
+    # Missing rejection factors do not contribute
+    radiogenic_rej_err = np.where(np.isnan(radiogenic_rej), 0., radiogenic_rej_err)
+    radiogenic_rej     = np.nan_to_num(radiogenic_rej)
+
+    return {
+        'radiogenic_bq'      : radiogenic_df.loc[sources, RADIOGENIC_ISOTOPES].to_numpy(dtype=float),
+        'activity_rel_err'   : np.array([activity_rel_err.get(radiogenic_components[source][0], 0.)
+                                         for source in sources]),
+        'radiogenic_rej'     : radiogenic_rej    [0, 0],
+        'radiogenic_rej_err' : radiogenic_rej_err[0, 0],
+        'radon_bq'           : get_radon_background_level(det_name, radon_bkgnd_level) / units.Bq,
+        'radon_rel_err'      : radon_rel_err,
+        'radon_rej'          : radon_rej    [0, 0, 0, 0],
+        'radon_rej_err'      : radon_rej_err[0, 0, 0, 0],
+        'muon_bq'            : muon_bq,
+        'muon_flux_rel_err'  : flux_rel_err,
+        'muon_stat_rel_err'  : stat_rel_err,
+        'Xe137_rej'          : Xe137_rej    [0, 0, 0, 0],
+        'Xe137_rej_err'      : Xe137_rej_err[0, 0, 0, 0],
+        'toCKKY'             : get_toCKKY(get_Xe136_mass(det_name), energyRes)
+    }
+
+
+
+#####################################################################
+def evaluate_toys(model    : Dict[str, Any],
+                  n_toys   : int,
+                  seed_seq : np.random.SeedSequence
+                 )        -> np.ndarray:
+    '''
+    It returns the total background index (ckky) of n_toys toys,
+    sampling every input from its uncertainty (gaussian, truncated at 0).
+    '''
+    rng = np.random.default_rng(seed_seq)
+
+    def sample(mean, sigma, size):
+        return np.maximum(rng.normal(mean, sigma, size), 0.)
+
+    n_src, n_iso = model['radiogenic_bq'].shape
+
+    # Activities of every component: isotopes sampled independently (toys, src, iso)
+    activity_scale = sample(1., model['activity_rel_err'][:, None], (n_toys, n_src, n_iso))
+    radiogenic_rej = sample(model['radiogenic_rej'], model['radiogenic_rej_err'],
+                            (n_toys, n_src, n_iso))
+    radiogenic_bq  = np.einsum('tsi,si,tsi->t', activity_scale,
+                               model['radiogenic_bq'], radiogenic_rej)
+
+    radon_bq = model['radon_bq'] * sample(1., model['radon_rel_err'], n_toys) * \
+               sample(model['radon_rej'], model['radon_rej_err'], n_toys)
+
+    muon_bq  = model['muon_bq']  * sample(1., model['muon_flux_rel_err'], n_toys) * \
+               sample(1., model['muon_stat_rel_err'], n_toys) * \
+               sample(model['Xe137_rej'], model['Xe137_rej_err'], n_toys)
+
+    return (radiogenic_bq + radon_bq + muon_bq) * model['toCKKY']
+
+
+
+#####################################################################
+def evaluate_nominal(model: Dict[str, Any]) -> float:
+    '''
+    It returns the total background index (ckky) with every input at its nominal value.
+    '''
+    radiogenic_bq = np.sum(model['radiogenic_bq'] * model['radiogenic_rej'])
+    radon_bq      = model['radon_bq'] * model['radon_rej']
+    muon_bq       = model['muon_bq']  * model['Xe137_rej']
+    return float((radiogenic_bq + radon_bq + muon_bq) * model['toCKKY'])
+
+
+
+#####################################################################
+def propagate_background_uncertainty(det_name               : str,
+                                     radiogenic_bkgnd_level : str,
+                                     radon_bkgnd_level      : str,
+                                     hosting_lab            : str,
+                                     energyRes              : float,
+                                     spatialDef             : str,
+                                     n_toys                 : int = 1000000,
+                                     chunk_size             : int = 100000,
+                                     n_workers              : Optional[int] = None,
+                                     seed                   : Optional[int] = None,
+                                     activity_rel_err       : Optional[Dict[str, float]] = None,
+                                     radon_rel_err          : float = 0.,
+                                     muon_level             : Optional[Tuple[float, float]] = None,
+                                     quantiles              : Sequence[float] = DEFAULT_QUANTILES,
+                                     n_hist_bins            : int = 2000,
+                                     keep_samples           : bool = False
+                                    )                      -> Dict[str, Any]:
+    '''
+    It propagates the uncertainties of rejection factors, material & radon activities
+    and lab muon flux to the total background index (ckky) of the scenario passed,
+    using n_toys toys evaluated in chunks of chunk_size over a pool of n_workers processes
+    (n_workers = 1 runs them in this process).
+
+    The distribution is accumulated in a histogram of n_hist_bins (range set by a first
+    chunk, with under/overflow counts), so memory is bounded by chunk_size.
+    Only keep_samples = True keeps every toy.
+
+    It returns a dictionary with the mean, std, quantiles ({q: value}), the histogram
+    (hist_counts, hist_edges, underflow, overflow) and the samples (if kept).
+    '''
+    model     = get_toy_model(det_name, radiogenic_bkgnd_level, radon_bkgnd_level, hosting_lab,
+                              energyRes, spatialDef, activity_rel_err, radon_rel_err, muon_level)
+    n_chunks  = math.ceil(n_toys / chunk_size)
+    seeds     = np.random.SeedSequence(seed).spawn(n_chunks)
+    sizes     = [min(chunk_size, n_toys - i * chunk_size) for i in range(n_chunks)]
+
+    ### The first chunk sets the histogram range
+    first_toys = evaluate_toys(model, sizes[0], seeds[0])
+    hist_edges = np.linspace(0., 2. * first_toys.max(), n_hist_bins + 1)
+    hist_counts = np.zeros(n_hist_bins, dtype=np.int64)
+    underflow, overflow, toys_sum, toys_sum2 = 0, 0, 0., 0.
+    samples = []
+
+    def accumulate(toys):
+        nonlocal underflow, overflow, toys_sum, toys_sum2
+        hist_counts[:] += np.histogram(toys, bins=hist_edges)[0]
+        underflow      += int(np.count_nonzero(toys < hist_edges[ 0]))
+        overflow       += int(np.count_nonzero(toys > hist_edges[-1]))
+        toys_sum       += toys.sum()
+        toys_sum2      += (toys**2).sum()
+        if keep_samples:
+            samples.append(toys)
+
+    accumulate(first_toys)
+
+    if n_workers == 1:
+        for size, seed_seq in zip(sizes[1:], seeds[1:]):
+            accumulate(evaluate_toys(model, size, seed_seq))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            # Chunks submitted in windows, so pending results stay bounded
+            window = 2 * (n_workers or os.cpu_count() or 1)
+            for first in range(1, n_chunks, window):
+                futures = [executor.submit(evaluate_toys, model, size, seed_seq)
+                           for size, seed_seq in zip(sizes[first:first + window],
+                                                     seeds[first:first + window])]
+                for future in futures:
+                    accumulate(future.result())
+
+    ### Quantiles from the cumulative histogram (linear within bins)
+    cumulative = np.concatenate([[underflow], underflow + np.cumsum(hist_counts)]) / n_toys
+    quantile_values = {q: float(np.interp(q, cumulative, hist_edges)) for q in quantiles}
+
+    mean = toys_sum / n_toys
+    return {
+        'nominal'     : evaluate_nominal(model),
+        'mean'        : mean,
+        'std'         : math.sqrt(max(toys_sum2 / n_toys - mean**2, 0.)),
+        'quantiles'   : quantile_values,
+        'hist_counts' : hist_counts,
+        'hist_edges'  : hist_edges,
+        'underflow'   : underflow,
+        'overflow'    : overflow,
+        'samples'     : np.concatenate(samples) if keep_samples else None
+    }